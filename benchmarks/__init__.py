@@ -0,0 +1,3 @@
+"""
+Benchmarks for WebbPSF calculations. See bench_psf.py and run_benchmarks.py.
+"""
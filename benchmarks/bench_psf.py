@@ -0,0 +1,102 @@
+"""
+bench_psf.py
+
+    Benchmarks of calcPSF for each propagation regime in WebbPSF.
+
+    These follow the conventions of airspeed velocity (asv): each class has
+    `params` and `param_names`, a `setup` method called with each combination of
+    parameters, and `time_*` and `peakmem_*` methods that asv times or measures
+    the peak memory of. They can be run with asv, or with the standalone
+    run_benchmarks.py script in this directory which needs nothing beyond
+    WebbPSF itself.
+
+    The calculations run against a synthetic data directory (see
+    synthetic_data.py), created on first use in $WEBBPSF_BENCH_DATA or
+    ~/.webbpsf/benchmark_data, so no WebbPSF data files or network access are
+    needed. All calculations are serial, with autotuning disabled, so results are
+    comparable from run to run.
+
+"""
+import os
+
+from . import synthetic_data
+
+
+# mode name: (instrument, image mask, pupil mask)
+MODES = {'NIRCam imaging':      ('NIRCam', None, None),
+         'NIRSpec imaging':     ('NIRSpec', None, 'NIRSpec grating'),
+         'NIRISS imaging':      ('NIRISS', None, None),
+         'MIRI imaging':        ('MIRI', None, None),
+         'FGS imaging':         ('FGS', None, None),
+         'NIRCam round SAM':    ('NIRCam', 'MASK335R', 'CIRCLYOT'),
+         'NIRCam wedge':        ('NIRCam', 'MASKLWB', 'WEDGELYOT'),
+         'MIRI FQPM':           ('MIRI', 'FQPM1065', 'MASKFQPM'),
+         'MIRI Lyot':           ('MIRI', 'LYOT2300', 'MASKLYOT'),
+         'NIRISS NRM':          ('NIRISS', None, 'MASK_NRM'),
+         'NIRISS GR700XD':      ('NIRISS', None, 'GR700XD'),
+         'NIRSpec slit':        ('NIRSpec', 'S200A1', 'NIRSpec grating'),
+         'NIRSpec MSA shutter': ('NIRSpec', 'Three adjacent MSA open shutters', 'NIRSpec grating'),
+         'NIRSpec MSA grid':    ('NIRSpec', 'MSA all open', 'NIRSpec grating')}
+
+# filters for each mode, where the instrument default isn't appropriate
+FILTERS = {'NIRCam round SAM': 'F335M', 'NIRCam wedge': 'F444W', 'MIRI FQPM': 'F1065C', 'MIRI Lyot': 'F2300C',
+           'NIRISS NRM': 'F430M', 'NIRISS GR700XD': 'F150W', 'MIRI imaging': 'F1000W', 'NIRCam imaging': 'F200W'}
+
+OVERSAMPLES = [1, 2, 4, 8]
+NLAMBDAS = [1, 5, 10]
+FOV_ARCSEC = 5.0
+
+
+def data_path():
+    """ Location of the synthetic data directory, creating it if needed """
+    path = os.getenv('WEBBPSF_BENCH_DATA', os.path.join(os.path.expanduser('~'), '.webbpsf', 'benchmark_data'))
+    return synthetic_data.make_synthetic_data(path)
+
+
+def setup_webbpsf():
+    """ Point WebbPSF at the synthetic data, and fix the parallelization settings """
+    os.environ['WEBBPSF_PATH'] = data_path()
+    import webbpsf
+    webbpsf.settings.autotune.set(False)
+    webbpsf.settings.use_multiprocessing.set(False)
+    webbpsf.settings.use_threads.set(False)
+    return webbpsf
+
+
+def make_instrument(mode):
+    """ Configure an instrument for one of the MODES """
+    webbpsf = setup_webbpsf()
+    instname, image_mask, pupil_mask = MODES[mode]
+    inst = webbpsf.Instrument(instname)
+    if mode in FILTERS: inst.filter = FILTERS[mode]
+    inst.image_mask = image_mask
+    inst.pupil_mask = pupil_mask
+    return inst
+
+
+class CalcPSF(object):
+    """ Full calcPSF, including setup and output formatting """
+    params = [sorted(MODES.keys()), OVERSAMPLES, NLAMBDAS]
+    param_names = ['mode', 'oversample', 'nlambda']
+    timeout = 1800
+
+    def setup(self, mode, oversample, nlambda):
+        self.inst = make_instrument(mode)
+
+    def time_calcPSF(self, mode, oversample, nlambda):
+        self.inst.calcPSF(oversample=oversample, nlambda=nlambda, fov_arcsec=FOV_ARCSEC)
+
+    def peakmem_calcPSF(self, mode, oversample, nlambda):
+        self.inst.calcPSF(oversample=oversample, nlambda=nlambda, fov_arcsec=FOV_ARCSEC)
+
+
+class OpticalSystemSetup(object):
+    """ Building the optical system alone: reading pupils, OPDs and masks """
+    params = [sorted(MODES.keys()), OVERSAMPLES]
+    param_names = ['mode', 'oversample']
+
+    def setup(self, mode, oversample):
+        self.inst = make_instrument(mode)
+
+    def time_getOpticalSystem(self, mode, oversample):
+        self.inst._getOpticalSystem(fft_oversample=oversample, fov_arcsec=FOV_ARCSEC)
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+"""
+run_benchmarks.py
+
+    Run the WebbPSF benchmarks and compare them against a stored baseline.
+
+    This is a minimal stand-in for asv, for machines where that isn't available.
+    Each benchmark runs in a fresh Python process, so that its peak memory is
+    measured cleanly. Results are compared to the baseline for this machine in
+    benchmarks/baselines/, and any benchmark slower or larger than its baseline by
+    more than the tolerance is reported as a regression (with a non-zero exit
+    status, for use in automated testing).
+
+    Run from the top level of the source tree:
+
+        python -m benchmarks.run_benchmarks --quick            # a fast subset
+        python -m benchmarks.run_benchmarks -k "MIRI FQPM"     # just one mode
+        python -m benchmarks.run_benchmarks --save-baseline    # record a new baseline
+
+"""
+import os
+import sys
+import json
+import time
+import socket
+import inspect
+import optparse
+import itertools
+import subprocess
+
+_BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines')
+_MODULES = ['bench_psf']
+
+
+def _benchmark_classes():
+    import importlib
+    for modname in _MODULES:
+        module = importlib.import_module('benchmarks.' + modname)
+        for name, cls in sorted(inspect.getmembers(module, inspect.isclass)):
+            if cls.__module__ == module.__name__ and hasattr(cls, 'params'):
+                yield modname, cls
+
+
+def benchmark_id(clsname, method, params):
+    return "%s.%s(%s)" % (clsname, method, ", ".join([str(p) for p in params]))
+
+
+def list_benchmarks(quick=False, pattern=None):
+    """ Return a list of (module name, class name, method name, params) for all benchmarks """
+    cases = []
+    for modname, cls in _benchmark_classes():
+        params = list(cls.params)
+        if quick:
+            # smallest oversampling and nlambda values only
+            for i, name in enumerate(cls.param_names):
+                if name == 'oversample': params[i] = [p for p in params[i] if p <= 2]
+                if name == 'nlambda': params[i] = params[i][:1]
+        methods = [m for m in sorted(dir(cls)) if m.startswith('time_') or m.startswith('peakmem_')]
+        for method in methods:
+            for combo in itertools.product(*params):
+                if pattern is not None and pattern not in benchmark_id(cls.__name__, method, combo): continue
+                cases.append((modname, cls.__name__, method, list(combo)))
+    return cases
+
+
+def run_one(modname, clsname, method, params, repeat=1):
+    """ Run a single benchmark in this process, and return its result as a dict """
+    import importlib
+    import resource
+    module = importlib.import_module('benchmarks.' + modname)
+    bench = getattr(module, clsname)()
+    bench.setup(*params)
+    result = {}
+    if method.startswith('time_'):
+        times = []
+        for i in range(repeat):
+            t0 = time.time()
+            getattr(bench, method)(*params)
+            times.append(time.time() - t0)
+        result['time'] = min(times)
+        inst = getattr(bench, 'inst', None)
+        if getattr(inst, 'last_profile', None) is not None and method == 'time_calcPSF':
+            result['stages'] = dict([(s.name, s.elapsed) for s in inst.last_profile.stages if s.depth == 0])
+    else:
+        getattr(bench, method)(*params)
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        result['peakmem'] = maxrss * (1. if sys.platform == 'darwin' else 1024.)
+    return result
+
+
+def _run_subprocess(case, repeat):
+    cmd = [sys.executable, '-m', 'benchmarks.run_benchmarks', '--run-one', json.dumps(case), '--repeat', str(repeat)]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    if proc.returncode != 0:
+        return {'error': err.strip().splitlines()[-1] if err.strip() else 'failed'}
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def baseline_filename():
+    return os.path.join(_BASELINE_DIR, socket.gethostname().split('.')[0] + '.json')
+
+
+def compare(results, baseline, tolerance):
+    """ Compare results to a baseline, returning a list of (id, quantity, old, new, status) """
+    comparisons = []
+    for bid, result in sorted(results.items()):
+        if bid not in baseline: continue
+        for quantity in ['time', 'peakmem']:
+            if quantity not in result or quantity not in baseline[bid]: continue
+            old, new = baseline[bid][quantity], result[quantity]
+            if new > old*(1+tolerance):
+                status = 'REGRESSION'
+            elif new < old/(1+tolerance):
+                status = 'improved'
+            else:
+                status = 'ok'
+            comparisons.append((bid, quantity, old, new, status))
+    return comparisons
+
+
+def _format(quantity, value):
+    return "%9.3f s " % value if quantity == 'time' else "%8.1f MB" % (value/1024.**2)
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage="python -m benchmarks.run_benchmarks [options]")
+    parser.add_option('--quick', action='store_true', help='Only run oversample <= 2 and the smallest nlambda')
+    parser.add_option('-k', dest='pattern', help='Only run benchmarks whose name contains this string')
+    parser.add_option('--repeat', type='int', default=1, help='Number of times to repeat each timing, taking the fastest')
+    parser.add_option('--baseline', default=None, help='Baseline file (default: baselines/<hostname>.json)')
+    parser.add_option('--save-baseline', action='store_true', help='Save these results as the baseline for this machine')
+    parser.add_option('--tolerance', type='float', default=0.2, help='Fractional change allowed before flagging a regression')
+    parser.add_option('--output', default=None, help='Also write the results to this JSON file')
+    parser.add_option('--list', action='store_true', help='List the benchmarks without running them')
+    parser.add_option('--run-one', default=None, help=optparse.SUPPRESS_HELP)
+    options, args = parser.parse_args(argv)
+
+    if options.run_one is not None:
+        modname, clsname, method, params = json.loads(options.run_one)
+        print json.dumps(run_one(modname, clsname, method, params, repeat=options.repeat))
+        return 0
+
+    cases = list_benchmarks(quick=options.quick, pattern=options.pattern)
+    if options.list:
+        for modname, clsname, method, params in cases: print benchmark_id(clsname, method, params)
+        return 0
+
+    # create the synthetic data once up front, rather than racing to do so in the first benchmark
+    from . import bench_psf
+    print "Using synthetic data in " + bench_psf.data_path()
+
+    results = {}
+    for i, case in enumerate(cases):
+        bid = benchmark_id(*case[1:])
+        result = _run_subprocess(case, options.repeat)
+        results[bid] = result
+        if 'error' in result:
+            print "[%3d/%d] %-70s FAILED: %s" % (i+1, len(cases), bid, result['error'])
+        else:
+            quantity = 'time' if 'time' in result else 'peakmem'
+            print "[%3d/%d] %-70s %s" % (i+1, len(cases), bid, _format(quantity, result[quantity]))
+        sys.stdout.flush()
+
+    record = {'machine': socket.gethostname(), 'python': sys.version.split()[0],
+              'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'results': results}
+    if options.output is not None:
+        with open(options.output, 'w') as f: json.dump(record, f, indent=1, sort_keys=True)
+
+    status = 0
+    baseline_file = options.baseline or baseline_filename()
+    if os.path.exists(baseline_file):
+        with open(baseline_file) as f: baseline = json.load(f)['results']
+        comparisons = compare(results, baseline, options.tolerance)
+        regressions = [c for c in comparisons if c[4] == 'REGRESSION']
+        print "\nCompared %d results against baseline %s:" % (len(comparisons), baseline_file)
+        for bid, quantity, old, new, flag in comparisons:
+            if flag != 'ok':
+                print "  %-10s %-70s %s -> %s (%+.0f%%)" % (flag, bid, _format(quantity, old), _format(quantity, new), 100*(new/old-1))
+        print "%d regression(s) beyond %.0f%% tolerance" % (len(regressions), 100*options.tolerance)
+        if len(regressions) > 0: status = 1
+    elif not options.save_baseline:
+        print "\nNo baseline for this machine yet; run with --save-baseline to record one."
+
+    if options.save_baseline:
+        baseline = dict([(k, v) for k, v in results.items() if 'error' not in v])
+        if os.path.exists(baseline_file):
+            # keep baseline entries for benchmarks not run this time
+            with open(baseline_file) as f: previous = json.load(f)['results']
+            previous.update(baseline)
+            baseline = previous
+        record['results'] = baseline
+        if not os.path.isdir(os.path.dirname(baseline_file)): os.makedirs(os.path.dirname(baseline_file))
+        with open(baseline_file, 'w') as f: json.dump(record, f, indent=1, sort_keys=True)
+        print "Saved baseline to " + baseline_file
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
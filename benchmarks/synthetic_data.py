@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+"""
+synthetic_data.py
+
+    Create a small stand-in for the WebbPSF data directory, for benchmarking.
+
+    The real data files (pupil, OPDs, filter profiles, pupil masks) are large and
+    not freely redistributable, and the benchmarks should run on any machine
+    without them. This writes files with the same names, formats, and array sizes
+    as the real ones, but with simple synthetic contents: a hexagonal pupil with
+    secondary obscuration and struts, smooth random OPDs, tophat filter profiles,
+    circular stand-ins for the Lyot stops and other pupil masks, and SIAFs with
+    just the full-frame detector apertures, as linear transformations.
+
+    Calculation times depend on array sizes, not on their contents, so timings
+    against this data are representative of the real thing. The PSFs are not!
+
+    Usage:
+
+        python synthetic_data.py /path/to/directory [npix]
+
+"""
+import os
+import sys
+import numpy as np
+import astropy.io.fits as fits
+
+
+PUPIL_DIAMETER = 6.5 # meters, flat-to-flat of the hexagon approximating the primary
+
+FILTERS = {'NIRCam':  ['F070W', 'F150W', 'F200W', 'F210M', 'F335M', 'F444W', 'F480M'],
+           'NIRSpec': ['F110W', 'F140X'],
+           'NIRISS':  ['F150W', 'F277W', 'F380M', 'F430M', 'F480M'],
+           'MIRI':    ['F560W', 'F1000W', 'F1065C', 'F1140C', 'F1550C', 'F2300C'],
+           'FGS':     ['FGS']}
+
+# fractional bandwidth and default nlambda for each filter width suffix
+_BANDWIDTHS = {'W': (0.25, 9), 'X': (0.35, 9), 'M': (0.10, 3), 'N': (0.01, 1), 'C': (0.06, 3)}
+
+# pupil masks read from FITS files, relative to the data directory, and the fraction of the
+# pupil diameter each one transmits (a circular stand-in for the real shape)
+PUPIL_MASKS = {'tricontagon.fits': 1.0,
+               'MIRI/optics/MIRI_FQPMLyotStop.fits.gz': 0.80,
+               'MIRI/optics/MIRI_LyotLyotStop.fits.gz': 0.75,
+               'MIRI/optics/MIRI_LRS_Pupil_Stop.fits.gz': 0.90,
+               'NIRCam/optics/NIRCam_Lyot_Somb.fits': 0.80,
+               'NIRCam/optics/NIRCam_Lyot_Sinc.fits': 0.80,
+               'NIRISS/coronagraph/MASKCLEAR.fits.gz': 0.95,
+               'NIRISS/optics/MASKGR700XD.fits.gz': 0.95}
+
+
+def _coordinates(npix):
+    """ x, y in meters across a pupil array of npix pixels """
+    pixelscale = PUPIL_DIAMETER / npix
+    y, x = np.indices((npix, npix), dtype=float)
+    y -= (npix-1)/2.
+    x -= (npix-1)/2.
+    return x*pixelscale, y*pixelscale, pixelscale
+
+
+def _pupil_header(hdu, pixelscale, npix):
+    hdu.header.update('PUPLSCAL', pixelscale, 'Pupil plane pixel scale in meters')
+    hdu.header.update('PUPLDIAM', pixelscale*npix, 'Full pupil array size in meters')
+    hdu.header.update('DIAM', PUPIL_DIAMETER, 'Pupil diameter in meters')
+    hdu.header.update('SYNTHETC', True, 'Synthetic data for benchmarking only')
+
+
+def make_pupil(npix):
+    """ Hexagonal pupil with central obscuration and three struts """
+    x, y, pixelscale = _coordinates(npix)
+    r = PUPIL_DIAMETER/2
+    hexagon = (np.abs(y) <= r*np.sqrt(3)/2) & (np.abs(y) <= np.sqrt(3)*(r - np.abs(x)))
+    obscuration = np.sqrt(x**2+y**2) < 0.37
+    struts = np.zeros_like(hexagon)
+    for angle in [90, 210, 330]:
+        theta = np.radians(angle)
+        along = x*np.cos(theta) + y*np.sin(theta)
+        across = -x*np.sin(theta) + y*np.cos(theta)
+        struts |= (along > 0) & (np.abs(across) < 0.04)
+    pupil = (hexagon & ~obscuration & ~struts).astype(np.float32)
+    hdu = fits.PrimaryHDU(pupil)
+    _pupil_header(hdu, pixelscale, npix)
+    return fits.HDUList([hdu])
+
+
+def make_mask(npix, fraction):
+    """ Circular pupil mask transmitting the given fraction of the pupil diameter """
+    x, y, pixelscale = _coordinates(npix)
+    mask = (np.sqrt(x**2+y**2) < fraction*PUPIL_DIAMETER/2).astype(np.float32)
+    hdu = fits.PrimaryHDU(mask)
+    _pupil_header(hdu, pixelscale, npix)
+    return fits.HDUList([hdu])
+
+
+def make_nrm(npix):
+    """ Non-redundant mask with seven small holes """
+    x, y, pixelscale = _coordinates(npix)
+    mask = np.zeros((npix, npix), dtype=np.float32)
+    holes = [(0, -2.6), (-2.0, -1.2), (2.0, -1.2), (-1.0, 0.6), (2.3, 0.9), (-2.2, 1.6), (1.0, 2.3)]
+    for hx, hy in holes:
+        mask[np.sqrt((x-hx)**2+(y-hy)**2) < 0.4] = 1
+    hdu = fits.PrimaryHDU(mask)
+    _pupil_header(hdu, pixelscale, npix)
+    return fits.HDUList([hdu])
+
+
+def make_opd(npix, nslices=3, rms=0.1, seed=0):
+    """ Datacube of smooth random OPD maps, in microns """
+    x, y, pixelscale = _coordinates(npix)
+    rho = np.sqrt(x**2+y**2) / (PUPIL_DIAMETER/2)
+    theta = np.arctan2(y, x)
+    # a few low order aberrations: focus, astigmatism, coma, trefoil, spherical
+    modes = [2*rho**2-1, rho**2*np.cos(2*theta), rho**2*np.sin(2*theta),
+             (3*rho**3-2*rho)*np.cos(theta), (3*rho**3-2*rho)*np.sin(theta),
+             rho**3*np.cos(3*theta), 6*rho**4-6*rho**2+1]
+    random = np.random.RandomState(seed)
+    cube = np.zeros((nslices, npix, npix), dtype=np.float32)
+    for i in range(nslices):
+        coeffs = random.normal(size=len(modes))
+        opd = np.sum([c*m for c, m in zip(coeffs, modes)], axis=0)
+        cube[i] = opd * rms/opd[rho < 1].std()
+    hdu = fits.PrimaryHDU(cube)
+    _pupil_header(hdu, pixelscale, npix)
+    hdu.header.update('BUNIT', 'micron')
+    return fits.HDUList([hdu])
+
+
+# full-frame SIAF apertures for each instrument's detectors, as (name, pixel scale in arcsec, X size, Y size)
+SIAF_APERTURES = {'NIRCam':  [('NRC%s_FULL_CNTR' % d, 0.0317, 2048, 2048) for d in
+                              ['A1', 'A2', 'A3', 'A4', 'A5', 'B1', 'B2', 'B3', 'B4', 'B5']],
+                  'NIRSpec': [('NRS1_FULL_CNTR', 0.1, 2048, 2048), ('NRS2_FULL_CNTR', 0.1, 2048, 2048)],
+                  'NIRISS':  [('NIS_FULL_CNTR', 0.065, 2048, 2048)],
+                  'MIRI':    [('MIRIM_FULL_ILLCNTR', 0.11, 1032, 1024)],
+                  'FGS':     [('FGS1_FULL_CNTR', 0.069, 2048, 2048), ('FGS2_FULL_CNTR', 0.069, 2048, 2048)]}
+
+
+def siaf_filename(instname):
+    """ SIAF file name for an instrument, relative to the data directory, as jwxml.SIAF reads it """
+    return '%s/%s%sSIAF.XML' % (instname, instname, '_' if instname == 'NIRISS' else '')
+
+
+def make_siaf(instname):
+    """ SIAF XML text with a first-order (linear) aperture for each full-frame detector """
+    entries = []
+    for i, (name, pixelscale, xsize, ysize) in enumerate(SIAF_APERTURES[instname]):
+        half_x, half_y = xsize/2. * pixelscale, ysize/2. * pixelscale
+        values = [('AperName', name), ('AperType', 'FULLSCA'),
+                  ('XDetSize', xsize), ('YDetSize', ysize), ('XSciSize', xsize), ('YSciSize', ysize),
+                  ('XDetRef', (xsize+1)/2.), ('YDetRef', (ysize+1)/2.), ('XSciRef', (xsize+1)/2.), ('YSciRef', (ysize+1)/2.),
+                  ('XSciScale', pixelscale), ('YSciScale', pixelscale),
+                  ('DetSciYAngle', 0), ('DetSciParity', 1), ('V3IdlYAng', 0), ('VIdlParity', -1),
+                  ('V2Ref', 100.0 + 150*i), ('V3Ref', -500.0),
+                  ('XIdlVert1', -half_x), ('XIdlVert2', half_x), ('XIdlVert3', half_x), ('XIdlVert4', -half_x),
+                  ('YIdlVert1', -half_y), ('YIdlVert2', -half_y), ('YIdlVert3', half_y), ('YIdlVert4', half_y),
+                  ('Sci2IdlDeg', 1),
+                  ('Sci2IdlX10', pixelscale), ('Sci2IdlX11', 0), ('Sci2IdlY10', 0), ('Sci2IdlY11', pixelscale),
+                  ('Idl2SciX10', 1/pixelscale), ('Idl2SciX11', 0), ('Idl2SciY10', 0), ('Idl2SciY11', 1/pixelscale)]
+        entries.append('  <SiafEntry>\n' + ''.join(['    <%s>%s</%s>\n' % (key, value, key) for key, value in values]) +
+                       '  </SiafEntry>\n')
+    return '<?xml version="1.0" encoding="UTF-8"?>\n<SiafFile>\n' + ''.join(entries) + '</SiafFile>\n'
+
+
+def _filter_center(filtername):
+    """ Central wavelength in microns from a filter name like F210M or F1065C """
+    if filtername == 'FGS': return 2.8
+    return float(filtername[1:-1])/100
+
+
+def make_filter(filtername):
+    """ Tophat filter throughput table, with wavelengths in Angstroms """
+    if filtername == 'FGS':
+        wmin, wmax = 0.6, 5.0
+    else:
+        center = _filter_center(filtername)
+        width = _BANDWIDTHS[filtername[-1]][0] * center
+        wmin, wmax = center-width/2, center+width/2
+    wave = np.linspace(wmin - 0.05*(wmax-wmin), wmax + 0.05*(wmax-wmin), 200) * 1e4
+    throughput = ((wave >= wmin*1e4) & (wave <= wmax*1e4)).astype(float) * 0.9
+    cols = fits.ColDefs([fits.Column(name='WAVELENGTH', format='D', unit='Angstrom', array=wave),
+                         fits.Column(name='THROUGHPUT', format='D', array=throughput)])
+    if hasattr(fits.BinTableHDU, 'from_columns'):
+        table = fits.BinTableHDU.from_columns(cols)
+    else:
+        table = fits.new_table(cols)
+    table.header.update('WAVEUNIT', 'Angstrom')
+    return fits.HDUList([fits.PrimaryHDU(), table])
+
+
+def _nlambda(filtername):
+    if filtername == 'FGS': return 10
+    return _BANDWIDTHS[filtername[-1]][1]
+
+
+def make_synthetic_data(path, npix=1024, clobber=False):
+    """ Write a synthetic WebbPSF data directory.
+
+    Parameters
+    ----------
+    path : string
+        Directory to create. Point $WEBBPSF_PATH at this to use it.
+    npix : int
+        Size of the pupil arrays. The real data use 1024.
+    clobber : bool
+        Regenerate the files even if the directory already exists.
+
+    Returns
+    -------
+    path : string
+        The data directory
+    """
+    path = os.path.abspath(path)
+    marker = os.path.join(path, 'synthetic_v2_npix%d' % npix)
+    if os.path.exists(marker) and not clobber:
+        return path
+
+    def write(hdulist, relpath):
+        filename = os.path.join(path, relpath)
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        hdulist.writeto(filename, clobber=True)
+
+    write(make_pupil(npix), 'pupil_RevV.fits')
+    for relpath, fraction in PUPIL_MASKS.items():
+        write(make_mask(npix, fraction), relpath)
+    write(make_nrm(npix), 'NIRISS/coronagraph/MASK_NRM.fits.gz')
+
+    lines = ['instrument filter nlambda']
+    for seed, (instname, filters) in enumerate(sorted(FILTERS.items())):
+        write(make_opd(npix, seed=seed), '%s/OPD/OPD_RevV_%s_synthetic.fits' % (instname, instname.lower()))
+        for filtername in filters:
+            write(make_filter(filtername), '%s/filters/%s_throughput.fits' % (instname, filtername))
+            lines.append('%s %s %d' % (instname, filtername, _nlambda(filtername)))
+        with open(os.path.join(path, siaf_filename(instname)), 'w') as f:
+            f.write(make_siaf(instname))
+    with open(os.path.join(path, 'filters.txt'), 'w') as f:
+        f.write("\n".join(lines) + "\n")
+
+    open(marker, 'w').close()
+    return path
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print __doc__
+        sys.exit(1)
+    npix = int(sys.argv[2]) if len(sys.argv) > 2 else 1024
+    print "Writing synthetic WebbPSF data with %d pixel pupils to %s" % (npix, make_synthetic_data(sys.argv[1], npix=npix, clobber=True))
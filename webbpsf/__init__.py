@@ -20,6 +20,9 @@ from poppy import (display_PSF, display_PSF_difference, display_EE, display_prof
 from .webbpsf_core import Instrument, JWInstrument, NIRCam, NIRISS, NIRSpec,MIRI,FGS
 
 from . import utils
+from . import tuning
+from . import propagation
+from . import profiling
 from .utils import setup_logging #, _system_diagnostic, _check_for_new_install, _restart_logging
 
 utils.check_for_new_install()    # display informative message if so.
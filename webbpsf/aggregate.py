@@ -0,0 +1,388 @@
+#!/usr/bin/env python
+"""
+aggregate.py
+
+    Streaming statistics over many PSF realizations.
+
+    Monte Carlo studies (over OPD realizations, jitter draws, pupil shifts, ...)
+    usually need only the mean PSF, its per-pixel variance, and the distributions
+    of a few metrics such as encircled energy, FWHM and Strehl ratio. A
+    `PSFAggregator` consumes PSFs one at a time as they are computed and keeps
+    just those:
+
+        >>> from webbpsf import aggregate
+        >>> agg = aggregate.PSFAggregator(ee_radii=[0.1, 0.5])
+        >>> for i in range(10):
+        ...     nc.pupilopd = ('OPD_RevV_nircam_132.fits', i)
+        ...     agg.add(nc.calcPSF(fov_arcsec=3))
+        >>> mean_psf, variance = agg.mean, agg.variance
+        >>> agg.quantile('fwhm', [0.05, 0.5, 0.95])
+
+    The per-pixel mean and variance are running (Welford) moments, so memory does
+    not grow with the number of PSFs. Metric distributions are kept as quantile
+    sketches with bounded relative error and a size that depends only on the range
+    of values. Aggregators from different worker processes or batch shards can be
+    combined with `merge`, exactly, in any order; `write` saves one to a FITS file
+    and `read_aggregate` loads it back.
+
+"""
+import numpy as np
+import astropy.io.fits as fits
+
+import poppy
+
+import logging
+_log = logging.getLogger('webbpsf')
+
+
+class RunningMoments(object):
+    """ Running mean and variance of a scalar or array quantity, by Welford's algorithm
+
+    Attributes
+    ----------
+    count : int
+        Number of values added
+    mean : float or ndarray
+        Mean of the values so far
+    m2 : float or ndarray
+        Sum of squared deviations from the mean
+    """
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+
+    def add(self, value):
+        value = np.asarray(value, dtype=np.float64)
+        self.count += 1
+        if self.mean is None:
+            self.mean = value.copy()
+            self.m2 = np.zeros_like(self.mean)
+            return
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def merge(self, other):
+        """ Combine with the moments of another set of values (Chan et al.'s parallel algorithm) """
+        if other.count == 0: return
+        if self.count == 0:
+            self.count, self.mean, self.m2 = other.count, np.array(other.mean, copy=True), np.array(other.m2, copy=True)
+            return
+        if np.shape(self.mean) != np.shape(other.mean):
+            raise ValueError("Can't merge moments of shape %s with %s" % (np.shape(self.mean), np.shape(other.mean)))
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * (float(other.count) / count)
+        self.m2 = self.m2 + other.m2 + delta**2 * (float(self.count) * other.count / count)
+        self.count = count
+
+    @property
+    def variance(self):
+        """ Sample variance (with N-1 in the denominator), or None for fewer than 2 values """
+        if self.count < 2: return None
+        return self.m2 / (self.count - 1)
+
+
+class QuantileSketch(object):
+    """ Mergeable sketch of a distribution, for estimating its quantiles
+
+    Values are counted in logarithmically spaced bins (as in the DDSketch algorithm),
+    so every quantile estimate is within `relative_accuracy` of the true value, and
+    the number of bins grows only with the logarithm of the range of values, not with
+    the number of values. Merging two sketches just adds their bin counts, so it is
+    exact and independent of the order of merging.
+
+    Parameters
+    ----------
+    relative_accuracy : float
+        Maximum relative error of quantile estimates.
+    """
+    def __init__(self, relative_accuracy=0.005):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.positive = {}  # bin index: count, for values > 0
+        self.negative = {}  # bin index of abs(value): count, for values < 0
+        self.zeros = 0
+        self.count = 0
+        self.min = np.inf
+        self.max = -np.inf
+
+    def _index(self, value):
+        return int(np.ceil(np.log(value) / np.log(self.gamma)))
+
+    def _value(self, index):
+        return 2 * self.gamma**index / (self.gamma + 1)
+
+    def add(self, value, count=1):
+        value = float(value)
+        if not np.isfinite(value): return
+        if value > 0:
+            bins, key = self.positive, self._index(value)
+        elif value < 0:
+            bins, key = self.negative, self._index(-value)
+        else:
+            self.zeros += count
+            bins = None
+        if bins is not None: bins[key] = bins.get(key, 0) + count
+        self.count += count
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Can't merge sketches with different relative accuracies")
+        for mine, theirs in [(self.positive, other.positive), (self.negative, other.negative)]:
+            for key, count in theirs.items():
+                mine[key] = mine.get(key, 0) + count
+        self.zeros += other.zeros
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q):
+        """ Estimate the q'th quantile (0 <= q <= 1), or an array of them for an iterable of q """
+        if np.iterable(q): return np.array([self.quantile(qi) for qi in q])
+        if self.count == 0: return np.nan
+        if not 0 <= q <= 1: raise ValueError("Quantiles must be between 0 and 1")
+        rank = q * (self.count - 1)
+        # walk through the bins from the most negative value to the most positive
+        bins = [(-self._value(k), n) for k, n in sorted(self.negative.items(), reverse=True)]
+        bins.append((0.0, self.zeros))
+        bins.extend([(self._value(k), n) for k, n in sorted(self.positive.items())])
+        seen = 0
+        for value, n in bins:
+            seen += n
+            if seen > rank: break
+        return min(max(value, self.min), self.max)
+
+    def _bins(self):
+        """ (sign, index, count) for every non-empty bin """
+        rows = [(-1, k, n) for k, n in sorted(self.negative.items())]
+        if self.zeros > 0: rows.append((0, 0, self.zeros))
+        rows.extend([(1, k, n) for k, n in sorted(self.positive.items())])
+        return rows
+
+
+class PSFAggregator(object):
+    """ Accumulate statistics over a stream of PSFs
+
+    Parameters
+    ----------
+    ext : int or string
+        Which extension of each PSF to use, e.g. 'DET_SAMP' for the detector-sampled PSF.
+    ee_radii : iterable of floats
+        Radii in arcsec at which to record the encircled energy, as metrics 'ee_<radius>'.
+    fwhm : bool
+        Record the FWHM in arcsec, as metric 'fwhm'?
+    strehl_reference : fits.HDUList, optional
+        A PSF with no wavefront error, computed with the same sampling. If given, the Strehl
+        ratio of each PSF is recorded as metric 'strehl', estimated as the ratio of its
+        flux-normalized peak to that of the reference.
+    relative_accuracy : float
+        Relative accuracy of the metric quantile sketches.
+
+    Attributes
+    ----------
+    count : int
+        Number of PSFs added
+    mean, variance : ndarray
+        Per-pixel mean and sample variance of the PSFs added
+    metrics : dict
+        Running moments of each metric, by name
+    sketches : dict
+        Quantile sketches of each metric, by name
+    header : fits.Header
+        Header of the first PSF added, for its pixel scale, instrument configuration, etc.
+    """
+    def __init__(self, ext=0, ee_radii=(0.1, 0.2, 0.5), fwhm=True, strehl_reference=None, relative_accuracy=0.005):
+        self.ext = ext
+        self.ee_radii = [float(r) for r in ee_radii]
+        self.fwhm = fwhm
+        self.relative_accuracy = relative_accuracy
+        self.pixels = RunningMoments()
+        self.metrics = {}
+        self.sketches = {}
+        self.header = None
+        self._reference_peak = None
+        if strehl_reference is not None:
+            reference = strehl_reference[ext].data
+            self._reference_peak = reference.max() / reference.sum()
+
+    @property
+    def count(self):
+        return self.pixels.count
+
+    @property
+    def mean(self):
+        return self.pixels.mean
+
+    @property
+    def variance(self):
+        return self.pixels.variance
+
+    def measure(self, psf):
+        """ Compute the metrics for one PSF, returning a dict of values by metric name """
+        values = {}
+        if len(self.ee_radii) > 0:
+            ee = poppy.measure_EE(psf, ext=self.ext)
+            for radius in self.ee_radii:
+                values['ee_%g' % radius] = float(ee(radius))
+        if self.fwhm:
+            values['fwhm'] = float(poppy.measure_fwhm(psf, ext=self.ext))
+        if self._reference_peak is not None:
+            data = psf[self.ext].data
+            values['strehl'] = float(data.max() / data.sum() / self._reference_peak)
+        return values
+
+    def add(self, psf):
+        """ Add a PSF, given as an HDUList such as calcPSF returns
+
+        A cube of PSFs, such as from `JWInstrument.calcPSF_opd_cube`, adds each plane in turn.
+        """
+        hdu = psf[self.ext]
+        if hdu.data.ndim == 3:
+            for plane in hdu.data:
+                self.add(fits.HDUList([fits.PrimaryHDU(data=plane, header=hdu.header)]) if self.ext in (0, 'PRIMARY')
+                         else fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(data=plane, header=hdu.header)]))
+            return
+        if self.header is None: self.header = hdu.header.copy()
+        self.pixels.add(hdu.data)
+        for name, value in self.measure(psf).items():
+            self.metrics.setdefault(name, RunningMoments()).add(value)
+            self.sketches.setdefault(name, QuantileSketch(self.relative_accuracy)).add(value)
+
+    def _check_compatible(self, other):
+        """ Raise ValueError unless the other aggregator measures its PSFs the same way as this one """
+        if str(other.ext) != str(self.ext):
+            raise ValueError("Can't merge aggregates of extension %s with extension %s" % (other.ext, self.ext))
+        # compared as formatted in the metric names, which is all that survives a round trip through a file
+        if sorted(['%g' % r for r in other.ee_radii]) != sorted(['%g' % r for r in self.ee_radii]):
+            raise ValueError("Can't merge aggregates with different encircled energy radii")
+        if bool(other.fwhm) != bool(self.fwhm):
+            raise ValueError("Can't merge aggregates with and without the FWHM")
+        if (other._reference_peak is None) != (self._reference_peak is None) or (self._reference_peak is not None and
+                not np.allclose(other._reference_peak, self._reference_peak, rtol=1e-10, atol=0)):
+            raise ValueError("Can't merge aggregates with different Strehl references")
+
+    def merge(self, other):
+        """ Combine with another aggregator's statistics, e.g. from another process or shard
+
+        Both must measure their PSFs the same way: the same extension, encircled energy radii,
+        FWHM setting and Strehl reference. Otherwise this raises ValueError.
+        """
+        self._check_compatible(other)
+        self.pixels.merge(other.pixels)
+        if self.header is None and other.header is not None: self.header = other.header.copy()
+        for name in other.metrics:
+            self.metrics.setdefault(name, RunningMoments()).merge(other.metrics[name])
+            self.sketches.setdefault(name, QuantileSketch(self.relative_accuracy)).merge(other.sketches[name])
+        return self
+
+    def quantile(self, metric, q):
+        """ Estimated quantile(s) q (between 0 and 1) of a metric's distribution """
+        return self.sketches[metric].quantile(q)
+
+    def summary(self, quantiles=(0.05, 0.5, 0.95)):
+        """ Dict of {metric: dict(mean=, std=, min=, max=, q<percent>=...)} """
+        result = {}
+        for name in sorted(self.metrics):
+            moments, sketch = self.metrics[name], self.sketches[name]
+            entry = {'mean': float(moments.mean), 'min': sketch.min, 'max': sketch.max,
+                     'std': float(np.sqrt(moments.variance)) if moments.count > 1 else np.nan}
+            for q in quantiles:
+                entry['q%g' % (100*q)] = sketch.quantile(q)
+            result[name] = entry
+        return result
+
+    def to_hdulist(self):
+        """ The statistics as an HDUList: mean PSF, VARIANCE, and METRICS and SKETCHES tables """
+        if self.count == 0: raise ValueError("No PSFs have been added.")
+        primary = fits.PrimaryHDU(data=self.mean, header=self.header.copy())
+        primary.header.update('NPSF', self.count, 'Number of PSFs aggregated')
+        primary.header.update('AGGEXT', str(self.ext), 'Extension of each PSF aggregated')
+        primary.header.update('SKETCHRA', self.relative_accuracy, 'Relative accuracy of metric quantile sketches')
+        if self._reference_peak is not None:
+            primary.header.update('STRLREF', self._reference_peak, 'Normalized peak of the Strehl reference PSF')
+        m2 = fits.ImageHDU(data=self.pixels.m2)
+        m2.header.update('EXTNAME', 'M2', 'Per-pixel sum of squared deviations from the mean')
+        variance = fits.ImageHDU(data=self.variance if self.count > 1 else np.zeros_like(self.mean))
+        variance.header.update('EXTNAME', 'VARIANCE', 'Per-pixel sample variance')
+
+        names = sorted(self.metrics)
+        metrics = _table([fits.Column(name='NAME', format='16A', array=np.asarray(names, dtype='S16')),
+                          fits.Column(name='COUNT', format='K', array=np.asarray([self.metrics[n].count for n in names])),
+                          fits.Column(name='MEAN', format='D', array=np.asarray([self.metrics[n].mean for n in names])),
+                          fits.Column(name='M2', format='D', array=np.asarray([self.metrics[n].m2 for n in names])),
+                          fits.Column(name='MIN', format='D', array=np.asarray([self.sketches[n].min for n in names])),
+                          fits.Column(name='MAX', format='D', array=np.asarray([self.sketches[n].max for n in names]))], 'METRICS')
+        rows = [(name,) + row for name in names for row in self.sketches[name]._bins()]
+        sketches = _table([fits.Column(name='NAME', format='16A', array=np.asarray([r[0] for r in rows], dtype='S16')),
+                           fits.Column(name='SIGN', format='I', array=np.asarray([r[1] for r in rows], dtype=np.int16)),
+                           fits.Column(name='BIN', format='J', array=np.asarray([r[2] for r in rows], dtype=np.int32)),
+                           fits.Column(name='COUNT', format='K', array=np.asarray([r[3] for r in rows], dtype=np.int64))], 'SKETCHES')
+        return fits.HDUList([primary, variance, m2, metrics, sketches])
+
+    def write(self, filename, clobber=True):
+        self.to_hdulist().writeto(filename, clobber=clobber)
+
+    @classmethod
+    def from_hdulist(cls, hdulist):
+        header = hdulist[0].header
+        ext = header.get('AGGEXT', '0')
+        aggregator = cls(ext=int(ext) if ext.isdigit() else ext, ee_radii=(), fwhm=False,
+                         relative_accuracy=header['SKETCHRA'])
+        aggregator.header = header.copy()
+        aggregator._reference_peak = header.get('STRLREF', None)
+        for key in ['NPSF', 'AGGEXT', 'SKETCHRA', 'STRLREF']:
+            if key in aggregator.header: del aggregator.header[key]
+        aggregator.pixels.count = header['NPSF']
+        aggregator.pixels.mean = np.asarray(hdulist[0].data, dtype=np.float64)
+        aggregator.pixels.m2 = np.asarray(hdulist['M2'].data, dtype=np.float64)
+        for row in hdulist['METRICS'].data:
+            name = row['NAME'].strip()
+            moments = aggregator.metrics[name] = RunningMoments()
+            moments.count, moments.mean, moments.m2 = int(row['COUNT']), float(row['MEAN']), float(row['M2'])
+            sketch = aggregator.sketches[name] = QuantileSketch(aggregator.relative_accuracy)
+            sketch.count, sketch.min, sketch.max = moments.count, float(row['MIN']), float(row['MAX'])
+        for row in hdulist['SKETCHES'].data:
+            sketch = aggregator.sketches[row['NAME'].strip()]
+            if row['SIGN'] == 0:
+                sketch.zeros += int(row['COUNT'])
+            else:
+                bins = sketch.positive if row['SIGN'] > 0 else sketch.negative
+                bins[int(row['BIN'])] = int(row['COUNT'])
+        # measure any further PSFs the same way as the originals
+        aggregator.ee_radii = sorted([float(n[3:]) for n in aggregator.metrics if n.startswith('ee_')])
+        aggregator.fwhm = 'fwhm' in aggregator.metrics
+        return aggregator
+
+
+def _table(columns, extname):
+    cols = fits.ColDefs(columns)
+    if hasattr(fits.BinTableHDU, 'from_columns'):
+        table = fits.BinTableHDU.from_columns(cols)
+    else:
+        table = fits.new_table(cols)
+    table.header.update('EXTNAME', extname)
+    return table
+
+
+def read_aggregate(filename):
+    """ Load a PSFAggregator saved with its `write` method """
+    hdulist = fits.open(filename)
+    try:
+        return PSFAggregator.from_hdulist(hdulist)
+    finally:
+        hdulist.close()
+
+
+def merge_aggregates(filenames, output=None):
+    """ Combine aggregators saved from several workers or shards into one, optionally writing it out """
+    total = None
+    for filename in filenames:
+        aggregator = read_aggregate(filename)
+        total = aggregator if total is None else total.merge(aggregator)
+    if total is None: raise ValueError("No files to merge.")
+    if output is not None: total.write(output)
+    return total
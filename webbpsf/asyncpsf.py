@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+"""
+asyncpsf.py
+
+    Run PSF calculations from an asyncio event loop without blocking it.
+
+    `calcPSF_async` and `calcImage_async` (also available as the
+    `JWInstrument.calcPSF_async` and `TargetScene.calcImage_async` methods)
+    snapshot the instrument as currently configured, run the calculation on a
+    pool of worker threads, and immediately return an asyncio Future for the
+    result, which can be awaited (or yielded from, in a trollius coroutine on
+    Python 2):
+
+        >>> psf = await nc.calcPSF_async(fov_arcsec=5, oversample=4)
+
+    The number of calculations running at once is limited by the size of the
+    thread pool; further requests wait in a queue. Concurrent requests for
+    identical calculations (same instrument configuration and arguments) are
+    coalesced into one computation whose result is given to every caller.
+    Cancelling the Future stops the calculation, via a
+    `webbpsf.propagation.CancelToken`, once every caller waiting on it has
+    cancelled.
+
+    Calculations running at once share the process: changes to global state
+    such as poppy.settings and thread caps are made under a lock (see
+    `webbpsf.tuning`), and each calculation gets an equal share of the memory
+    budget, so that together they stay within `settings.max_memory`.
+
+    This uses the standard library asyncio package if available, or else the
+    trollius backport.
+
+"""
+import copy
+import threading
+
+import astropy.io.fits as fits
+
+import logging
+_log = logging.getLogger('webbpsf')
+
+try:
+    import asyncio
+    _HAS_ASYNCIO = True
+except ImportError:
+    try:
+        import trollius as asyncio
+        _HAS_ASYNCIO = True
+    except ImportError:
+        _HAS_ASYNCIO = False
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+    _HAS_FUTURES = True
+except ImportError:
+    _HAS_FUTURES = False
+
+from . import settings
+from . import propagation
+
+
+# argument types whose repr identifies their value, for coalescing identical requests
+_PLAIN_TYPES = (bool, int, long, float, complex, basestring, type(None))
+
+
+def _freeze(value):
+    """ Hashable representation of a value, or None if it can't be compared by value """
+    if isinstance(value, _PLAIN_TYPES):
+        return (type(value).__name__, value)
+    if isinstance(value, (list, tuple)):
+        items = [_freeze(v) for v in value]
+        return None if any([i is None for i in items]) else ('seq',) + tuple(items)
+    if isinstance(value, dict):
+        items = [(k, _freeze(v)) for k, v in sorted(value.items())]
+        return None if any([i[1] is None for i in items]) else ('dict',) + tuple(items)
+    return None
+
+
+def config_key(instrument, kwargs, scene=None):
+    """ Key identifying a calculation, or None if it can't be identified by value
+
+    Two calculations with the same key would give identical results: the key covers the
+    instrument configuration, including detector and detector coordinates, the arguments,
+    and the settings that calcPSF uses as defaults. Calculations with arguments that aren't
+    plain values (such as a pysynphot spectrum object
+    or an HDUList for the OPD) get None, and are never coalesced.
+    """
+    detector = instrument.detector if instrument._detector is not None else None
+    state = [instrument.name, instrument.filter, instrument.image_mask, instrument.pupil_mask,
+             instrument.pupilopd, instrument.pupil, instrument.pixelscale, instrument.options,
+             detector, instrument.detector_coordinates, kwargs]
+    # defaults that calcPSF takes from the settings when not given
+    state.append([settings.precision(), settings.output_dtype(), settings.default_output_mode(),
+                  settings.default_oversampling(), settings.get_webbpsf_data_path()])
+    if scene is not None:
+        state.append([dict([(k, v) for k, v in source.items() if k != 'spectrum']) for source in scene.sources])
+        state.append([source['spectrum'] for source in scene.sources])
+    key = _freeze(state)
+    if key is None: return None
+    return ('scene' if scene is not None else 'psf',) + key
+
+
+def _copy_result(result):
+    return fits.HDUList([hdu.copy() for hdu in result])
+
+
+class _SharedCalculation(object):
+    """ One calculation running in the executor, and the callers waiting on it """
+    def __init__(self, key, token):
+        self.key = key
+        self.token = token
+        self.future = None      # concurrent.futures.Future in the executor
+        self.waiters = []       # (event loop, asyncio Future) for each caller
+
+
+class PSFExecutor(object):
+    """ Runs PSF calculations on a thread pool on behalf of asyncio event loops
+
+    Parameters
+    ----------
+    max_concurrent : int, optional
+        Maximum number of calculations to run at once. Default is `settings.n_processes`.
+    coalesce : bool
+        Share one computation between concurrent requests for identical calculations?
+    """
+    def __init__(self, max_concurrent=None, coalesce=True):
+        if not _HAS_ASYNCIO or not _HAS_FUTURES:
+            raise ImportError("Asynchronous PSF calculations require asyncio (or trollius on Python 2).")
+        if max_concurrent is None or max_concurrent < 1:
+            max_concurrent = max(settings.n_processes(), 1)
+        self.max_concurrent = max_concurrent
+        self.coalesce = coalesce
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrent)
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def calcPSF(self, instrument, loop=None, **kwargs):
+        """ Start instrument.calcPSF(**kwargs), returning an asyncio Future for the result """
+        return self._submit(instrument, None, kwargs, loop)
+
+    def calcImage(self, scene, instrument, loop=None, **kwargs):
+        """ Start scene.calcImage(instrument, **kwargs), returning an asyncio Future for the result """
+        return self._submit(instrument, scene, kwargs, loop)
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+    def _submit(self, instrument, scene, kwargs, loop):
+        if loop is None: loop = asyncio.get_event_loop()
+        waiter = loop.create_future() if hasattr(loop, 'create_future') else asyncio.Future(loop=loop)
+        key = config_key(instrument, kwargs, scene) if self.coalesce and 'outfile' not in kwargs else None
+
+        with self._lock:
+            shared = self._inflight.get(key) if key is not None else None
+            if shared is None:
+                shared = _SharedCalculation(key, propagation.CancelToken())
+                # snapshot the configuration now, so that the caller may go on to change it, and
+                # so concurrent calculations on one instrument don't share state
+                instrument = copy.deepcopy(instrument)
+                if scene is None:
+                    function, args = instrument.calcPSF, ()
+                else:
+                    function, args = copy.deepcopy(scene).calcImage, (instrument,)
+                run_kwargs = dict(kwargs, cancel_token=shared.token)
+                if key is not None: self._inflight[key] = shared
+                start = True
+            else:
+                _log.debug("Joining identical calculation already in progress")
+                start = False
+            shared.waiters.append((loop, waiter))
+
+        waiter.add_done_callback(lambda w: self._waiter_done(shared, w))
+        if start:
+            shared.future = self._executor.submit(self._run, function, args, run_kwargs)
+            shared.future.add_done_callback(lambda f: self._calculation_done(shared, f))
+        return waiter
+
+    def _run(self, function, args, kwargs):
+        # up to max_concurrent of these run at once, so each may use only that share of the memory
+        with propagation.budget_share(1.0 / self.max_concurrent):
+            return function(*args, **kwargs)
+
+    def _calculation_done(self, shared, future):
+        # called from the worker thread; hand the result to each waiter on its own loop
+        with self._lock:
+            if self._inflight.get(shared.key) is shared: del self._inflight[shared.key]
+            waiters = list(shared.waiters)
+        for i, (loop, waiter) in enumerate(waiters):
+            loop.call_soon_threadsafe(self._resolve, waiter, future, i > 0)
+
+    @staticmethod
+    def _resolve(waiter, future, copy_result):
+        if waiter.done(): return
+        if future.cancelled():
+            waiter.cancel()
+        elif future.exception() is not None:
+            waiter.set_exception(future.exception())
+        else:
+            # each caller gets its own HDUList, so one modifying it can't affect the others
+            waiter.set_result(_copy_result(future.result()) if copy_result else future.result())
+
+    def _waiter_done(self, shared, waiter):
+        if not waiter.cancelled(): return
+        with self._lock:
+            if any([not w.cancelled() for l, w in shared.waiters]): return
+            # nobody wants this result any more; make sure no new request joins it
+            if self._inflight.get(shared.key) is shared: del self._inflight[shared.key]
+        _log.info("Cancelling PSF calculation")
+        if shared.future is None or not shared.future.cancel():
+            shared.token.cancel()
+
+
+_default_executor = None
+_default_lock = threading.Lock()
+
+
+def get_executor():
+    """ The PSFExecutor shared by calcPSF_async and calcImage_async, created on first use """
+    global _default_executor
+    with _default_lock:
+        if _default_executor is None:
+            _default_executor = PSFExecutor()
+        return _default_executor
+
+
+def calcPSF_async(instrument, loop=None, **kwargs):
+    """ Compute instrument.calcPSF(**kwargs) on a worker thread, returning an asyncio Future
+
+    The instrument is copied as currently configured, so it may be changed straight away
+    without affecting the calculation. Arguments are as for calcPSF, except that callbacks
+    are called from the worker thread, and the instrument's `last_profile` is not updated.
+    """
+    return get_executor().calcPSF(instrument, loop=loop, **kwargs)
+
+
+def calcImage_async(scene, instrument, loop=None, **kwargs):
+    """ Compute scene.calcImage(instrument, **kwargs) on a worker thread, returning an asyncio Future """
+    return get_executor().calcImage(scene, instrument, loop=loop, **kwargs)
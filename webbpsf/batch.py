@@ -0,0 +1,527 @@
+#!/usr/bin/env python
+"""
+batch.py
+
+    Run large sets of PSF calculations from a job file, resumably.
+
+    A job file is JSON (or YAML, if PyYAML is installed) containing either a list
+    of jobs, or a dict with a list of "jobs" and optionally "defaults" that apply
+    to every job:
+
+        {"defaults": {"nlambda": 5, "fov_arcsec": 5, "oversample": 4},
+         "jobs": [
+            {"instrument": "NIRCam", "sweep": {"filter": ["F200W", "F444W"], "oversample": [2, 4]}},
+            {"instrument": "MIRI", "filter": "F1065C", "image_mask": "FQPM1065", "pupil_mask": "MASKFQPM",
+             "pupilopd": ["OPD_RevV_miri_421.fits", 3], "outfile": "miri_fqpm_{pupilopd[1]}.fits"},
+            {"type": "obssim", "instrument": "NIRCam", "filter": "F335M",
+             "sources": [{"sptype": "G2V", "name": "star"},
+                         {"sptype": "M5V", "name": "companion", "separation": 1.0, "PA": 45, "normalization": 1e-4}]}
+         ]}
+
+    Each job gives the instrument name; any of filter, image_mask, pupil_mask,
+    pupilopd, pupil, and options (a dict of instrument options); a source spectral
+    type; and any other calcPSF (or for obssim jobs, calcImage) arguments. A
+    "sweep" dict expands a job into the Cartesian product of the values listed
+    for each of its keys. Output filenames may use {key} fields from the job, and
+    default to <job id>.fits, where the id is a hash of the calculation parameters.
+    Identical calculations are computed only once.
+
+    Each output file is written under a temporary name and renamed into place when
+    complete, and each completed job is recorded in a checkpoint manifest
+    (batch_manifest.jsonl in the output directory). Running the same job file again
+    skips every job already in the manifest whose output exists, so an interrupted
+    run resumes where it left off.
+
+        webbpsf batch jobs.json --outdir psflib --processes 8
+
+    Job sets too large for one machine can be split across several sharing a
+    filesystem, with no coordinator: run the same command on each of N machines
+    with --shard 1/N, --shard 2/N, and so on. Every machine computes the same
+    deterministic assignment of jobs to shards, balanced using an estimate of
+    each job's cost, and keeps its own manifest. Afterwards, `webbpsf merge`
+    checks that every job is complete and consistent and assembles the outputs
+    into one PSF library file.
+
+"""
+import os
+import glob
+import copy
+import json
+import time
+import shutil
+import hashlib
+import itertools
+import multiprocessing
+import numpy as np
+import astropy.io.fits as fits
+
+import logging
+_log = logging.getLogger('webbpsf')
+
+try:
+    import yaml
+    _HAS_YAML = True
+except ImportError:
+    _HAS_YAML = False
+
+from . import settings
+
+
+MANIFEST_NAME = 'batch_manifest.jsonl'
+
+# job keys describing the instrument configuration rather than calcPSF arguments
+_INSTRUMENT_KEYS = ['filter', 'image_mask', 'pupil_mask', 'pupilopd', 'pupil']
+# job keys that are not passed on to calcPSF or calcImage
+_JOB_KEYS = ['type', 'instrument', 'options', 'source', 'sources', 'outfile'] + _INSTRUMENT_KEYS
+
+
+def load_jobs(filename):
+    """ Read a job file, returning the list of jobs with defaults applied, before sweeps are expanded """
+    with open(filename) as f:
+        text = f.read()
+    if filename.lower().endswith(('.yaml', '.yml')):
+        if not _HAS_YAML: raise ImportError("Reading YAML job files requires PyYAML.")
+        spec = yaml.safe_load(text)
+    else:
+        spec = json.loads(text)
+
+    if isinstance(spec, list):
+        defaults, jobs = {}, spec
+    else:
+        defaults, jobs = spec.get('defaults', {}), spec['jobs']
+    result = []
+    for job in jobs:
+        full = copy.deepcopy(defaults)
+        full.update(job)
+        result.append(full)
+    return result
+
+
+def _canonical(value):
+    return json.dumps(value, sort_keys=True, separators=(',', ':'))
+
+
+def job_id(job):
+    """ Short hash identifying the calculation a job performs, ignoring its output filename """
+    params = dict([(k, v) for k, v in job.items() if k not in ('outfile', 'id')])
+    return hashlib.sha1(_canonical(params).encode('utf-8')).hexdigest()[:16]
+
+
+def expand_jobs(jobs, outdir='.'):
+    """ Expand sweeps, assign ids and output filenames, and merge identical calculations
+
+    Returns a list of job dicts, each with 'id' and 'outfile' keys, and an 'aliases' list of
+    any further output filenames requested for the same calculation. Raises ValueError if
+    different calculations would write the same output file.
+    """
+    expanded = []
+    for job in jobs:
+        job = dict(job)
+        job.setdefault('type', 'calcPSF')
+        sweep = job.pop('sweep', {})
+        keys = sorted(sweep.keys())
+        for values in itertools.product(*[sweep[k] for k in keys]):
+            single = dict(job)
+            single.update(zip(keys, values))
+            expanded.append(single)
+
+    unique = []
+    by_id = {}
+    for job in expanded:
+        jid = job_id(job)
+        template = job.get('outfile', None) or (jid + '.fits')
+        outfile = os.path.join(outdir, template.format(id=jid, **job))
+        if jid in by_id:
+            if outfile != by_id[jid]['outfile'] and outfile not in by_id[jid]['aliases']:
+                by_id[jid]['aliases'].append(outfile)
+            continue
+        job.update(id=jid, outfile=outfile, aliases=[])
+        by_id[jid] = job
+        unique.append(job)
+
+    # different calculations must never write to the same file, or all but one result is lost
+    owners = {}
+    for job in unique:
+        for outfile in [job['outfile']] + job['aliases']:
+            path = os.path.normpath(os.path.abspath(outfile))
+            if owners.get(path, job['id']) != job['id']:
+                raise ValueError("Jobs %s and %s would both write %s. Include the swept parameters in the outfile "
+                        "template, e.g. 'psf_{filter}.fits'." % (owners[path], job['id'], outfile))
+            owners[path] = job['id']
+    if len(unique) < len(expanded):
+        _log.info("%d identical jobs merged, leaving %d unique calculations" % (len(expanded)-len(unique), len(unique)))
+    return unique
+
+
+def _instrument(job):
+    from . import webbpsf_core
+    inst = webbpsf_core.Instrument(job['instrument'])
+    for key in _INSTRUMENT_KEYS:
+        if key in job:
+            value = job[key]
+            setattr(inst, key, tuple(value) if isinstance(value, list) else value)
+    inst.options.update(job.get('options', {}))
+    return inst
+
+
+def _calc_kwargs(job):
+    kwargs = dict([(k, v) for k, v in job.items() if k not in _JOB_KEYS + ['id', 'aliases']])
+    for key in ('fov_arcsec', 'fov_pixels'):
+        if isinstance(kwargs.get(key), list): kwargs[key] = tuple(kwargs[key])
+    return kwargs
+
+
+def _temporary_name(outfile):
+    # keep the extension, so that e.g. .fits.gz files are still compressed
+    dirname, basename = os.path.split(outfile)
+    return os.path.join(dirname, '.part%d.%s' % (os.getpid(), basename))
+
+
+#---- cost estimates and sharding
+
+# detector pixel scales in arcsec, for estimating output array sizes
+_PIXELSCALES = {'nircam': 0.0317, 'nircam_long': 0.0648, 'nirspec': 0.1, 'niriss': 0.065, 'miri': 0.11, 'fgs': 0.069}
+_PUPIL_NPIX = 1024
+
+
+def _uses_fft(job):
+    """ Does this configuration propagate through an intermediate image plane with FFTs? """
+    image_mask = job.get('image_mask', None)
+    if image_mask is None or image_mask == 'MSA all open': return image_mask is not None
+    # the NIRCam round occulters and the slits use semi-analytic methods with small matrix
+    # Fourier transforms instead, unless no_sam is set
+    if job['instrument'].lower() == 'nirspec' or image_mask == 'LRS slit' or (image_mask.startswith('MASK') and image_mask.endswith('R')):
+        return job.get('options', {}).get('no_sam', False)
+    return True
+
+
+def _pixelscale(job):
+    instrument = job['instrument'].lower()
+    if instrument == 'nircam' and job.get('filter', None) is not None:
+        # long wavelength channel filters are F250M and redder
+        digits = ''.join([c for c in job['filter'] if c.isdigit()])
+        if digits != '' and int(digits) >= 250: return _PIXELSCALES['nircam_long']
+    return _PIXELSCALES.get(instrument, 0.065)
+
+
+def estimate_cost(job):
+    """ Rough relative cost of a job, in units of about a million floating point operations
+
+    This counts the main Fourier transforms for each wavelength: a matrix Fourier transform
+    from the 1024 pixel pupil to the output field of view for direct imaging (and the
+    semi-analytic methods, which are dominated by it), plus two FFTs of the pupil array
+    padded by twice the oversampling for coronagraphs and other configurations needing them.
+    It's only meant for balancing work between shards.
+    """
+    instrument = job['instrument'].lower()
+    oversample = job.get('oversample', None) or job.get('fft_oversample', None) or settings.default_oversampling()
+    nlambda = 1 if job.get('monochromatic') is not None else (job.get('nlambda', None) or 5)
+    pixelscale = _pixelscale(job)
+    if job.get('fov_pixels', None) is not None:
+        npix = np.max(job['fov_pixels'])
+    else:
+        npix = np.max(job.get('fov_arcsec', None) or (12. if instrument == 'miri' else settings.default_fov_arcsec())) / pixelscale
+    nout = npix * oversample
+    cost = 2. * _PUPIL_NPIX**2 * nout + 2. * _PUPIL_NPIX * nout**2
+    if _uses_fft(job):
+        nfft = _PUPIL_NPIX * 2 * oversample
+        cost += 2 * 5. * nfft**2 * np.log2(nfft)
+    nsources = max(len(job.get('sources', [])), 1) if job.get('type', 'calcPSF') == 'obssim' else 1
+    return cost * nlambda * nsources / 1e6
+
+
+def parse_shard(shard):
+    """ Parse a shard specification 'i/N', with i from 1 to N, into (i, N) """
+    try:
+        index, nshards = [int(v) for v in shard.split('/')]
+    except ValueError:
+        raise ValueError("Shard must be given as i/N, e.g. 2/8")
+    if nshards < 1 or index < 1 or index > nshards:
+        raise ValueError("Shard %s is out of range; use i/N with 1 <= i <= N" % shard)
+    return index, nshards
+
+
+def assign_shards(jobs, nshards):
+    """ Deterministically assign jobs to shards, balancing the estimated costs
+
+    Uses the longest processing time first heuristic: jobs are taken in order of decreasing
+    cost (ties broken by id) and each is given to the shard with the least work so far
+    (ties broken by shard number). The result depends only on the set of jobs, not
+    their order, so every machine computes the same assignment.
+
+    Returns a dict of job id: shard number, from 1 to nshards.
+    """
+    loads = [0.0] * nshards
+    assignment = {}
+    for job in sorted(jobs, key=lambda job: (-estimate_cost(job), job['id'])):
+        shard = min(range(nshards), key=lambda i: (loads[i], i))
+        loads[shard] += estimate_cost(job)
+        assignment[job['id']] = shard + 1
+    return assignment
+
+
+def shard_jobs(jobs, shard):
+    """ The subset of jobs belonging to one shard, given as (i, N) or 'i/N' """
+    if isinstance(shard, basestring): shard = parse_shard(shard)
+    index, nshards = shard
+    assignment = assign_shards(jobs, nshards)
+    return [job for job in jobs if assignment[job['id']] == index]
+
+
+def manifest_name(outdir, shard=None):
+    """ Manifest filename for a run, or one shard of it """
+    if shard is None: return os.path.join(outdir, MANIFEST_NAME)
+    return os.path.join(outdir, MANIFEST_NAME.replace('.jsonl', '.shard%dof%d.jsonl' % tuple(shard)))
+
+
+def _makedirs(dirname):
+    if dirname != '' and not os.path.isdir(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            pass # another worker created it first
+
+
+def run_job(job):
+    """ Compute one job, writing its output atomically. Returns a manifest record. """
+    import poppy
+    t0 = time.time()
+    outfile = job['outfile']
+    tmpfile = _temporary_name(outfile)
+    try:
+        for filename in [outfile] + job.get('aliases', []): _makedirs(os.path.dirname(filename))
+        inst = _instrument(job)
+        kwargs = _calc_kwargs(job)
+        if job['type'] == 'obssim':
+            from . import obssim
+            scene = obssim.TargetScene()
+            for source in job.get('sources', []):
+                source = dict(source)
+                scene.addPointSource(source.pop('sptype'), **source)
+            scene.calcImage(inst, outfile=tmpfile, clobber=True, **kwargs)
+        elif job['type'] == 'calcPSF':
+            if job.get('source') is not None:
+                kwargs['source'] = poppy.specFromSpectralType(job['source'])
+            inst.calcPSF(outfile=tmpfile, clobber=True, **kwargs)
+        else:
+            raise ValueError("Unknown job type %s" % job['type'])
+        os.rename(tmpfile, outfile)
+        for alias in job.get('aliases', []):
+            shutil.copyfile(outfile, _temporary_name(alias))
+            os.rename(_temporary_name(alias), alias)
+        status, error = 'done', None
+    except Exception as e:
+        _log.exception("Job %s failed" % job['id'])
+        if os.path.exists(tmpfile): os.remove(tmpfile)
+        status, error = 'failed', "%s: %s" % (e.__class__.__name__, e)
+    return {'id': job['id'], 'outfile': outfile, 'status': status, 'error': error,
+            'elapsed': time.time() - t0, 'finished': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def read_manifest(filename):
+    """ Read a checkpoint manifest, returning a dict of the latest record for each job id """
+    records = {}
+    if not os.path.exists(filename): return records
+    with open(filename) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue # a line cut short by an interruption
+            records[record['id']] = record
+    return records
+
+
+def completed_jobs(jobs, manifest):
+    """ Ids of the jobs that the manifest records as done, and whose output files exist """
+    records = read_manifest(manifest)
+    return set([job['id'] for job in jobs if records.get(job['id'], {}).get('status') == 'done'
+                and os.path.exists(job['outfile']) and all([os.path.exists(a) for a in job.get('aliases', [])])])
+
+
+def _init_worker():
+    # each job runs in its own worker process, so calculations must not start further processes
+    settings.autotune.set(False)
+    settings.use_multiprocessing.set(False)
+    settings.use_threads.set(False)
+
+
+def run_batch(jobs, outdir='.', nprocesses=None, manifest=None, resume=True, progress=None, shard=None):
+    """ Run a list of jobs, as returned by expand_jobs, on a pool of processes
+
+    Parameters
+    ----------
+    jobs : list of dicts
+        Jobs to run
+    outdir : string
+        Output directory, which holds the manifest by default
+    nprocesses : int, optional
+        Number of worker processes, or 1 to run in this process. Default is `settings.n_processes`.
+    manifest : string, optional
+        Checkpoint manifest filename. Default is batch_manifest.jsonl in outdir.
+    resume : bool
+        Skip jobs the manifest records as complete?
+    progress : callable, optional
+        Called with (number completed, number to run, record) after each job.
+    shard : tuple or string, optional
+        Run only shard i of N, given as (i, N) or 'i/N'. Each shard keeps its own manifest.
+
+    Returns
+    -------
+    records : list of dicts
+        Manifest records for the jobs run this time
+    """
+    if isinstance(shard, basestring): shard = parse_shard(shard)
+    if shard is not None:
+        njobs = len(jobs)
+        jobs = shard_jobs(jobs, shard)
+        _log.info("Shard %d/%d: %d of %d jobs" % (shard[0], shard[1], len(jobs), njobs))
+    if manifest is None: manifest = manifest_name(outdir, shard)
+    if nprocesses is None or nprocesses < 1: nprocesses = max(settings.n_processes(), 1)
+    if not os.path.isdir(outdir): os.makedirs(outdir)
+
+    if resume:
+        done = completed_jobs(jobs, manifest)
+        if len(done) > 0: _log.info("Resuming: %d of %d jobs already complete" % (len(done), len(jobs)))
+        jobs = [job for job in jobs if job['id'] not in done]
+
+    # start the most expensive jobs first, so the pool isn't left waiting on one long job at the end
+    jobs = sorted(jobs, key=lambda job: (-estimate_cost(job), job['id']))
+    records = []
+    t0 = time.time()
+    with open(manifest, 'a') as manifest_file:
+        if nprocesses == 1:
+            results = itertools.imap(run_job, jobs)
+            pool = None
+        else:
+            pool = multiprocessing.Pool(nprocesses, initializer=_init_worker)
+            results = pool.imap_unordered(run_job, jobs)
+        try:
+            for record in results:
+                if shard is not None: record['shard'] = '%d/%d' % tuple(shard)
+                # one line per job, flushed immediately, so an interrupted run loses at most the jobs in progress
+                manifest_file.write(json.dumps(record) + "\n")
+                manifest_file.flush()
+                os.fsync(manifest_file.fileno())
+                records.append(record)
+                if progress is not None:
+                    progress(len(records), len(jobs), record)
+                else:
+                    elapsed = time.time() - t0
+                    remaining = elapsed / len(records) * (len(jobs) - len(records))
+                    _log.info("[%d/%d] %s %s in %.1f s (about %.0f s remaining)" % (len(records), len(jobs),
+                        record['outfile'], record['status'], record['elapsed'], remaining))
+        except BaseException:
+            if pool is not None: pool.terminate()
+            raise
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+    nfailed = len([r for r in records if r['status'] != 'done'])
+    if nfailed > 0: _log.warn("%d of %d jobs failed; see %s" % (nfailed, len(records), manifest))
+    return records
+
+
+#---- merging shards into a PSF library
+
+def _all_records(outdir):
+    """ The manifest records for every shard in outdir, preferring a 'done' record for each job """
+    records = {}
+    for filename in sorted(glob.glob(os.path.join(outdir, MANIFEST_NAME.replace('.jsonl', '*.jsonl')))):
+        for jid, record in read_manifest(filename).items():
+            if record.get('status') == 'done' or jid not in records: records[jid] = record
+    return records
+
+
+def check_shards(jobs, outdir):
+    """ Check that every job in a sharded run is complete and consistent
+
+    Raises ValueError describing any problems: jobs not completed or with missing outputs,
+    shards run with different numbers of shards, or jobs run by a shard other than the
+    one they're assigned to (meaning the job file changed between shard runs).
+    Returns the number of shards.
+    """
+    records = _all_records(outdir)
+    problems = []
+    missing = [job['id'] for job in jobs if records.get(job['id'], {}).get('status') != 'done'
+               or not os.path.exists(job['outfile'])]
+    if len(missing) > 0:
+        problems.append("%d of %d jobs are not complete (e.g. %s)" % (len(missing), len(jobs), ", ".join(missing[:5])))
+    counts = set([int(r['shard'].split('/')[1]) for r in records.values() if r.get('shard')])
+    if len(counts) > 1:
+        problems.append("shards were run with different numbers of shards: %s" % ", ".join([str(c) for c in sorted(counts)]))
+    nshards = counts.pop() if len(counts) == 1 else 1
+    if len(problems) == 0 and nshards > 1:
+        assignment = assign_shards(jobs, nshards)
+        moved = [job['id'] for job in jobs if records[job['id']].get('shard') not in (None, '%d/%d' % (assignment[job['id']], nshards))]
+        if len(moved) > 0:
+            problems.append("%d jobs were computed by a different shard than assigned; was the job file changed between runs?" % len(moved))
+    ids = set([job['id'] for job in jobs])
+    stale = [jid for jid in records if jid not in ids]
+    if len(stale) > 0:
+        _log.warn("%d manifest records are for jobs not in this job file; ignoring them" % len(stale))
+    if len(problems) > 0:
+        raise ValueError("Cannot merge: " + "; ".join(problems))
+    return nshards
+
+
+def _index_table(jobs):
+    def column(name, values):
+        values = ['' if v is None else str(v) for v in values]
+        return fits.Column(name=name, format='%dA' % max([len(v) for v in values] + [1]), array=np.asarray(values))
+    params = [_canonical(dict([(k, v) for k, v in job.items() if k not in ('id', 'outfile', 'aliases')])) for job in jobs]
+    cols = fits.ColDefs([column('ID', [job['id'] for job in jobs]),
+                         column('INSTRUME', [job['instrument'] for job in jobs]),
+                         column('FILTER', [job.get('filter') for job in jobs]),
+                         column('CORONMSK', [job.get('image_mask') for job in jobs]),
+                         column('PUPIL', [job.get('pupil_mask') for job in jobs]),
+                         column('OUTFILE', [os.path.basename(job['outfile']) for job in jobs]),
+                         column('PARAMS', params)])
+    if hasattr(fits.BinTableHDU, 'from_columns'):
+        table = fits.BinTableHDU.from_columns(cols)
+    else:
+        table = fits.new_table(cols)
+    table.header.update('EXTNAME', 'INDEX')
+    return table
+
+
+def merge_shards(jobs, outdir, output):
+    """ Check a (possibly sharded) batch run is complete, and assemble its outputs into one PSF library
+
+    The library is a FITS file with an INDEX table extension listing each job's id, configuration,
+    and full parameters as JSON, followed by the PSF image extensions for each job, named by job id
+    (plus <id>_DET for the detector-sampled PSF, if present).
+    Jobs are written in order of id, so the library is the same however the jobs were sharded.
+    """
+    nshards = check_shards(jobs, outdir)
+    jobs = sorted(jobs, key=lambda job: job['id'])
+    tmpfile = _temporary_name(output)
+    primary = fits.PrimaryHDU()
+    primary.header.update('NJOBS', len(jobs), 'Number of PSFs in this library')
+    primary.header.update('NSHARDS', nshards, 'Number of shards the calculations were split into')
+    fits.HDUList([primary, _index_table(jobs)]).writeto(tmpfile, clobber=True)
+    shapes = {}
+    try:
+        for job in jobs:
+            psf = fits.open(job['outfile'])
+            images = [hdu for hdu in psf if isinstance(hdu, (fits.PrimaryHDU, fits.ImageHDU, fits.CompImageHDU)) and hdu.data is not None]
+            if len(images) == 0: raise ValueError("No image data in %s" % job['outfile'])
+            if job.get('filter') is not None and images[0].header.get('FILTER', job['filter']) != job['filter']:
+                raise ValueError("%s has FILTER=%s but job %s is for %s" % (job['outfile'], images[0].header['FILTER'], job['id'], job['filter']))
+            # jobs with the same sampling parameters must give the same array sizes
+            sampling = _canonical([job['instrument'], job.get('fov_arcsec'), job.get('fov_pixels'), job.get('oversample'), _pixelscale(job)])
+            if shapes.setdefault(sampling, images[0].data.shape) != images[0].data.shape:
+                raise ValueError("%s has shape %s, unlike other PSFs with the same sampling" % (job['outfile'], images[0].data.shape))
+            for i, hdu in enumerate(images):
+                header = fits.ImageHDU(data=hdu.data, header=hdu.header).header
+                extname = hdu.header.get('EXTNAME', '')
+                header.update('EXTNAME', job['id'] + ('_DET' if extname == 'DET_SAMP' else '' if i == 0 else '_%d' % i))
+                fits.append(tmpfile, hdu.data, header)
+            psf.close()
+        os.rename(tmpfile, output)
+    except BaseException:
+        if os.path.exists(tmpfile): os.remove(tmpfile)
+        raise
+    _log.info("Merged %d PSFs from %d shard(s) into %s" % (len(jobs), nshards, output))
+    return output
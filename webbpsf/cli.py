@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+"""
+cli.py
+
+    The `webbpsf` command line tool.
+
+        webbpsf batch JOBFILE       Run the PSF calculations in a job file (see webbpsf.batch)
+        webbpsf merge JOBFILE       Check a sharded batch run and merge it into one PSF library
+        webbpsf serve [options]     Run a local PSF server (see webbpsf.server)
+        webbpsf gui                 Start the graphical interface
+
+    Run `webbpsf <command> --help` for the options of each command.
+"""
+import os
+import sys
+import optparse
+
+import logging
+_log = logging.getLogger('webbpsf')
+
+
+def _serve(argv):
+    parser = optparse.OptionParser(usage="webbpsf serve [--socket PATH | --port N] [options]",
+            description="Run a long-lived local PSF server, keeping instruments, data, weights and optical systems warm between requests.")
+    parser.add_option('--socket', dest='socket_path', default=None, help='Listen on this Unix domain socket')
+    parser.add_option('--port', type='int', default=None, help='Listen on this TCP port on localhost')
+    parser.add_option('--host', default='127.0.0.1', help='Address to listen on for TCP (default localhost only)')
+    parser.add_option('--workers', type='int', default=None, help='Number of worker threads (default: settings.n_processes)')
+    parser.add_option('--cache-size', type='int', default=8, help='Optical systems to cache per worker')
+    parser.add_option('--preload', default='', help='Comma-separated instrument names to load at startup')
+    options, args = parser.parse_args(argv)
+    if options.socket_path is None and options.port is None:
+        parser.error("Give either --socket or --port")
+
+    from . import server
+    preload = [name.strip() for name in options.preload.split(',') if name.strip() != '']
+    server.serve(socket_path=options.socket_path, port=options.port, host=options.host,
+            nworkers=options.workers, cache_size=options.cache_size, preload=preload)
+    return 0
+
+
+def _batch(argv):
+    parser = optparse.OptionParser(usage="webbpsf batch JOBFILE [options]",
+            description="Run the calcPSF and obssim jobs in a JSON or YAML job file, resuming an interrupted run.")
+    parser.add_option('-o', '--outdir', default='.', help='Output directory (default: current directory)')
+    parser.add_option('-p', '--processes', type='int', default=None, help='Number of worker processes (default: settings.n_processes)')
+    parser.add_option('--manifest', default=None, help='Checkpoint manifest file (default: OUTDIR/batch_manifest.jsonl)')
+    parser.add_option('--restart', action='store_true', help='Ignore the manifest and recompute every job')
+    parser.add_option('--shard', default=None, help='Run only shard i of N, given as i/N (1 <= i <= N), on this machine')
+    parser.add_option('-n', '--dry-run', action='store_true', help='List the jobs that would be run, and stop')
+    options, args = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error("Give one job file")
+
+    from . import batch
+    jobs = batch.expand_jobs(batch.load_jobs(args[0]), outdir=options.outdir)
+    shard = batch.parse_shard(options.shard) if options.shard is not None else None
+    if options.dry_run:
+        if shard is not None: jobs = batch.shard_jobs(jobs, shard)
+        manifest = options.manifest or batch.manifest_name(options.outdir, shard)
+        done = batch.completed_jobs(jobs, manifest) if not options.restart else set()
+        for job in jobs:
+            print "%s %-8s %10.0f  %s" % (job['id'], 'done' if job['id'] in done else 'todo', batch.estimate_cost(job), job['outfile'])
+        print "%d jobs, %d already complete, estimated cost %.0f" % (len(jobs), len(done), sum([batch.estimate_cost(job) for job in jobs]))
+        return 0
+    records = batch.run_batch(jobs, outdir=options.outdir, nprocesses=options.processes,
+            manifest=options.manifest, resume=not options.restart, shard=shard)
+    return 1 if any([r['status'] != 'done' for r in records]) else 0
+
+
+def _merge(argv):
+    parser = optparse.OptionParser(usage="webbpsf merge JOBFILE --outdir DIR --output LIBRARY",
+            description="Check that every job of a (sharded) batch run is complete and consistent, and assemble the outputs into one PSF library file.")
+    parser.add_option('-o', '--outdir', default='.', help='Output directory of the batch run')
+    parser.add_option('--output', default=None, help='PSF library filename (default: OUTDIR/psf_library.fits)')
+    options, args = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error("Give one job file")
+
+    from . import batch
+    jobs = batch.expand_jobs(batch.load_jobs(args[0]), outdir=options.outdir)
+    try:
+        batch.merge_shards(jobs, options.outdir, options.output or os.path.join(options.outdir, 'psf_library.fits'))
+    except ValueError as e:
+        _log.error(str(e))
+        return 1
+    return 0
+
+
+def _gui(argv):
+    import webbpsf
+    webbpsf.gui()
+    return 0
+
+
+COMMANDS = {'batch': _batch, 'merge': _merge, 'serve': _serve, 'gui': _gui}
+
+
+def main(argv=None):
+    if argv is None: argv = sys.argv[1:]
+    if len(argv) == 0 or argv[0] not in COMMANDS:
+        print __doc__
+        return 0 if len(argv) > 0 and argv[0] in ('-h', '--help') else 1
+    logging.basicConfig(level=logging.INFO, format='%(name)-10s: %(levelname)-8s %(message)s')
+    return COMMANDS[argv[0]](argv[1:])
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+"""
+jitter.py
+
+    Pointing jitter, as a transfer function applied to the oversampled PSF.
+
+    Jitter blurs the PSF by the distribution of line of sight offsets during an
+    exposure. That is a convolution of the broadband intensity, so rather than
+    averaging PSFs computed at many offsets, it is applied once to the summed PSF
+    as a multiplication in the Fourier domain: one FFT of the PSF, and one inverse
+    FFT per jitter model.
+
+    Three models are available:
+
+        - 'gaussian': a circular Gaussian with rms `sigma` per axis, in arcsec
+        - the same with `sigma` = (major, minor) for an elliptical Gaussian, with
+          its major axis at `angle` degrees counterclockwise from +X
+        - 'timeseries': the empirical distribution of a series of (x, y) offsets,
+          e.g. from a pointing simulation, whose transfer function is the mean of
+          exp(-2 pi i (u x + v y)) over the samples
+
+    `jitter_psf` takes a list of sigmas to return a batch of jittered PSFs from one
+    forward transform, for studies over jitter amplitude:
+
+        >>> cube = jitter.jitter_psf(psf[0].data, psf[0].header['PIXELSCL'], sigma=[0.003, 0.007, 0.015])
+
+    In calcPSF, jitter is selected with options['jitter'] = 'gaussian' and
+    options['jitter_sigma'] (and optionally options['jitter_angle']), or with
+    options['jitter'] = 'timeseries' and options['jitter_timeseries'] = (x, y).
+
+"""
+import numpy as np
+
+import logging
+_log = logging.getLogger('webbpsf')
+
+
+_GAUSSIAN_NAMES = ['gaussian', 'gauss', 'Gaussian blur', 'Accurate yet SLOW grid']
+_NO_JITTER_NAMES = ['none', 'None', 'Just use OPDs']
+
+
+def _frequencies(shape, pixelscale):
+    """ Spatial frequencies in cycles per arcsec along Y and X, for the real FFT of an array of this shape """
+    ny, nx = shape
+    v = np.fft.fftfreq(ny, d=pixelscale)
+    u = np.arange(nx//2 + 1) / (nx * float(pixelscale))
+    return v, u
+
+
+def gaussian_transfer(shape, pixelscale, sigma, angle=0.0):
+    """ Transfer function of Gaussian jitter, on the real FFT grid of an image
+
+    Parameters
+    ----------
+    shape : tuple
+        (ny, nx) shape of the image
+    pixelscale : float
+        Image pixel scale in arcsec
+    sigma : float or 2-tuple
+        RMS jitter per axis in arcsec, or (major, minor) for elliptical jitter
+    angle : float
+        Angle of the major axis in degrees counterclockwise from +X, for elliptical jitter
+    """
+    v, u = _frequencies(shape, pixelscale)
+    u, v = u[np.newaxis, :], v[:, np.newaxis]
+    if np.isscalar(sigma):
+        return np.exp(-2 * np.pi**2 * sigma**2 * (u**2 + v**2))
+    major, minor = sigma
+    c, s = np.cos(np.radians(angle)), np.sin(np.radians(angle))
+    return np.exp(-2 * np.pi**2 * (major**2 * (u*c + v*s)**2 + minor**2 * (-u*s + v*c)**2))
+
+
+def timeseries_transfer(shape, pixelscale, x, y):
+    """ Transfer function of jitter given as a series of line of sight offsets, on the real FFT grid of an image
+
+    The phase factors are separable in X and Y, so the mean over samples is one matrix product.
+
+    Parameters
+    ----------
+    shape : tuple
+        (ny, nx) shape of the image
+    pixelscale : float
+        Image pixel scale in arcsec
+    x, y : arrays
+        Offsets in arcsec, sampled uniformly in time
+    """
+    v, u = _frequencies(shape, pixelscale)
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    phase_y = np.exp(-2j * np.pi * np.outer(v, y))
+    phase_x = np.exp(-2j * np.pi * np.outer(x, u))
+    return np.dot(phase_y, phase_x) / len(x)
+
+
+def jitter_psf(image, pixelscale, model='gaussian', sigma=0.007, angle=0.0, timeseries=None):
+    """ Convolve a PSF, or a cube of them, with pointing jitter
+
+    Parameters
+    ----------
+    image : ndarray
+        PSF, or cube of PSFs with shape (n, ny, nx)
+    pixelscale : float
+        Image pixel scale in arcsec
+    model : string
+        'gaussian' or 'timeseries'
+    sigma : float, 2-tuple, or list of those
+        For Gaussian jitter, the rms per axis in arcsec, or (major, minor) for elliptical jitter.
+        A list gives a batch of jittered PSFs for the one image.
+    angle : float
+        Angle of the major axis in degrees counterclockwise from +X, for elliptical jitter
+    timeseries : 2-tuple of arrays
+        For timeseries jitter, the (x, y) line of sight offsets in arcsec
+
+    Returns
+    -------
+    jittered : ndarray
+        The same shape as image, or with an extra leading axis for a list of sigmas.
+        Light jittered beyond the edges of the image is lost, as it would be from a detector.
+    """
+    image = np.asarray(image, dtype=np.float64)
+    cube = image if image.ndim == 3 else image[np.newaxis]
+    ny, nx = cube.shape[1:]
+
+    if model in _GAUSSIAN_NAMES:
+        batch = isinstance(sigma, list)
+        sigmas = sigma if batch else [sigma]
+        extent = 4 * max([np.max(s) for s in sigmas])
+    elif model == 'timeseries':
+        if timeseries is None:
+            raise ValueError("Timeseries jitter requires the (x, y) offsets")
+        batch = False
+        extent = max(np.abs(timeseries[0]).max(), np.abs(timeseries[1]).max())
+    else:
+        raise ValueError("Unknown jitter model '%s'. Use 'gaussian' or 'timeseries'." % model)
+
+    # zero padding, so jitter does not wrap light around the edges
+    pad = int(np.ceil(extent / pixelscale)) + 1
+    shape = (ny + 2*pad, nx + 2*pad)
+    padded = np.zeros((cube.shape[0],) + shape)
+    padded[:, pad:pad+ny, pad:pad+nx] = cube
+    transform = np.fft.rfft2(padded)
+
+    if model == 'timeseries':
+        transfers = [timeseries_transfer(shape, pixelscale, timeseries[0], timeseries[1])]
+    else:
+        transfers = [gaussian_transfer(shape, pixelscale, s, angle=angle) for s in sigmas]
+    result = np.asarray([np.fft.irfft2(transform * t, s=shape)[:, pad:pad+ny, pad:pad+nx] for t in transfers])
+
+    if image.ndim == 2: result = result[:, 0]
+    return result if batch else result[0]
+
+
+def options_model(options):
+    """ Keyword arguments for `jitter_psf` from a JWInstrument options dictionary, or None for no jitter """
+    model = options.get('jitter', None)
+    if model is None or model in _NO_JITTER_NAMES:
+        return None
+    if model in _GAUSSIAN_NAMES:
+        return dict(model='gaussian', sigma=options.get('jitter_sigma', 0.007), angle=options.get('jitter_angle', 0.0))
+    if model == 'timeseries':
+        return dict(model='timeseries', timeseries=options['jitter_timeseries'])
+    raise ValueError("Unknown jitter model '%s'. Use 'gaussian' or 'timeseries'." % model)
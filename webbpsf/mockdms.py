@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+"""
+mockdms.py
+
+    Mock JWST DMS output: detector-sampled PSFs placed on a full detector frame.
+
+    A full frame is mostly empty, and thousands of dense float64 2048x2048 frames
+    would need tens of GB, so the frame is stored sparsely: just the PSF stamp,
+    in a SCI extension whose header gives its position on the frame using the DMS
+    subarray keywords SUBSTRT1/2 (1-based first pixel) and SUBSIZE1/2, along with
+    the frame size in FRMSIZE1/2. Dense frames are only made on request, with
+    `full_frame`, which can add the stamp into an existing array such as a
+    memory-mapped file:
+
+        >>> frames = np.lib.format.open_memmap('frames.npy', mode='w+', dtype='float32', shape=(1000, 2048, 2048))
+        >>> for i, psf in enumerate(psfs):
+        ...     mockdms.full_frame(psf, out=frames[i])
+
+    Frames here are in the DMS Science frame, in which `detector_coordinates` are given.
+
+"""
+import numpy as np
+import astropy.io.fits as fits
+
+import logging
+_log = logging.getLogger('webbpsf')
+
+
+DEFAULT_FRAME_SHAPE = (2048, 2048)
+
+
+def place_stamp(stamp, frame_shape, coordinates):
+    """ Where a PSF stamp centered at the given coordinates falls on a frame, to the nearest pixel
+
+    Parameters
+    ----------
+    stamp : 2D ndarray
+        Detector-sampled PSF, centered in its array
+    frame_shape : tuple
+        (ny, nx) size of the full frame
+    coordinates : tuple
+        (x, y) 0-based pixel coordinates of the PSF center on the frame
+
+    Returns
+    -------
+    stamp : 2D ndarray
+        The part of the stamp that lies on the frame
+    x0, y0 : ints
+        0-based frame coordinates of its first pixel
+    """
+    ny, nx = stamp.shape
+    x0 = int(np.round(coordinates[0] - (nx - 1) / 2.0))
+    y0 = int(np.round(coordinates[1] - (ny - 1) / 2.0))
+    # trim whatever falls off the edges of the frame
+    ylo, xlo = max(0, -y0), max(0, -x0)
+    yhi, xhi = min(ny, frame_shape[0] - y0), min(nx, frame_shape[1] - x0)
+    if yhi <= ylo or xhi <= xlo:
+        raise ValueError("A PSF of shape %s at %s is entirely off the %s frame" % (stamp.shape, coordinates, frame_shape))
+    return stamp[ylo:yhi, xlo:xhi], x0 + xlo, y0 + ylo
+
+
+def sci_hdu(stamp, header, frame_shape, coordinates, detector=None):
+    """ SCI extension holding a stamp and its position on the frame """
+    data, x0, y0 = place_stamp(stamp, frame_shape, coordinates)
+    hdu = fits.ImageHDU(data=data, header=header.copy())
+    hdu.header.update('EXTNAME', 'SCI')
+    if detector is not None:
+        hdu.header.update('DETECTOR', detector, 'Detector name')
+    hdu.header.update('SUBSTRT1', x0 + 1, 'Frame X pixel of the first stamp column, 1-based')
+    hdu.header.update('SUBSTRT2', y0 + 1, 'Frame Y pixel of the first stamp row, 1-based')
+    hdu.header.update('SUBSIZE1', data.shape[1], 'Stamp size in X')
+    hdu.header.update('SUBSIZE2', data.shape[0], 'Stamp size in Y')
+    hdu.header.update('FRMSIZE1', frame_shape[1], 'Full frame size in X')
+    hdu.header.update('FRMSIZE2', frame_shape[0], 'Full frame size in Y')
+    hdu.header.update('DET_X', coordinates[0], 'PSF center X on the frame, 0-based Science pixels')
+    hdu.header.update('DET_Y', coordinates[1], 'PSF center Y on the frame, 0-based Science pixels')
+    return hdu
+
+
+def full_frame(hdulist, out=None, dtype=np.float32):
+    """ Expand the sparse SCI stamp of a mock DMS HDUList into a full detector frame
+
+    Parameters
+    ----------
+    hdulist : fits.HDUList
+        Output of calcPSF with output_mode 'Mock JWST DMS Output'
+    out : 2D ndarray, optional
+        Frame to add the stamp into, e.g. a slice of a memory-mapped cube, instead of
+        allocating a new one. It must have the frame shape.
+    dtype : numpy dtype
+        Type of a newly allocated frame
+
+    Returns
+    -------
+    frame : 2D ndarray
+    """
+    header = hdulist['SCI'].header
+    shape = (header['FRMSIZE2'], header['FRMSIZE1'])
+    if out is None:
+        out = np.zeros(shape, dtype=dtype)
+    elif out.shape != shape:
+        raise ValueError("Frame of shape %s does not match the mock DMS frame %s" % (out.shape, shape))
+    x0, y0 = header['SUBSTRT1'] - 1, header['SUBSTRT2'] - 1
+    stamp = hdulist['SCI'].data
+    out[y0:y0+stamp.shape[0], x0:x0+stamp.shape[1]] += stamp
+    return out
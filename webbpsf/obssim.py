@@ -19,6 +19,7 @@ import logging
 import poppy
 
 import webbpsf_core
+import utils
 
 
 _log = logging.getLogger('webbpsf')
@@ -103,78 +104,97 @@ class TargetScene(object):
             add read noise? TBD
         clobber : bool
             overwrite existing files? default True
+        output_dtype, output_compression, output_oversampled :
+            Compact output options, as for calcPSF. These are applied to the summed
+            image, not to the individual PSFs.
 
 
         It may also be useful to pass arguments to the calcPSF() call, which is supported through the **kwargs 
         mechanism. Such arguments might include fov_arcsec, fov_pixels, oversample, etc.
         """
 
+        # the individual PSFs are summed at full precision, and only the final image compacted
+        output_dtype = kwargs.pop('output_dtype', None) or webbpsf_core.settings.output_dtype()
+        output_compression = kwargs.pop('output_compression', None) or webbpsf_core.settings.output_compression()
+        output_oversampled = kwargs.pop('output_oversampled', True)
+        kwargs['output_dtype'] = 'float64'
+        # likewise mock DMS output applies to the summed image: the per-source PSFs are oversampled images
+        # to be added together, and it is the sum that is rebinned and placed on the detector frame
+        output_mode = kwargs.pop('output_mode', None) or instrument.options.get('output_mode', webbpsf_core.settings.default_output_mode())
+        dms_output = output_mode in ('Mock JWST DMS Output', 'dms')
+        saved_output_mode = instrument.options.get('output_mode', None)
+        if dms_output: instrument.options['output_mode'] = 'Oversampled image'
+
         sum_image = None
         image_PA = PA
 
-        for obj in self.sources:
-            _log.info('Now propagating for '+obj['name'])
-            # set  companion spectrum and position
-            src_spectrum = obj['spectrum']
-
-            if offset_r is None:
-                instrument.options['source_offset_r'] = obj['separation']
-                instrument.options['source_offset_theta'] = obj['PA'] - image_PA
-            else:
-                # combine the actual source position with the image offset position.
-                obj_x = obj['separation'] * np.cos(obj['PA'] * np.pi/180)
-                obj_y = obj['separation'] * np.sin(obj['PA'] * np.pi/180)
-                offset_x = offset_r * np.cos(offset_PA * np.pi/180)
-                offset_y = offset_r * np.sin(offset_PA * np.pi/180)
-
-                src_x = obj_x + offset_x
-                src_y = obj_y + offset_y
-                src_r = np.sqrt(src_x**2+src_y**2)
-                src_pa = np.arctan2(src_y, src_x) * 180/np.pi
-                instrument.options['source_offset_r'] = src_r
-                instrument.options['source_offset_theta'] = src_pa - image_PA
-                #stop()
-
-            _log.info('  post-offset & rot pos: %.3f  at %.1f deg' % (instrument.options['source_offset_r'], instrument.options['source_offset_theta']))
-
-
-            src_psf =  instrument.calcPSF(source = src_spectrum, outfile=None, save_intermediates=False, rebin=rebin, 
-                **kwargs)
-
-            # figure out the flux ratio
-            if obj['normalization'] is not None:
-                # use the explicitly-provided normalization:
-                if isinstance(obj['normalization'], numbers.Number):
-                    src_psf[0].data *= obj['normalization']
-                else:
-                    raise NotImplemented("Not Yet")
-            else:
-                # use the flux level already implicitly set by the source spectrum.
-                # i.e. figure out what the flux of the source is, inside the selected bandpass
-                bp = instrument._getSynphotBandpass()
-                effstim_Jy = pysynphot.Observation(src_spectrum, bp).effstim('Jy')
-                src_psf[0].data *= effstim_Jy
- 
-            # add the scaled companion PSF to the stellar PSF:
-            if sum_image is None:
-                sum_image = src_psf
-                sum_image[0].header.add_history("obssim : Creating an image simulation with multiple PSFs")
-                sum_image[0].header.update('IMAGE_PA', image_PA,'PA of scene in simulated image')
-                sum_image[0].header.update('OFFSET_R',0 if offset_r is None else offset_r ,'[arcsec] Offset of target center from FOV center')
-                sum_image[0].header.update('OFFSETPA',0 if offset_PA is None else offset_PA ,'[deg] Position angle of target offset from FOV center')
+        try:
+            for obj in self.sources:
+                _log.info('Now propagating for '+obj['name'])
+                # set  companion spectrum and position
+                src_spectrum = obj['spectrum']
 
                 if offset_r is None:
-                    sum_image[0].header.add_history("Image is centered on target (perfect acquisition)")
+                    instrument.options['source_offset_r'] = obj['separation']
+                    instrument.options['source_offset_theta'] = obj['PA'] - image_PA
+                else:
+                    # combine the actual source position with the image offset position.
+                    obj_x = obj['separation'] * np.cos(obj['PA'] * np.pi/180)
+                    obj_y = obj['separation'] * np.sin(obj['PA'] * np.pi/180)
+                    offset_x = offset_r * np.cos(offset_PA * np.pi/180)
+                    offset_y = offset_r * np.sin(offset_PA * np.pi/180)
+
+                    src_x = obj_x + offset_x
+                    src_y = obj_y + offset_y
+                    src_r = np.sqrt(src_x**2+src_y**2)
+                    src_pa = np.arctan2(src_y, src_x) * 180/np.pi
+                    instrument.options['source_offset_r'] = src_r
+                    instrument.options['source_offset_theta'] = src_pa - image_PA
+                    #stop()
+
+                _log.info('  post-offset & rot pos: %.3f  at %.1f deg' % (instrument.options['source_offset_r'], instrument.options['source_offset_theta']))
+
+
+                src_psf =  instrument.calcPSF(source = src_spectrum, outfile=None, save_intermediates=False, rebin=rebin, 
+                    **kwargs)
+
+                # figure out the flux ratio
+                if obj['normalization'] is not None:
+                    # use the explicitly-provided normalization:
+                    if isinstance(obj['normalization'], numbers.Number):
+                        src_psf[0].data *= obj['normalization']
+                    else:
+                        raise NotImplemented("Not Yet")
                 else:
-                    sum_image[0].header.add_history("Image is offset %.2f arcsec at PA=%.1f from target" % (offset_r, offset_PA))
+                    # use the flux level already implicitly set by the source spectrum.
+                    # i.e. figure out what the flux of the source is, inside the selected bandpass
+                    bp = instrument._getSynphotBandpass()
+                    effstim_Jy = pysynphot.Observation(src_spectrum, bp).effstim('Jy')
+                    src_psf[0].data *= effstim_Jy
+ 
+                # add the scaled companion PSF to the stellar PSF:
+                if sum_image is None:
+                    sum_image = src_psf
+                    sum_image[0].header.add_history("obssim : Creating an image simulation with multiple PSFs")
+                    sum_image[0].header.update('IMAGE_PA', image_PA,'PA of scene in simulated image')
+                    sum_image[0].header.update('OFFSET_R',0 if offset_r is None else offset_r ,'[arcsec] Offset of target center from FOV center')
+                    sum_image[0].header.update('OFFSETPA',0 if offset_PA is None else offset_PA ,'[deg] Position angle of target offset from FOV center')
+
+                    if offset_r is None:
+                        sum_image[0].header.add_history("Image is centered on target (perfect acquisition)")
+                    else:
+                        sum_image[0].header.add_history("Image is offset %.2f arcsec at PA=%.1f from target" % (offset_r, offset_PA))
 
-            else:
-                sum_image[0].data += src_psf[0].data
-            #update FITS header history
-            sum_image[0].header.add_history("Added source %s at r=%.3f, theta=%.2f" % (obj['name'], obj['separation'], obj['PA']))
-            sum_image[0].header.add_history("                with effstim = %.3g Jy" % effstim_Jy)
-            sum_image[0].header.add_history("                counts in image: %.3g" % src_psf[0].data.sum())
-            sum_image[0].header.add_history("                pos in image: %.3g'' at %.1f deg" % (instrument.options['source_offset_r'],  instrument.options['source_offset_theta'])  )
+                else:
+                    sum_image[0].data += src_psf[0].data
+                #update FITS header history
+                sum_image[0].header.add_history("Added source %s at r=%.3f, theta=%.2f" % (obj['name'], obj['separation'], obj['PA']))
+                sum_image[0].header.add_history("                with effstim = %.3g Jy" % effstim_Jy)
+                sum_image[0].header.add_history("                counts in image: %.3g" % src_psf[0].data.sum())
+                sum_image[0].header.add_history("                pos in image: %.3g'' at %.1f deg" % (instrument.options['source_offset_r'],  instrument.options['source_offset_theta'])  )
+        finally:
+            if saved_output_mode is None: instrument.options.pop('output_mode', None)
+            else: instrument.options['output_mode'] = saved_output_mode
 
 
         if noise:
@@ -184,29 +204,37 @@ class TargetScene(object):
             #add noise in image - photon and read noise, mainly.
        
         # downsample? 
-        if rebin and sum_image[0].header['DET_SAMP'] > 1:
-            # throw away the existing rebinned extension
-            sum_image.pop() 
-            # and generate a new one from the summed image
+        extnames = [hdu.header.get('EXTNAME', '') for hdu in sum_image]
+        if rebin and sum_image[0].header['DET_SAMP'] > 1 and 'DET_SAMP' in extnames:
+            # the existing rebinned extension holds just the first source; overwrite it in place
+            # with the rebinned summed image.
             _log.info(" Downsampling summed image to detector pixel scale.")
-            rebinned_sum_image = sum_image[0].copy()
             detector_oversample = sum_image[0].header['DET_SAMP']
-            rebinned_sum_image.data = poppy.rebin_array(rebinned_sum_image.data, rc=(detector_oversample, detector_oversample))
-            rebinned_sum_image.header.update('OVERSAMP', 1, 'These data are rebinned to detector pixels')
-            rebinned_sum_image.header.update('CALCSAMP', detector_oversample, 'This much oversampling used in calculation')
-            rebinned_sum_image.header.update('EXTNAME', 'DET_SAMP')
-            rebinned_sum_image.header['PIXELSCL'] *= detector_oversample
-            sum_image.append(rebinned_sum_image)
+            utils.rebin_array(sum_image[0].data, detector_oversample, out=sum_image[extnames.index('DET_SAMP')].data)
+
 
 
+        if dms_output:
+            instrument._calcPSF_format_output(sum_image, {'output_mode': output_mode, 'rebin': rebin,
+                'detector_oversample': sum_image[0].header['DET_SAMP'], 'output_dtype': output_dtype})
+        else:
+            utils.compact_output(sum_image, dtype=output_dtype, oversampled=output_oversampled)
 
         if outfile is not None:
             sum_image[0].header.update ("FILENAME", os.path.basename (outfile),
                            comment="Name of this file")
-            sum_image.writeto(outfile, clobber=clobber)
+            utils.write_fits(sum_image, outfile, compression=output_compression, clobber=clobber)
             _log.info("Saved image to "+outfile)
         return sum_image
 
+    def calcImage_async(self, instrument, **kwargs):
+        """ Start calcImage on a worker thread, returning an asyncio Future for the result
+
+        For use from within an asyncio event loop. See `webbpsf.asyncpsf`.
+        """
+        import asyncpsf
+        return asyncpsf.calcImage_async(self, instrument, **kwargs)
+
     def display(self):
         plt.clf()
         for obj in self.sources:
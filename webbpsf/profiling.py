@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+"""
+profiling.py
+
+    Timing and peak memory telemetry for PSF calculations.
+
+    Each call to calcPSF records a `CalcProfile`, available afterwards as the
+    instrument's `last_profile` attribute. This breaks the calculation down into
+    stages (weights, optical system construction, propagation, output formatting,
+    etc.), giving the elapsed time and memory high-water mark for each, plus the
+    time taken for each wavelength.
+
+    The timers are cheap enough to leave on all the time. Memory is sampled from the
+    process's peak resident set size, which is always available on Unix, and in
+    addition from tracemalloc when that is tracing (start it with
+    `tracemalloc.start()` before the calculation to get per-stage Python heap peaks;
+    this slows the calculation somewhat).
+
+"""
+import sys
+import time
+import contextlib
+import numpy as np
+import astropy.io.fits as fits
+
+import logging
+_log = logging.getLogger('webbpsf')
+
+try:
+    import resource
+    _HAS_RESOURCE = True
+except ImportError:
+    _HAS_RESOURCE = False
+
+try:
+    import tracemalloc
+    _HAS_TRACEMALLOC = True
+except ImportError:
+    _HAS_TRACEMALLOC = False
+
+# ru_maxrss is in kilobytes on Linux but in bytes on Mac OS
+_MAXRSS_UNITS = 1. if sys.platform == 'darwin' else 1024.
+_MB = 1024.**2
+
+
+def _maxrss(who='self'):
+    """ Peak resident set size in MB, of this process or (for who='children') its largest child process """
+    if not _HAS_RESOURCE: return np.nan
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if who == 'children' else resource.RUSAGE_SELF)
+    return usage.ru_maxrss * _MAXRSS_UNITS / _MB
+
+
+def _tracing():
+    return _HAS_TRACEMALLOC and tracemalloc.is_tracing()
+
+
+class StageProfile(object):
+    """ Time and memory for one stage of a calculation
+
+    Attributes
+    ----------
+    name : string
+        Stage name. Nested stages are named 'outer/inner'.
+    elapsed : float
+        Wall clock time in seconds
+    maxrss : float
+        Peak resident set size of this process at the end of the stage, in MB. This is a
+        high-water mark for the whole process so far, so it only ever increases.
+    child_maxrss : float
+        Peak resident set size of the largest worker process that has finished so far, in MB.
+    traced_peak : float or None
+        Peak memory allocated through Python during the stage according to tracemalloc, in MB,
+        or None if tracemalloc was not tracing.
+    """
+    def __init__(self, name, elapsed, maxrss, child_maxrss, traced_peak=None):
+        self.name = name
+        self.elapsed = elapsed
+        self.maxrss = maxrss
+        self.child_maxrss = child_maxrss
+        self.traced_peak = traced_peak
+
+    @property
+    def depth(self):
+        return self.name.count('/')
+
+    def __repr__(self):
+        return "<StageProfile %s: %.3f s, maxrss %.1f MB>" % (self.name, self.elapsed, self.maxrss)
+
+
+class CalcProfile(object):
+    """ Per-stage timings and peak memory for one PSF calculation
+
+    Stages are recorded with the `stage` context manager, which may be nested.
+    The results are available as `stages` (in order of completion, so inner stages
+    come before the stage containing them) and `wavelengths`, or summarized with
+    `summary()`, `as_dict()`, `to_header()` and `to_table_hdu()`.
+    """
+    def __init__(self, name=''):
+        self.name = name
+        self.stages = []
+        self.wavelengths = []   # list of (index, wavelength in meters, elapsed seconds)
+        self._stack = []    # [name, traced peak in bytes] for each stage in progress
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """ Context manager timing one stage of the calculation """
+        tracing = _tracing()
+        if tracing and hasattr(tracemalloc, 'reset_peak'):
+            # fold the peak so far into any enclosing stages before resetting it for this one
+            current_peak = tracemalloc.get_traced_memory()[1]
+            for frame in self._stack: frame[1] = max(frame[1], current_peak)
+            tracemalloc.reset_peak()
+        frame = [name, 0]
+        self._stack.append(frame)
+        fullname = '/'.join([f[0] for f in self._stack])
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - t0
+            peak = max(frame[1], tracemalloc.get_traced_memory()[1]) if tracing else 0
+            self.stages.append(StageProfile(fullname, elapsed, _maxrss(), _maxrss('children'),
+                peak / _MB if tracing else None))
+            self._stack.pop()
+            for outer in self._stack: outer[1] = max(outer[1], peak)
+
+    def add_wavelength(self, index, wavelength, elapsed):
+        """ Record the propagation time for one wavelength """
+        self.wavelengths.append((index, wavelength, elapsed))
+
+    def __getitem__(self, name):
+        for stage in self.stages:
+            if stage.name == name: return stage
+        raise KeyError(name)
+
+    @property
+    def total_time(self):
+        """ Sum of the times for all top-level stages, in seconds """
+        return sum([s.elapsed for s in self.stages if s.depth == 0])
+
+    @property
+    def peak_memory(self):
+        """ Peak resident set size in MB of this process or any worker process """
+        if len(self.stages) == 0: return np.nan
+        return max(max([s.maxrss for s in self.stages]), max([s.child_maxrss for s in self.stages]))
+
+    def as_dict(self):
+        """ Return the profile as plain Python types, e.g. for saving as JSON """
+        return {'name': self.name,
+                'total_time': self.total_time,
+                'peak_memory': self.peak_memory,
+                'stages': [dict(name=s.name, elapsed=s.elapsed, maxrss=s.maxrss, child_maxrss=s.child_maxrss,
+                                traced_peak=s.traced_peak) for s in self.stages],
+                'wavelengths': [dict(index=int(i), wavelength=float(w), elapsed=e) for i, w, e in self.wavelengths]}
+
+    def summary(self):
+        """ Return a human-readable table of the stages as a string """
+        lines = ["Profile for %s: %.3f s total, peak memory %.1f MB" % (self.name, self.total_time, self.peak_memory)]
+        for s in self.stages:
+            line = "  %-30s %9.3f s  maxrss %8.1f MB" % ('  '*s.depth + s.name.split('/')[-1], s.elapsed, s.maxrss)
+            if s.traced_peak is not None: line += "  traced peak %8.1f MB" % s.traced_peak
+            lines.append(line)
+        if len(self.wavelengths) > 0:
+            times = np.asarray([e for i, w, e in self.wavelengths])
+            lines.append("  %d wavelengths: %.3f s mean, %.3f s max" % (len(times), times.mean(), times.max()))
+        return "\n".join(lines)
+
+    def to_header(self, header):
+        """ Write the top-level stage times and peak memory to FITS header keywords
+
+        Stage times go in keywords T_<STAGE>, using the first six letters of the stage name.
+        """
+        header.update('PRFTIME', self.total_time, 'Total time for stages profiled so far [s]')
+        header.update('PRFMEM', self.peak_memory, 'Peak resident memory of any process [MB]')
+        for s in self.stages:
+            if s.depth == 0:
+                header.update('T_'+s.name[:6].upper(), s.elapsed, 'Time for %s stage [s]' % s.name)
+        if len(self.wavelengths) > 0:
+            header.update('T_WAVMAX', max([e for i, w, e in self.wavelengths]), 'Max time for one wavelength [s]')
+
+    def to_table_hdu(self):
+        """ Return the stages and per-wavelength times as a FITS binary table extension named PROFILE """
+        names = [s.name for s in self.stages] + ['wavelength %d' % i for i, w, e in self.wavelengths]
+        elapsed = [s.elapsed for s in self.stages] + [e for i, w, e in self.wavelengths]
+        maxrss = [s.maxrss for s in self.stages] + [np.nan for i, w, e in self.wavelengths]
+        traced = [(np.nan if s.traced_peak is None else s.traced_peak) for s in self.stages] + [np.nan for i, w, e in self.wavelengths]
+        width = max([len(n) for n in names] + [1])
+        cols = fits.ColDefs([fits.Column(name='STAGE', format='%dA' % width, array=np.asarray(names)),
+                             fits.Column(name='TIME', format='D', unit='s', array=np.asarray(elapsed)),
+                             fits.Column(name='MAXRSS', format='D', unit='MB', array=np.asarray(maxrss)),
+                             fits.Column(name='TRACED', format='D', unit='MB', array=np.asarray(traced))])
+        if hasattr(fits.BinTableHDU, 'from_columns'):
+            hdu = fits.BinTableHDU.from_columns(cols)
+        else:
+            hdu = fits.new_table(cols)
+        hdu.header.update('EXTNAME', 'PROFILE')
+        return hdu
+
+
+class _NullStage(object):
+    def __enter__(self): return self
+    def __exit__(self, *args): return False
+
+
+def stage(profile, name):
+    """ Time a stage on `profile`, or do nothing if `profile` is None
+
+    This lets methods such as _getOpticalSystem be instrumented while remaining
+    usable on their own.
+    """
+    if profile is None: return _NullStage()
+    return profile.stage(name)
@@ -0,0 +1,872 @@
+#!/usr/bin/env python
+"""
+propagation.py
+
+    The wavelength loop for broadband PSF calculations.
+
+    This computes the monochromatic PSF for each wavelength with the optical
+    system's `propagate_mono` method, and accumulates the weighted sum. Unlike
+    poppy.OpticalSystem.calcPSF, the number of worker processes is chosen to
+    fit the calculation inside a memory budget (see `settings.max_memory`),
+    and the wavelengths are handed to those workers in chunks so that no more
+    than that many wavelengths are ever in flight at once.
+
+    The workers may be either separate processes, or threads within this
+    process (see `settings.use_threads`). Threads work well here since
+    NumPy and FFTW release the GIL during the expensive array operations,
+    and unlike processes they can be used from inside the GUIs. In either
+    case each monochromatic result can be handed back to the caller as it
+    arrives, in the calling thread.
+
+    For direct imaging (pupil planes followed by the detector), `calc_psf_steps`
+    computes PSFs for many variations on one optical system at once, such as
+    steps through focus. The field in the last pupil plane is computed once per
+    wavelength, each variation applied to a copy of it, and the variations
+    transformed to the detector together in batched matrix Fourier transforms.
+    `calc_psf_offsets` does likewise for many source positions, shifting the
+    grid of detector pixels rather than tilting the pupil.
+    `calc_psf_tiled` computes one PSF over a very large field of view in tiles
+    of the detector plane, each with its own MFT matrices.
+
+"""
+import os
+import copy
+import time
+import contextlib
+import threading
+import multiprocessing
+import multiprocessing.pool
+import numpy as np
+import astropy.io.fits as fits
+
+import poppy
+
+from . import settings
+from . import utils
+
+import logging
+_log = logging.getLogger('webbpsf')
+
+try:
+    import psutil
+    _HAS_PSUTIL = True
+except ImportError:
+    _HAS_PSUTIL = False
+
+
+_GB = 1024.**3
+
+
+#---------------------------------------------------------------------------------
+# Memory estimation
+
+def _pupil_npix(optsys):
+    """ Number of pixels across the entrance pupil array """
+    for plane in optsys.planes:
+        amplitude = getattr(plane, 'amplitude', None)
+        if amplitude is not None and not np.isscalar(amplitude):
+            return max(amplitude.shape)
+    return 1024 # the usual JWST pupil size, if it can't be determined
+
+
+def _detector_npix(optsys):
+    """ Number of oversampled pixels in the detector plane array """
+    det = optsys.planes[-1]
+    fov_pixels = getattr(det, 'fov_pixels', None)
+    if fov_pixels is None: return 0
+    oversample = getattr(det, 'oversample', 1)
+    if np.isscalar(fov_pixels): fov_pixels = (fov_pixels, fov_pixels)
+    return int(fov_pixels[0]*oversample) * int(fov_pixels[1]*oversample)
+
+
+def _uses_fft(optsys):
+    """ Will this optical system use FFTs to reach an intermediate image plane? """
+    if hasattr(optsys, 'occulter_box') or hasattr(optsys, 'slit_box'):
+        return False # semi-analytic coronagraph or slit
+    return any([p.planetype == poppy.poppy_core._IMAGE for p in optsys.planes])
+
+
+def estimate_memory_per_wavelength(optsys, precision='double'):
+    """ Estimate the peak memory, in bytes, needed to propagate one wavelength through an optical system.
+
+    The estimate is based on the size of the pupil array, the amount of zero padding for any FFTs
+    to intermediate image planes, and the oversampled detector size. It is deliberately
+    conservative: several full-size complex arrays (the wavefront, phasors, coordinate
+    arrays, and temporary copies) exist at the peak. For a 1024 pixel pupil with FFTs at
+    oversample=4 this comes out to about 1 GB, consistent with measurements.
+
+    In single precision only the stored wavefront is complex64. poppy's phasors, FFTs and
+    matrix Fourier transforms still produce complex128 arrays, which are converted
+    afterwards, so those temporaries are counted at 16 bytes either way.
+
+    Parameters
+    ----------
+    optsys : poppy.OpticalSystem
+        The optical system to be propagated through
+    precision : string
+        'single' or 'double', the precision of the propagated wavefront
+
+    Returns
+    -------
+    nbytes : float
+        Estimated peak memory per wavelength in bytes
+    """
+    npup = _pupil_npix(optsys)
+    ndet = _detector_npix(optsys)
+    wavefront_bytes = 8 if precision == 'single' else 16
+    temp_bytes = 16 # poppy always computes in complex128
+
+    nbytes = npup**2 * (wavefront_bytes + 3*temp_bytes)     # pupil plane wavefront, phasors & copies
+    nbytes += ndet * (wavefront_bytes + 2*temp_bytes)       # detector plane wavefront & intensity
+    nbytes += 2 * npup * np.sqrt(ndet) * temp_bytes         # MFT matrices
+    if _uses_fft(optsys):
+        npad = npup * optsys.oversample
+        nbytes += npad**2 * (wavefront_bytes + 3*temp_bytes) # padded arrays for FFTs
+    return float(nbytes)
+
+
+def available_memory():
+    """ Currently available RAM in bytes, or None if it cannot be determined (requires psutil) """
+    if not _HAS_PSUTIL: return None
+    try:
+        return float(psutil.virtual_memory().available)
+    except AttributeError:
+        return float(psutil.avail_phymem()) # older psutil versions
+
+
+_budget_share = threading.local()
+
+
+@contextlib.contextmanager
+def budget_share(fraction):
+    """ Context manager limiting calculations in this thread to a fraction of the memory budget
+
+    For use where several calculations run at once in threads of one process, such as
+    in `asyncpsf` and `server`, so that together they stay within `settings.max_memory`.
+    """
+    saved = getattr(_budget_share, 'fraction', 1.0)
+    _budget_share.fraction = saved * fraction
+    try:
+        yield
+    finally:
+        _budget_share.fraction = saved
+
+
+def memory_budget():
+    """ Total memory in bytes that a calculation may use, from `settings.max_memory`.
+
+    If that is zero, use 80% of currently available RAM, or None for no limit if
+    the available RAM cannot be determined. Inside `budget_share` this is reduced
+    to the given fraction.
+    """
+    fraction = getattr(_budget_share, 'fraction', 1.0)
+    max_memory = settings.max_memory()
+    if max_memory > 0:
+        return fraction * max_memory * _GB
+    available = available_memory()
+    return None if available is None else fraction * 0.8 * available
+
+
+def plan_schedule(optsys, nwavelengths, nprocesses, budget=None, precision='double'):
+    """ Choose how many worker processes to use for a calculation within a memory budget.
+
+    Parameters
+    ----------
+    optsys : poppy.OpticalSystem
+        The optical system to be propagated through
+    nwavelengths : int
+        Number of wavelengths to compute
+    nprocesses : int
+        Requested number of worker processes. 0 means as many as there are CPUs.
+    budget : float or None
+        Memory budget in bytes, or None for no limit.
+    precision : string
+        'single' or 'double', the precision of the propagated wavefronts
+
+    Returns
+    -------
+    nworkers : int
+        Number of wavelengths to compute at once. 1 means compute serially in this process.
+        0 means that even a single wavelength is estimated to exceed the budget.
+    per_wavelength : float
+        Estimated memory per wavelength in bytes
+    """
+    if nprocesses == 0: nprocesses = multiprocessing.cpu_count()
+    nworkers = max(1, min(nprocesses, nwavelengths))
+
+    per_wavelength = estimate_memory_per_wavelength(optsys, precision=precision)
+    if budget is not None:
+        nfit = int(budget // per_wavelength)
+        if nfit < nworkers:
+            _log.info("Memory budget of %.2f GB allows %d wavelength(s) at once at %.2f GB each (%d processes requested)" %
+                    (budget/_GB, nfit, per_wavelength/_GB, nprocesses))
+        nworkers = min(nworkers, nfit)
+    return nworkers, per_wavelength
+
+
+#---------------------------------------------------------------------------------
+# Progress reporting and cancellation
+
+class CalculationCancelled(Exception):
+    """ Raised when a calculation is stopped through its CancelToken """
+    pass
+
+
+class CancelToken(object):
+    """ Cooperative cancellation for a PSF calculation
+
+    Pass one of these to calcPSF as `cancel_token`, and call `cancel()` on it from
+    any thread (e.g. a progress callback, a GUI event handler, or a job scheduler)
+    to stop the calculation. The token is checked between wavelengths, and between
+    optical planes when those are computed in this process.
+    """
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self):
+        """ Request that the calculation stop as soon as possible """
+        self._event.set()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def check(self):
+        """ Raise CalculationCancelled if cancellation has been requested """
+        if self._event.is_set():
+            raise CalculationCancelled("PSF calculation cancelled")
+
+
+class ProgressEvent(object):
+    """ Progress report for a calc_psf progress callback
+
+    Attributes
+    ----------
+    kind : string
+        'plane' when one optical plane has been computed for one wavelength, or
+        'wavelength' when a wavelength has been completed and added to the sum.
+    index : int
+        Index of the wavelength in the list of wavelengths for the calculation
+    wavelength : float
+        Wavelength in meters
+    nwavelengths : int
+        Total number of wavelengths in the calculation
+    ncompleted : int
+        Number of wavelengths completed so far (for 'wavelength' events)
+    plane_index : int
+        Index of the optical plane (for 'plane' events)
+    plane_name : string
+        Name of the optical plane (for 'plane' events)
+    elapsed : float
+        Time in seconds taken by this plane, or by this whole wavelength
+    """
+    def __init__(self, kind, index, wavelength, nwavelengths, elapsed, ncompleted=None, plane_index=None, plane_name=None):
+        self.kind = kind
+        self.index = index
+        self.wavelength = wavelength
+        self.nwavelengths = nwavelengths
+        self.elapsed = elapsed
+        self.ncompleted = ncompleted
+        self.plane_index = plane_index
+        self.plane_name = plane_name
+
+    def __repr__(self):
+        if self.kind == 'plane':
+            return "<ProgressEvent: wavelength %d/%d, plane %d (%s), %.3f s>" % (self.index+1, self.nwavelengths,
+                    self.plane_index, self.plane_name, self.elapsed)
+        else:
+            return "<ProgressEvent: wavelength %d/%d done (%d completed), %.3f s>" % (self.index+1, self.nwavelengths,
+                    self.ncompleted, self.elapsed)
+
+
+#---------------------------------------------------------------------------------
+# The wavelength loop
+
+_worker_optsys = None
+
+def _init_worker(optsys):
+    global _worker_optsys
+    _worker_optsys = optsys
+
+
+class _ThreadLocalOpticalSystems(object):
+    """ Give each worker thread its own copy of an optical system
+
+    Optical elements may cache arrays on themselves during a propagation,
+    so the threads must not share them.
+    """
+    def __init__(self, optsys):
+        self.optsys = optsys
+        self._local = threading.local()
+
+    def get(self):
+        if not hasattr(self._local, 'optsys'):
+            self._local.optsys = copy.deepcopy(self.optsys)
+        return self._local.optsys
+
+
+class WavelengthResult(object):
+    """ The result of the propagation for one wavelength, as handed to a calc_psf callback
+
+    Attributes
+    ----------
+    index : int
+        Index of this wavelength in the list of wavelengths for the calculation
+    wavelength, weight : float
+        Wavelength in meters and its normalized weight
+    data : ndarray
+        Monochromatic PSF intensity
+    header : fits.Header
+        FITS header for the monochromatic PSF
+    intermediates : list of poppy.Wavefront, or None
+        Wavefronts at each plane, if intermediates were requested
+    """
+    def __init__(self, index, wavelength, weight, data, header, intermediates=None):
+        self.index = index
+        self.wavelength = wavelength
+        self.weight = weight
+        self.data = data
+        self.header = header
+        self.intermediates = intermediates
+
+
+def set_precision(wavefront, precision):
+    """ Convert a wavefront's complex field to the given precision, 'single' or 'double', in place.
+
+    poppy creates wavefronts in double precision, and its FFTs and matrix Fourier
+    transforms return double precision results, so for single precision propagation
+    this is applied after each step. It does nothing if the field is already of the
+    right type, or for double precision.
+    """
+    if precision == 'single' and wavefront.wavefront.dtype != np.complex64:
+        wavefront.wavefront = wavefront.wavefront.astype(np.complex64)
+    return wavefront
+
+
+def _supports_precision(optsys, normalize='first'):
+    """ Can this optical system be propagated in single precision? """
+    if type(optsys) is poppy.OpticalSystem:
+        return normalize.lower() not in ('first=2', 'exit_pupil')
+    return getattr(optsys, '_supports_precision', False)
+
+
+class _Propagator(object):
+    """ Propagates single wavelengths, with optional per-plane progress reports, cancellation checks
+    and single precision.
+
+    These need webbpsf's own loop over the planes, which is only used for plain
+    poppy.OpticalSystems with the 'first', 'last' or no normalization. Other optical
+    systems (e.g. the semi-analytic coronagraph and slit) use their own propagate_mono,
+    report progress per wavelength only, and support single precision only if they
+    accept a precision argument.
+    """
+    def __init__(self, normalize='first', return_intermediates=False, progress=None, token=None, nwavelengths=0,
+            precision='double'):
+        self.normalize = normalize
+        self.return_intermediates = return_intermediates
+        self.progress = progress
+        self.token = token
+        self.nwavelengths = nwavelengths
+        self.precision = precision
+
+    def _use_plane_loop(self, optsys):
+        return ((self.progress is not None or self.token is not None or self.precision == 'single') and
+                type(optsys) is poppy.OpticalSystem and self.normalize.lower() not in ('first=2', 'exit_pupil'))
+
+    def __call__(self, optsys, index, wavelength):
+        """ Returns (index, psf data, header, intermediates, elapsed seconds) """
+        if self.token is not None: self.token.check()
+        t0 = time.time()
+        kwargs = {}
+        if self.precision == 'single' and getattr(optsys, '_supports_precision', False):
+            kwargs['precision'] = self.precision
+        if self._use_plane_loop(optsys):
+            psf, intermediates = self._propagate_planes(optsys, index, wavelength)
+        elif self.return_intermediates:
+            psf, intermediates = optsys.propagate_mono(wavelength, normalize=self.normalize, return_intermediates=True, **kwargs)
+        else:
+            psf, intermediates = _mono_hdulist(optsys.propagate_mono(wavelength, normalize=self.normalize, **kwargs)), None
+        return index, psf[0].data, psf[0].header, intermediates, time.time()-t0
+
+    def _propagate_planes(self, optsys, index, wavelength):
+        intermediates = [] if self.return_intermediates else None
+        wavefront = set_precision(optsys.inputWavefront(wavelength), self.precision)
+        for i, optic in enumerate(optsys.planes):
+            if self.token is not None: self.token.check()
+            t0 = time.time()
+            wavefront.propagateTo(optic)
+            set_precision(wavefront, self.precision)
+            wavefront *= optic
+            set_precision(wavefront, self.precision)
+            if i == 0 and self.normalize.lower() == 'first':
+                wavefront.normalize()
+            if self.return_intermediates: intermediates.append(wavefront.copy())
+            if self.progress is not None:
+                self.progress(ProgressEvent('plane', index, wavelength, self.nwavelengths, time.time()-t0,
+                    plane_index=i, plane_name=optic.name))
+        if self.normalize.lower() == 'last':
+            wavefront.normalize()
+        return wavefront.asFITS(), intermediates
+
+
+def _mono_hdulist(result):
+    """ propagate_mono may return either an HDUList or (HDUList, intermediates) """
+    return result[0] if isinstance(result, tuple) else result
+
+
+def _worker_propagate(args):
+    index, wavelength, normalize, precision = args
+    return _Propagator(normalize, precision=precision)(_worker_optsys, index, wavelength)
+
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i+size]
+
+
+def _iter_results(optsys, tasks, nworkers, propagator, use_threads=False):
+    """ Yield (index, psf data, header, intermediates, elapsed) for each task, in whatever order they complete
+
+    Closing the generator early (e.g. on cancellation) stops any worker processes immediately.
+    """
+    if nworkers == 1:
+        _log.info("Computing %d wavelength(s) serially" % len(tasks))
+        for index, wavelength, normalize, precision in tasks:
+            yield propagator(optsys, index, wavelength)
+        return
+
+    if use_threads:
+        _log.info("Computing %d wavelengths using %d threads" % (len(tasks), nworkers))
+        local = _ThreadLocalOpticalSystems(optsys)
+        def propagate(args):
+            index, wavelength, normalize, precision = args
+            return propagator(local.get(), index, wavelength)
+        pool = multiprocessing.pool.ThreadPool(nworkers)
+    else:
+        if propagator.return_intermediates:
+            raise ValueError("Intermediate planes cannot be returned from worker processes; use threads instead.")
+        _log.info("Computing %d wavelengths using %d processes" % (len(tasks), nworkers))
+        propagate = _worker_propagate
+        pool = multiprocessing.Pool(nworkers, initializer=_init_worker, initargs=(optsys,))
+
+    try:
+        for chunk in _chunks(tasks, nworkers):
+            for result in pool.imap_unordered(propagate, chunk):
+                yield result
+    except BaseException: # including GeneratorExit, if the caller stops early
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+
+
+def _broadband_keywords(header, wavelengths, weights, normalize):
+    """ Header keywords for the wavelengths and weights summed in a broadband PSF """
+    header.update('NWAVES', len(wavelengths), 'Number of wavelengths used in calculation')
+    header.update('WAVELEN', float((wavelengths*weights).sum()), 'Weighted mean wavelength in meters')
+    for i in range(len(wavelengths)):
+        header.update('WAVE'+str(i), wavelengths[i], "Wavelength "+str(i))
+        header.update('WGHT'+str(i), weights[i], "Wavelength weight "+str(i))
+    header.update('FFTTYPE', "pyFFTW" if poppy.settings.use_fftw() else "numpy.fft", 'Algorithm for FFTs: numpy or fftw')
+    header.update('NORMALIZ', normalize, 'PSF normalization method')
+
+
+def calc_psf(optsys, wavelengths, weights, normalize='first', nprocesses=1, budget=None,
+        use_threads=False, callback=None, return_intermediates=False,
+        progress=None, cancel_token=None, return_partial=False, profile=None, precision='double'):
+    """ Compute a broadband PSF as the weighted sum of monochromatic PSFs
+
+    Parameters
+    ----------
+    optsys : poppy.OpticalSystem
+        Optical system to propagate through
+    wavelengths, weights : iterables of floats
+        Wavelengths in meters and their relative weights
+    normalize : string
+        Normalization, passed to the optical system's propagate_mono
+    nprocesses : int
+        Maximum number of worker processes to use. 1 means run serially in this process,
+        0 means as many as there are CPUs. This may be reduced to fit within the memory budget.
+    budget : float or None
+        Memory budget in bytes. If None, no limit is applied.
+    use_threads : bool
+        Use a pool of threads in this process rather than worker processes.
+    callback : callable, optional
+        Function called with a `WavelengthResult` as each wavelength completes. This is
+        always called from the calling thread, in order of completion, which is not
+        necessarily the order of the wavelengths.
+    return_intermediates : bool
+        Include the wavefront at each plane in the results passed to `callback`. This
+        requires computing serially or with threads.
+    progress : callable, optional
+        Function called with a `ProgressEvent` after each wavelength, from the calling
+        thread, and after each optical plane, from whichever thread computed it. Plane
+        events are not available from worker processes.
+    cancel_token : CancelToken, optional
+        Token to check for cancellation between wavelengths and planes.
+    return_partial : bool
+        If the calculation is cancelled after some wavelengths have completed, return the
+        weighted sum of those instead of raising CalculationCancelled. The header keyword
+        CANCELLD is set, and NCOMPLET and WGHTDONE give the number and total weight of the
+        wavelengths included.
+    profile : webbpsf.profiling.CalcProfile, optional
+        Profile in which to record the time taken for each wavelength.
+    precision : string
+        'double' or 'single'. In single precision, wavefronts are complex64 and the
+        monochromatic intensities float32; the weighted sum is always accumulated in float64.
+        If even one wavelength in double precision is estimated to exceed the budget, single
+        precision is used instead where the optical system supports it.
+
+    Returns
+    -------
+    result : fits.HDUList
+        The PSF, with FITS header keywords giving the wavelengths and weights.
+    """
+    wavelengths = np.asarray(wavelengths, dtype=float).ravel()
+    weights = np.asarray(weights, dtype=float).ravel()
+    weights = weights / weights.sum()
+    nwavelengths = len(wavelengths)
+
+    if precision not in ('single', 'double'):
+        raise ValueError("precision must be 'single' or 'double', not %s" % precision)
+    if precision == 'single' and not _supports_precision(optsys, normalize):
+        _log.warn("Single precision is not available for %s; computing in double precision." % optsys.__class__.__name__)
+        precision = 'double'
+
+    nworkers, per_wavelength = plan_schedule(optsys, nwavelengths, nprocesses, budget=budget, precision=precision)
+    if nworkers < 1 and precision == 'double' and _supports_precision(optsys, normalize):
+        single_workers, single_per_wavelength = plan_schedule(optsys, nwavelengths, nprocesses, budget=budget, precision='single')
+        if single_workers >= 1:
+            _log.warn("Estimated memory of %.2f GB for a single wavelength exceeds the memory budget of %.2f GB; computing in single precision (%.2f GB) instead." %
+                    (per_wavelength/_GB, budget/_GB, single_per_wavelength/_GB))
+            precision = 'single'
+            nworkers, per_wavelength = single_workers, single_per_wavelength
+    if nworkers < 1:
+        _log.warn("Estimated memory of %.2f GB for a single wavelength exceeds the memory budget of %.2f GB. Continuing serially anyway." %
+                (per_wavelength/_GB, budget/_GB))
+        nworkers = 1
+    if nworkers > 1 and return_intermediates and not use_threads:
+        _log.info("Intermediate planes requested, so using threads rather than processes.")
+        use_threads = True
+
+    propagator = _Propagator(normalize, return_intermediates=return_intermediates, progress=progress,
+            token=cancel_token, nwavelengths=nwavelengths, precision=precision)
+    tasks = [(i, wavelengths[i], normalize, precision) for i in range(nwavelengths)]
+    psf_sum = None
+    header = None
+    completed = []
+    cancelled = False
+    results = _iter_results(optsys, tasks, nworkers, propagator, use_threads=use_threads)
+    try:
+        for index, data, mono_header, intermediates, elapsed in results:
+            if psf_sum is None:
+                psf_sum = np.zeros(data.shape, dtype=np.float64)
+                header = mono_header
+            psf_sum += data * weights[index]
+            completed.append(index)
+            if profile is not None: profile.add_wavelength(index, wavelengths[index], elapsed)
+            if callback is not None:
+                callback(WavelengthResult(index, wavelengths[index], weights[index], data, mono_header, intermediates))
+            del data, intermediates
+            if progress is not None:
+                progress(ProgressEvent('wavelength', index, wavelengths[index], nwavelengths, elapsed, ncompleted=len(completed)))
+            if cancel_token is not None: cancel_token.check()
+    except CalculationCancelled:
+        _log.warn("PSF calculation cancelled after %d of %d wavelengths" % (len(completed), nwavelengths))
+        if not return_partial or psf_sum is None:
+            del psf_sum
+            raise
+        cancelled = True
+    finally:
+        results.close()
+
+    header = header.copy()
+    _broadband_keywords(header, wavelengths, weights, normalize)
+    header.update('PRECISIO', precision, 'Floating point precision of propagation')
+    header.update('NPROCESS', nworkers, 'Number of wavelengths computed in parallel')
+    header.update('PARALLEL', 'threads' if (use_threads and nworkers > 1) else ('processes' if nworkers > 1 else 'serial'),
+            'Parallelization method')
+    if cancelled:
+        header.update('CANCELLD', True, 'Calculation cancelled; PSF is a partial sum')
+        header.update('NCOMPLET', len(completed), 'Number of wavelengths included in partial sum')
+        header.update('WGHTDONE', float(weights[completed].sum()), 'Total weight of wavelengths included')
+
+    return fits.HDUList([fits.PrimaryHDU(data=psf_sum, header=header)])
+
+
+#---------------------------------------------------------------------------------
+# Batched direct imaging
+
+_RADIANStoARCSEC = 180.*60*60 / np.pi
+
+
+def check_direct_imaging(optsys):
+    """ Raise NotImplementedError unless the optical system is pupil planes followed by a detector """
+    planes = optsys.planes
+    if planes[-1].planetype != poppy.poppy_core._DETECTOR or \
+            any([p.planetype != poppy.poppy_core._PUPIL for p in planes[:-1]]) or \
+            hasattr(optsys, 'occulter_box') or hasattr(optsys, 'slit_box'):
+        raise NotImplementedError("This is only available for optical systems of pupil planes followed by a "
+                "detector, not for coronagraphs or other systems with intermediate image planes.")
+
+
+def pupil_wavefront(optsys, wavelength, normalize='first'):
+    """ The wavefront in the last pupil plane of a direct imaging system, as propagate_mono computes it """
+    wavefront = optsys.inputWavefront(wavelength)
+    for i, optic in enumerate(optsys.planes[:-1]):
+        wavefront.propagateTo(optic)
+        wavefront *= optic
+        if i == 0 and normalize.lower() == 'first':
+            wavefront.normalize()
+    return wavefront
+
+
+def detector_transform(optsys, wavefront, offset=(0.0, 0.0)):
+    """ MFT matrices from a pupil wavefront to the oversampled detector pixels, as poppy would use
+
+    The output grid may be offset by (Y, X) oversampled pixels.
+    Returns (expYV, expXU, norm, npix), for use with `mft_stack`.
+    """
+    detector = optsys.planes[-1]
+    fov_pixels = detector.fov_pixels
+    if np.isscalar(fov_pixels): fov_pixels = (fov_pixels, fov_pixels)
+    npix = (int(fov_pixels[0] * detector.oversample), int(fov_pixels[1] * detector.oversample))
+    shape = wavefront.wavefront.shape
+    lamD = wavefront.wavelength / (shape[0] * wavefront.pixelscale) * _RADIANStoARCSEC
+    pixelscale = detector.pixelscale / detector.oversample
+    nlamD = (npix[0] * pixelscale / lamD, npix[1] * pixelscale / lamD)
+    expYV, expXU, norm = utils.mft_matrices(shape, nlamD, npix, offset=offset)
+    return expYV, expXU, norm, npix
+
+
+def mft_stack(fields, expYV, expXU, norm):
+    """ Matrix Fourier transform of a stack of pupil fields (m, ny, nx), with two matrix products for the whole stack """
+    m, ny, nx = fields.shape
+    rows = np.dot(expYV, fields.transpose(1, 0, 2).reshape(ny, m * nx))
+    rows = rows.reshape(expYV.shape[0], m, nx).transpose(1, 0, 2)
+    return norm * np.dot(rows, expXU)
+
+
+def calc_psf_steps(optsys, wavelengths, weights, steps, normalize='first', chunk=8, cancel_token=None):
+    """ Broadband PSFs for many variations on one direct imaging optical system, in one pass
+
+    Parameters
+    ----------
+    optsys : poppy.OpticalSystem
+        Optical system of pupil planes followed by a detector
+    wavelengths, weights : iterables of floats
+        Wavelengths in meters and their relative weights
+    steps : list of callables
+        Each is called with a copy of the wavefront in the last pupil plane, and should modify
+        it in place, e.g. by multiplying by a lens or tilting it.
+    normalize : string
+        Normalization, as for poppy: 'first' for unit total intensity at the entrance pupil
+    chunk : int
+        Number of steps to transform at once; higher is faster but uses more memory
+    cancel_token : CancelToken, optional
+        Checked between wavelengths
+
+    Returns
+    -------
+    psfs : ndarray
+        Oversampled PSFs, shape (number of steps, ny, nx)
+    """
+    check_direct_imaging(optsys)
+    weights = np.asarray(weights, dtype=np.float64) / np.sum(weights)
+    result = None
+    for wavelength, weight in zip(wavelengths, weights):
+        if cancel_token is not None: cancel_token.check()
+        wavefront = pupil_wavefront(optsys, wavelength, normalize=normalize)
+        expYV, expXU, norm, npix = detector_transform(optsys, wavefront)
+        if result is None: result = np.zeros((len(steps),) + npix)
+        for start in range(0, len(steps), chunk):
+            fields = []
+            for step in steps[start:start+chunk]:
+                variant = wavefront.copy()
+                step(variant)
+                fields.append(variant.wavefront)
+            images = mft_stack(np.asarray(fields), expYV, expXU, norm)
+            result[start:start+len(fields)] += weight * np.abs(images)**2
+    return result
+
+
+
+def calc_psf_offsets(optsys, wavelengths, weights, offset_r, offset_theta, normalize='first', chunk=8, cancel_token=None):
+    """ Broadband PSFs of a direct imaging optical system for many source positions, in one pass
+
+    A source offset is a tilt of the pupil wavefront, which by the Fourier shift theorem is
+    the same as shifting the grid of detector pixels the matrix Fourier transform evaluates.
+    So the pupil wavefront is computed once per wavelength, and each offset just needs its
+    own (small) MFT matrices. The products with the pupil for several offsets are done as
+    one matrix multiply.
+
+    Parameters
+    ----------
+    optsys : poppy.OpticalSystem
+        Optical system of pupil planes followed by a detector, with no source offset of its own
+    wavelengths, weights : iterables of floats
+        Wavelengths in meters and their relative weights
+    offset_r, offset_theta : floats or arrays
+        Source offsets in arcsec and position angles in degrees, as for poppy's
+        source_offset_r and source_offset_theta
+    normalize : string
+        Normalization, as for poppy: 'first' for unit total intensity at the entrance pupil
+    chunk : int
+        Number of offsets to transform at once; higher is faster but uses more memory
+    cancel_token : CancelToken, optional
+        Checked between wavelengths
+
+    Returns
+    -------
+    psfs : ndarray
+        Oversampled PSFs, shape (number of offsets, ny, nx)
+    """
+    check_direct_imaging(optsys)
+    offset_r, offset_theta = np.broadcast_arrays(np.atleast_1d(np.asarray(offset_r, dtype=np.float64)),
+                                                 np.atleast_1d(np.asarray(offset_theta, dtype=np.float64)))
+    # where the source lands on the detector, as poppy's inputWavefront tilts it, in oversampled pixels
+    detector = optsys.planes[-1]
+    pixelscale = detector.pixelscale / detector.oversample
+    shift_x = -offset_r * np.sin(np.radians(offset_theta)) / pixelscale
+    shift_y = offset_r * np.cos(np.radians(offset_theta)) / pixelscale
+
+    weights = np.asarray(weights, dtype=np.float64) / np.sum(weights)
+    result = None
+    for wavelength, weight in zip(wavelengths, weights):
+        if cancel_token is not None: cancel_token.check()
+        wavefront = pupil_wavefront(optsys, wavelength, normalize=normalize)
+        field = wavefront.wavefront
+        for start in range(0, len(offset_r), chunk):
+            indices = range(start, min(start + chunk, len(offset_r)))
+            # moving the source by +s pixels is evaluating the image at pixel coordinates -s
+            transforms = [detector_transform(optsys, wavefront, offset=(-shift_y[i], -shift_x[i])) for i in indices]
+            npix = transforms[0][3]
+            if result is None: result = np.zeros((len(offset_r),) + npix)
+            partial = np.dot(field, np.concatenate([t[1] for t in transforms], axis=1))
+            for j, i in enumerate(indices):
+                expYV, _, norm, _ = transforms[j]
+                image = norm * np.dot(expYV, partial[:, j*npix[1]:(j+1)*npix[1]])
+                result[i] += weight * np.abs(image)**2
+    return result
+
+
+def calc_psf_tiled(optsys, wavelengths, weights, tile=512, nworkers=1, out=None, filename=None, dtype=np.float64,
+        normalize='first', cancel_token=None):
+    """ Broadband PSF of a direct imaging optical system, computed in tiles, e.g. for very large fields of view
+
+    One wavelength at a time, the detector plane is computed in strips of `tile` rows, each
+    transformed from the pupil in tiles of `tile` columns with its own MFT matrices, and each
+    tile is added straight into the output array, which may be a memory-mapped file. So apart
+    from one pupil wavefront, memory use is proportional to the tile size rather than the field
+    of view. Strips are computed in parallel on threads. The result is the same as for `calc_psf`.
+
+    Parameters
+    ----------
+    optsys : poppy.OpticalSystem
+        Optical system of pupil planes followed by a detector
+    wavelengths, weights : iterables of floats
+        Wavelengths in meters and their relative weights
+    tile : int
+        Tile size in oversampled detector pixels
+    nworkers : int
+        Number of strips to compute at once; 0 means as many as there are CPUs.
+    out : 2D ndarray, optional
+        Array for the oversampled PSF, e.g. a np.memmap
+    filename : string, optional
+        Otherwise, a .npy file to memory-map for the PSF. Default is to allocate it in memory.
+    dtype : numpy dtype
+        Type of the output array, if this creates it. Each tile is computed in double precision,
+        and summed over wavelengths in this type.
+    normalize : string
+        Normalization, as for poppy: 'first' for unit total intensity at the entrance pupil
+    cancel_token : CancelToken, optional
+        Checked between strips
+
+    Returns
+    -------
+    psf : fits.HDUList
+        The PSF, with `out` (or the memory-mapped array) as its data. Any previous contents
+        of `out` are overwritten.
+    """
+    check_direct_imaging(optsys)
+    detector = optsys.planes[-1]
+    fov_pixels = detector.fov_pixels
+    if np.isscalar(fov_pixels): fov_pixels = (fov_pixels, fov_pixels)
+    npix = (int(fov_pixels[0] * detector.oversample), int(fov_pixels[1] * detector.oversample))
+    pixelscale = detector.pixelscale / detector.oversample
+    if out is None:
+        if filename is not None:
+            out = np.lib.format.open_memmap(filename, mode='w+', dtype=dtype, shape=npix)
+        else:
+            out = np.zeros(npix, dtype=dtype)
+    elif out.shape != npix:
+        raise ValueError("Output array of shape %s does not match the detector, %s" % (out.shape, npix))
+    weights = np.asarray(weights, dtype=np.float64) / np.sum(weights)
+
+    column_starts = range(0, npix[1], tile)
+    strip_starts = range(0, npix[0], tile)
+
+    def matrices(wavefront, start, size):
+        # MFT matrices for the tile of pixels from start to start+size, on the full detector grid: the spacing
+        # of the output pixels depends only on nlamD/npix, and the offset moves the tile center from the grid center
+        shape = wavefront.wavefront.shape
+        lamD = wavefront.wavelength / (shape[0] * wavefront.pixelscale) * _RADIANStoARCSEC
+        nlamD = (size[0] * pixelscale / lamD, size[1] * pixelscale / lamD)
+        offset = (start[0] + size[0]/2.0 - npix[0]/2.0, start[1] + size[1]/2.0 - npix[1]/2.0)
+        return utils.mft_matrices(shape, nlamD, size, offset=offset)
+
+    def compute_strip(args):
+        wavefront, weight, first, y0 = args
+        if cancel_token is not None: cancel_token.check()
+        ny = min(tile, npix[0] - y0)
+        expYV, _, norm = matrices(wavefront, (y0, 0), (ny, 1))
+        rows = np.dot(expYV, wavefront.wavefront)
+        for x0 in column_starts:
+            nx = min(tile, npix[1] - x0)
+            _, expXU, _ = matrices(wavefront, (y0, x0), (1, nx))
+            intensity = weight * np.abs(norm * np.dot(rows, expXU))**2
+            # the first wavelength overwrites whatever was in the output before
+            if first: out[y0:y0+ny, x0:x0+nx] = intensity
+            else: out[y0:y0+ny, x0:x0+nx] += intensity
+
+    if nworkers == 0: nworkers = multiprocessing.cpu_count()
+    nworkers = min(nworkers, len(strip_starts))
+    _log.info("Computing a %d x %d pixel PSF in %d x %d pixel tiles, %d strip(s) at a time" % (npix[1], npix[0], tile, tile, nworkers))
+    pool = multiprocessing.pool.ThreadPool(nworkers) if nworkers > 1 else None
+    try:
+        for i, (wavelength, weight) in enumerate(zip(wavelengths, weights)):
+            # only one pupil wavefront is needed at a time, shared by all the tiles
+            wavefront = pupil_wavefront(optsys, wavelength, normalize=normalize)
+            tasks = [(wavefront, weight, i == 0, y0) for y0 in strip_starts]
+            if pool is not None:
+                pool.map(compute_strip, tasks)
+            else:
+                for task in tasks: compute_strip(task)
+            del wavefront, tasks
+    finally:
+        if pool is not None: pool.terminate()
+
+    header = fits.Header()
+    header.update('PIXELSCL', pixelscale, 'Pixel scale in arcsec/pixel')
+    header.update('PIXUNIT', 'arcsecond', 'Pixel scale units')
+    header.update('OVERSAMP', detector.oversample, 'Oversampling factor relative to detector pixels')
+    header.update('DET_SAMP', detector.oversample, 'Oversampling factor for MFT to detector plane')
+    _broadband_keywords(header, np.asarray(wavelengths, dtype=np.float64), weights, normalize)
+    header.update('TILESIZE', tile, 'Tile size in pixels for the detector MFT')
+    header.update('NTILES', len(strip_starts) * len(column_starts), 'Number of detector tiles')
+    if isinstance(out, np.memmap) and out.filename is not None:
+        header.update('TILEFILE', os.path.basename(out.filename), 'Memory-mapped file holding the PSF')
+    return fits.HDUList([fits.PrimaryHDU(data=out, header=header)])
+
+def display_intermediates(intermediates):
+    """ Display the wavefront at each plane of a propagation, as poppy does with display_intermediates=True
+
+    This must be called from the main thread, e.g. from a calc_psf callback.
+    """
+    import matplotlib.pyplot as plt
+    plt.clf()
+    for i, wavefront in enumerate(intermediates):
+        wavefront.display(what='best', nrows=len(intermediates), row=i+1, colorbar=False)
+    plt.draw()
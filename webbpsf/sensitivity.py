@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+"""
+sensitivity.py
+
+    Linear sensitivity of PSFs to wavefront modes.
+
+    For a pupil field E = A exp(i 2 pi W / lambda) and small extra OPD
+    sum_k c_k M_k, the detector intensity changes to first order by
+    sum_k c_k dI/dc_k, where
+
+        dI/dc_k = 2 Re( conj(F[E]) F[i (2 pi / lambda) M_k E] )
+
+    and F is the matrix Fourier transform to the detector. `psf_jacobian`
+    evaluates this analytically for every mode and wavelength in one pass,
+    rather than by finite differences (which would take two propagations per
+    mode), giving a Jacobian cube from which approximate PSFs follow by a matrix
+    multiply:
+
+        >>> jac = nc.calcPSF_jacobian(modes='zernike', nterms=11)
+        >>> psf = sensitivity.linear_psf(jac, [0, 0, 0, 10e-9])
+
+    Modes may be any of the bases in `webbpsf.wfe` (Zernikes, hexikes, segment
+    poses), or an arbitrary cube of OPD maps in meters on the pupil grid.
+
+    Only direct imaging is supported, i.e. optical systems that consist of
+    pupil planes followed by the detector; coronagraphs and other systems with
+    intermediate image planes are not linear in this simple way.
+
+"""
+import numpy as np
+import scipy.ndimage
+import astropy.io.fits as fits
+
+from . import wfe
+from . import propagation
+
+import logging
+_log = logging.getLogger('webbpsf')
+
+
+class _ModeMaps(object):
+    """ OPD maps in meters for a set of modes, produced a few at a time on the wavefront grid """
+    def __init__(self, modes, shape, rotation=None):
+        self.modes = modes
+        self.shape = shape
+        self.rotation = rotation
+        if isinstance(modes, wfe._PupilBasis):
+            self.nmodes = modes.matrix.shape[1]
+            self.names = modes.names
+        else:
+            self.modes = np.asarray(modes, dtype=np.float64)
+            if self.modes.ndim == 2: self.modes = self.modes[np.newaxis]
+            self.nmodes = self.modes.shape[0]
+            self.names = ['M%d' % k for k in range(self.nmodes)]
+
+    def get(self, indices):
+        if isinstance(self.modes, wfe._PupilBasis):
+            maps = wfe._PupilBasis.opd(self.modes, np.eye(self.nmodes)[indices])
+        else:
+            maps = self.modes[indices]
+        if self.rotation:
+            # match the rotation poppy applies to the pupil and OPD
+            maps = np.asarray([scipy.ndimage.rotate(m, self.rotation, reshape=False) for m in maps])
+        if maps.shape[1:] != self.shape:
+            # center the maps in a larger (padded) wavefront array
+            padded = np.zeros((maps.shape[0],) + self.shape)
+            y0, x0 = (self.shape[0] - maps.shape[1]) // 2, (self.shape[1] - maps.shape[2]) // 2
+            if y0 < 0 or x0 < 0:
+                raise ValueError("Mode maps of shape %s are larger than the wavefront %s" % (maps.shape[1:], self.shape))
+            padded[:, y0:y0+maps.shape[1], x0:x0+maps.shape[2]] = maps
+            maps = padded
+        return maps
+
+
+def psf_jacobian(optsys, wavelengths, weights, modes, normalize='first', rotation=None, chunk=8):
+    """ PSF and its derivatives with respect to wavefront modes, summed over wavelengths
+
+    Parameters
+    ----------
+    optsys : poppy.OpticalSystem
+        Optical system of pupil planes followed by a detector
+    wavelengths, weights : iterables of floats
+        Wavelengths in meters and their relative weights
+    modes : wfe basis, or ndarray
+        A basis from `webbpsf.wfe` (e.g. `wfe.get_modal_basis('zernike', 11)`), or a cube
+        of OPD maps in meters on the grid of the entrance pupil
+    normalize : string
+        Normalization, as for poppy: 'first' for unit total intensity at the entrance pupil
+    rotation : float, optional
+        Rotation in degrees that the optical system applies to the entrance pupil, to
+        apply likewise to the mode maps
+    chunk : int
+        Number of modes to transform at once; higher is faster but uses more memory
+
+    Returns
+    -------
+    psf : ndarray
+        Oversampled PSF, shape (ny, nx)
+    jacobian : ndarray
+        Derivative of the PSF with respect to each mode coefficient, shape (nmodes, ny, nx),
+        per meter of OPD for maps, or per unit coefficient for a basis
+    """
+    propagation.check_direct_imaging(optsys)
+    weights = np.asarray(weights, dtype=np.float64) / np.sum(weights)
+
+    psf = None
+    for wavelength, weight in zip(wavelengths, weights):
+        # the pupil planes are just multiplied in, so each mode's derivative field in the
+        # last pupil plane is i k M E, wherever the modes are applied
+        wavefront = propagation.pupil_wavefront(optsys, wavelength, normalize=normalize)
+        field = wavefront.wavefront
+        expYV, expXU, norm, npix = propagation.detector_transform(optsys, wavefront)
+        if psf is None:
+            maps = _ModeMaps(modes, field.shape, rotation=rotation)
+            psf = np.zeros(npix)
+            jacobian = np.zeros((maps.nmodes,) + npix)
+
+        image = norm * np.dot(np.dot(expYV, field), expXU)
+        psf += weight * np.abs(image)**2
+        k = 2 * np.pi / wavelength
+        for start in range(0, maps.nmodes, chunk):
+            indices = np.arange(start, min(start + chunk, maps.nmodes))
+            dimage = propagation.mft_stack(1j * k * maps.get(indices) * field, expYV, expXU, norm)
+            jacobian[indices] += weight * 2 * np.real(np.conj(image) * dimage)
+    return psf, jacobian
+
+
+def linear_psf(jacobian_hdulist, coeffs, ext=0):
+    """ Approximate PSF for mode coefficients, from a result of `JWInstrument.calcPSF_jacobian`
+
+    Parameters
+    ----------
+    jacobian_hdulist : fits.HDUList
+        PSF and Jacobian, as computed by calcPSF_jacobian
+    coeffs : ndarray
+        Coefficient for each mode, or an array of coefficient vectors to get a cube of PSFs
+    ext : int or string
+        0 for the oversampled PSF, or 'DET_SAMP' for the detector-sampled one
+    """
+    jacobian = jacobian_hdulist['JAC_DET' if ext == 'DET_SAMP' else 'JACOBIAN'].data
+    coeffs = np.asarray(coeffs, dtype=np.float64)
+    return jacobian_hdulist[ext].data + np.tensordot(coeffs, jacobian, axes=(-1, 0))
@@ -0,0 +1,419 @@
+#!/usr/bin/env python
+"""
+server.py
+
+    A long-lived local PSF server, keeping instruments and data warm between requests.
+
+    Starting Python, importing webbpsf, reading an instrument's filter lists,
+    loading the pupil and OPD files, and computing source spectrum weights all
+    take time, which is wasted when each step of a pipeline computes only one PSF
+    in a new process. Instead, start a server once per node:
+
+        webbpsf serve --socket /tmp/webbpsf.sock
+        webbpsf serve --port 8765
+
+    and request PSFs from it with a `PSFClient`:
+
+        >>> client = webbpsf.server.PSFClient('/tmp/webbpsf.sock')
+        >>> psf = client.calcPSF('NIRCam', filter='F200W', fov_arcsec=5, oversample=4)
+
+    The server computes PSFs on a pool of worker threads. Each worker keeps its
+    own instances of each instrument, plus caches of optical systems and of
+    wavelength weights for recently used configurations, so only the first
+    request for any configuration pays the setup costs.
+
+    Workers running at once change global state such as poppy.settings and thread
+    caps only under the lock in `webbpsf.tuning`, and each gets an equal share of the
+    memory budget.
+
+    Protocol: the client sends a request as one line of JSON; the server replies
+    with one line of JSON, followed by a binary payload of the number of bytes
+    given in its 'nbytes' field. The payload is either a FITS file, or for
+    format='array' the raw bytes of each image extension in turn, as described
+    by the 'arrays' field. The server only listens on a Unix socket or on
+    localhost, and never unpickles anything.
+
+"""
+import os
+import io
+import json
+import time
+import socket
+import threading
+import collections
+import SocketServer
+import Queue
+
+import numpy as np
+import astropy.io.fits as fits
+
+import logging
+_log = logging.getLogger('webbpsf')
+
+from . import settings
+from . import propagation
+from . import webbpsf_core
+
+
+# calcPSF arguments a request may set
+_CALC_ARGS = ['filter', 'nlambda', 'monochromatic', 'fov_arcsec', 'fov_pixels', 'oversample', 'detector_oversample',
+              'fft_oversample', 'rebin', 'precision', 'output_dtype', 'output_oversampled', 'normalize']
+
+
+class _LRUCache(object):
+    """ A small least-recently-used cache """
+    def __init__(self, size):
+        self.size = size
+        self._items = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, compute):
+        if key in self._items:
+            self.hits += 1
+            value = self._items.pop(key)
+        else:
+            self.misses += 1
+            value = compute()
+            if len(self._items) >= self.size: self._items.popitem(last=False)
+        self._items[key] = value
+        return value
+
+
+def _key(*values):
+    return json.dumps(values, sort_keys=True, default=repr)
+
+
+class _Worker(threading.Thread):
+    """ Worker thread holding warm instruments and caches """
+    def __init__(self, server_state, cache_size):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.state = server_state
+        self.instruments = {}
+        self.optsys_cache = _LRUCache(cache_size)
+        self.weights_cache = _LRUCache(cache_size*4)
+
+    def run(self):
+        while True:
+            request, reply = self.state.queue.get()
+            if request is None: return
+            try:
+                reply.put(('ok', self.compute(request)))
+            except Exception as e:
+                _log.exception("PSF server request failed")
+                reply.put(('error', "%s: %s" % (e.__class__.__name__, e)))
+
+    def instrument(self, request):
+        """ A warm instrument configured as requested """
+        name = request['instrument']
+        if name.lower() not in self.instruments:
+            inst = webbpsf_core.Instrument(name)
+            defaults = {'filter': inst.filter, 'pupilopd': inst.pupilopd,
+                        'detector': inst.detector if inst._detector is not None else None}
+            self.instruments[name.lower()] = (inst, defaults)
+        inst, defaults = self.instruments[name.lower()]
+
+        # anything a request leaves out goes back to the default, not to whatever the last request set
+        inst.filter = request.get('filter', defaults['filter'])
+        if defaults['detector'] is not None: inst.detector = defaults['detector']
+        inst.image_mask = request.get('image_mask', None)
+        inst.pupil_mask = request.get('pupil_mask', None)
+        opd = request.get('pupilopd', defaults['pupilopd'])
+        inst.pupilopd = tuple(opd) if isinstance(opd, list) else opd
+        inst.options = dict(request.get('options', {}))
+
+        # the optical system depends only on the configuration, so reuse it when nothing has changed
+        worker = self
+        def cached_getOpticalSystem(*args, **kwargs):
+            # as the uncached method would, e.g. to update the NIRCam pixel scale for the filter
+            inst._validate_config()
+            key = _key(name.lower(), inst.filter, inst.image_mask, inst.pupil_mask, inst.pupilopd, inst.options, inst.pixelscale,
+                    args, dict([(k, v) for k, v in kwargs.items() if k != 'options']), kwargs.get('options'))
+            return worker.optsys_cache.get(key, lambda: type(inst)._getOpticalSystem(inst, *args, **kwargs))
+        def cached_getWeights(source=None, nlambda=5, monochromatic=None, **kwargs):
+            if source is not None and not isinstance(source, basestring):
+                return type(inst)._getWeights(inst, source=source, nlambda=nlambda, monochromatic=monochromatic, **kwargs)
+            key = _key(name.lower(), inst.filter, source, nlambda, monochromatic)
+            return worker.weights_cache.get(key, lambda: type(inst)._getWeights(inst,
+                source=None if source is None else worker.spectrum(source), nlambda=nlambda, monochromatic=monochromatic, **kwargs))
+        inst._getOpticalSystem = cached_getOpticalSystem
+        inst._getWeights = cached_getWeights
+        return inst
+
+    def spectrum(self, sptype):
+        return webbpsf_core.poppy.specFromSpectralType(sptype)
+
+    def compute(self, request):
+        inst = self.instrument(request)
+        kwargs = dict([(k, v) for k, v in request.get('calcPSF', {}).items() if k in _CALC_ARGS])
+        for k in ('fov_arcsec', 'fov_pixels'):
+            if isinstance(kwargs.get(k), list): kwargs[k] = tuple(kwargs[k])
+        if request.get('source') is not None: kwargs['source'] = request['source']
+        t0 = time.time()
+        # the workers compute at once, so each may use only its share of the memory budget
+        with propagation.budget_share(1.0 / self.state.nworkers):
+            result = inst.calcPSF(**kwargs)
+        self.state.record(time.time() - t0)
+        return result
+
+
+class _State(object):
+    """ State shared between the request handlers and the workers """
+    def __init__(self):
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.nworkers = 1
+        self.nrequests = 0
+        self.compute_time = 0.0
+        self.started = time.time()
+
+    def record(self, elapsed):
+        with self.lock:
+            self.nrequests += 1
+            self.compute_time += elapsed
+
+
+def _encode_result(result, format='fits'):
+    """ Return (description dict, payload bytes) for an HDUList """
+    if format == 'array':
+        arrays = []
+        chunks = []
+        for i, hdu in enumerate(result):
+            if not isinstance(hdu, (fits.PrimaryHDU, fits.ImageHDU)) or hdu.data is None: continue
+            data = np.ascontiguousarray(hdu.data)
+            arrays.append({'name': hdu.header.get('EXTNAME', 'PRIMARY' if i == 0 else str(i)),
+                           'shape': list(data.shape), 'dtype': data.dtype.str, 'nbytes': data.nbytes})
+            chunks.append(data.tobytes() if hasattr(data, 'tobytes') else data.tostring())
+        header = dict([(k, v) for k, v in result[0].header.items()
+                       if isinstance(v, (bool, int, long, float, basestring)) and k not in ('HISTORY', 'COMMENT', '')])
+        return {'format': 'array', 'arrays': arrays, 'header': header}, b''.join(chunks)
+    else:
+        buf = io.BytesIO()
+        result.writeto(buf)
+        return {'format': 'fits'}, buf.getvalue()
+
+
+def _decode_result(description, payload):
+    if description['format'] == 'array':
+        arrays = collections.OrderedDict()
+        offset = 0
+        for a in description['arrays']:
+            arrays[a['name']] = np.frombuffer(payload[offset:offset+a['nbytes']], dtype=a['dtype']).reshape(a['shape'])
+            offset += a['nbytes']
+        return arrays, description['header']
+    else:
+        return fits.open(io.BytesIO(payload))
+
+
+def _send(sock, description, payload=b''):
+    description = dict(description, nbytes=len(payload))
+    sock.sendall(json.dumps(description).encode('utf-8') + b'\n' + payload)
+
+
+def _recv_exactly(rfile, nbytes):
+    data = rfile.read(nbytes)
+    if len(data) != nbytes: raise IOError("Connection closed after %d of %d bytes" % (len(data), nbytes))
+    return data
+
+
+class _Handler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        # a client may send any number of requests on one connection
+        while True:
+            line = self.rfile.readline()
+            if not line: return
+            try:
+                request = json.loads(line)
+            except ValueError:
+                _send(self.request, {'status': 'error', 'error': 'Request is not valid JSON'})
+                continue
+            command = request.get('command', 'calcPSF')
+            if command == 'ping':
+                _send(self.request, {'status': 'ok', 'pid': os.getpid()})
+            elif command == 'stats':
+                _send(self.request, dict(self.server.stats(), status='ok'))
+            elif command == 'shutdown':
+                _send(self.request, {'status': 'ok'})
+                threading.Thread(target=self.server.shutdown).start()
+                return
+            elif command == 'calcPSF':
+                reply = Queue.Queue()
+                self.server.state.queue.put((request, reply))
+                status, result = reply.get()
+                if status == 'ok':
+                    try:
+                        description, payload = _encode_result(result, request.get('format', 'fits'))
+                    except Exception as e:
+                        _log.exception("PSF server could not encode result")
+                        status, result = 'error', "%s: %s" % (e.__class__.__name__, e)
+                if status == 'ok':
+                    _send(self.request, dict(description, status='ok'), payload)
+                else:
+                    _send(self.request, {'status': 'error', 'error': result})
+            else:
+                _send(self.request, {'status': 'error', 'error': 'Unknown command %s' % command})
+
+
+class _ServerMixin(object):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def start_workers(self, nworkers, cache_size, preload=()):
+        self.state = _State()
+        self.state.nworkers = nworkers
+        self.workers = [_Worker(self.state, cache_size) for i in range(nworkers)]
+        for worker in self.workers:
+            for name in preload:
+                worker.instrument({'instrument': name})
+            worker.start()
+
+    def stats(self):
+        with self.state.lock:
+            stats = {'workers': len(self.workers), 'requests': self.state.nrequests,
+                     'compute_time': self.state.compute_time, 'uptime': time.time() - self.state.started,
+                     'queued': self.state.queue.qsize()}
+        stats['optsys_cache'] = {'hits': sum([w.optsys_cache.hits for w in self.workers]),
+                                 'misses': sum([w.optsys_cache.misses for w in self.workers])}
+        stats['weights_cache'] = {'hits': sum([w.weights_cache.hits for w in self.workers]),
+                                  'misses': sum([w.weights_cache.misses for w in self.workers])}
+        return stats
+
+    def stop_workers(self):
+        for worker in self.workers: self.state.queue.put((None, None))
+
+
+class _TCPServer(_ServerMixin, SocketServer.ThreadingTCPServer): pass
+
+if hasattr(SocketServer, 'ThreadingUnixStreamServer'):
+    class _UnixServer(_ServerMixin, SocketServer.ThreadingUnixStreamServer): pass
+
+
+def make_server(socket_path=None, port=None, host='127.0.0.1', nworkers=None, cache_size=8, preload=()):
+    """ Create a PSF server listening on a Unix socket or a localhost TCP port
+
+    Parameters
+    ----------
+    socket_path : string, optional
+        Path of a Unix domain socket to listen on.
+    port : int, optional
+        TCP port to listen on, if socket_path is not given. Use 0 to pick a free port.
+    host : string
+        Address to listen on for TCP. Only change this from localhost on a trusted network,
+        since anyone who can connect can make the server compute (and read files for) PSFs.
+    nworkers : int, optional
+        Number of worker threads computing PSFs. Default is `settings.n_processes`.
+    cache_size : int
+        Number of optical systems to keep for each worker; four times as many sets of weights are kept.
+    preload : list of strings
+        Instrument names to create in every worker before starting.
+
+    Returns
+    -------
+    server : SocketServer server
+        Call its serve_forever() method to start handling requests.
+    """
+    if nworkers is None or nworkers < 1: nworkers = max(settings.n_processes(), 1)
+    if socket_path is not None:
+        if os.path.exists(socket_path): os.remove(socket_path)
+        server = _UnixServer(socket_path, _Handler)
+        os.chmod(socket_path, 0600)
+    else:
+        server = _TCPServer((host, port or 0), _Handler)
+    server.start_workers(nworkers, cache_size, preload)
+    return server
+
+
+def serve(socket_path=None, port=None, host='127.0.0.1', nworkers=None, cache_size=8, preload=()):
+    """ Run a PSF server until interrupted. See `make_server` for the parameters. """
+    server = make_server(socket_path, port, host, nworkers, cache_size, preload)
+    address = socket_path if socket_path is not None else "%s:%d" % server.server_address[:2]
+    _log.info("WebbPSF server listening on %s with %d workers" % (address, len(server.workers)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop_workers()
+        server.server_close()
+        if socket_path is not None and os.path.exists(socket_path): os.remove(socket_path)
+
+
+class PSFClient(object):
+    """ Client for a PSF server
+
+    Parameters
+    ----------
+    address : string or (host, port) tuple
+        Path of the server's Unix socket, or its TCP address. A string of the form
+        'host:port' is also accepted.
+    timeout : float, optional
+        Socket timeout in seconds
+    """
+    def __init__(self, address, timeout=None):
+        if isinstance(address, basestring) and ':' in address and not os.path.exists(address):
+            host, port = address.rsplit(':', 1)
+            address = (host, int(port))
+        if isinstance(address, basestring):
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.settimeout(timeout)
+        self._sock.connect(address)
+        self._rfile = self._sock.makefile('rb')
+
+    def _request(self, request):
+        self._sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        line = self._rfile.readline()
+        if not line: raise IOError("PSF server closed the connection")
+        description = json.loads(line)
+        payload = _recv_exactly(self._rfile, description['nbytes'])
+        if description['status'] != 'ok':
+            raise RuntimeError("PSF server error: " + description.get('error', 'unknown'))
+        return description, payload
+
+    def calcPSF(self, instrument, filter=None, image_mask=None, pupil_mask=None, pupilopd=None, options=None,
+            source=None, format='fits', **kwargs):
+        """ Compute a PSF on the server
+
+        Parameters
+        ----------
+        instrument : string
+            Instrument name
+        filter, image_mask, pupil_mask, pupilopd : optional
+            Instrument configuration. pupilopd may be a filename or (filename, slice); the
+            instrument's default OPD is used if it is not given.
+        options : dict, optional
+            Instrument options, such as source_offset_r
+        source : string, optional
+            Spectral type of the source, e.g. 'G2V'
+        format : string
+            'fits' to return an HDUList, or 'array' to return an ordered dict of arrays
+            by extension name and a dict of the primary header keywords, which avoids
+            FITS encoding and decoding.
+
+        Other keyword arguments (fov_arcsec, oversample, nlambda, etc.) are passed to calcPSF.
+        """
+        request = {'command': 'calcPSF', 'instrument': instrument, 'image_mask': image_mask,
+                   'pupil_mask': pupil_mask, 'options': options or {}, 'calcPSF': kwargs, 'format': format}
+        if filter is not None: request['filter'] = filter
+        if pupilopd is not None: request['pupilopd'] = pupilopd
+        if source is not None: request['source'] = source
+        unknown = [k for k in kwargs if k not in _CALC_ARGS]
+        if len(unknown) > 0: raise ValueError("Unsupported calcPSF arguments for the PSF server: " + ", ".join(unknown))
+        return _decode_result(*self._request(request))
+
+    def ping(self):
+        return self._request({'command': 'ping'})[0]
+
+    def stats(self):
+        """ Number of requests, compute time, and cache hits and misses on the server """
+        return self._request({'command': 'stats'})[0]
+
+    def shutdown(self):
+        """ Ask the server to stop """
+        self._request({'command': 'shutdown'})
+
+    def close(self):
+        self._rfile.close()
+        self._sock.close()
@@ -1,3 +1,4 @@
+import threading
 import astropy.config
 
 # Package-global configuration items here.
@@ -10,6 +11,8 @@ WEBBPSF_PATH = astropy.config.ConfigurationItem('webbpsf_data_path','unknown','D
 default_oversampling = astropy.config.ConfigurationItem('default_oversampling', 4, 'Default oversampling factor: number of times more finely sampled than an integer pixel for the grid spacing in the PSF calculation.')
 default_output_mode = astropy.config.ConfigurationItem('default_output_mode', 'Both as FITS extensions', "Should output include the oversampled PSF, a copy rebinned onto the integer detector spacing, or both? Options: 'oversampled','detector','both' ")
 default_fov_arcsec = astropy.config.ConfigurationItem('default_fov_arcsec', 5.0, "Default field of view size, in arcseconds per side of the square ")
+output_dtype = astropy.config.ConfigurationItem('output_dtype', 'float64', "Data type for output PSF images: 'float64', or 'float32' for files half the size. This only converts the output images; the propagation precision is set by the precision setting.")
+output_compression = astropy.config.ConfigurationItem('output_compression', 'none', "FITS tile compression for output files: 'none', 'GZIP_2' (lossless, recommended), 'GZIP_1' (lossless), or 'RICE_1' (lossy for floating point data).")
 
 
 
@@ -17,10 +20,19 @@ default_fov_arcsec = astropy.config.ConfigurationItem('default_fov_arcsec', 5.0,
 #   see _apply_settings_to_poppy below...
 use_multiprocessing= astropy.config.ConfigurationItem('use_multiprocessing', False, 'Should PSF calculations run in parallel using the Python multiprocessing framework (if True; faster but does not allow display of each wavelength) or run serially in a single process (if False; slower but shows the calculation in progress. Also a bit more robust.?)')
 n_processes= astropy.config.ConfigurationItem('n_processes', 4, 'Maximum number of additional worker processes to spawn. PSF calculations are likely RAM limited more than CPU limited for higher N on modern machines, particularly for oversampling >=4. Set to 0 to have the computer attempt to choose an intelligent default based on available cores and RAM.')
+use_threads = astropy.config.ConfigurationItem('use_threads', False, 'Compute wavelengths in parallel on a pool of threads within this process, rather than in separate processes? Threads can be used from the GUIs and allow displaying each wavelength as it completes. The number of threads is set by n_processes.')
 use_fftw = astropy.config.ConfigurationItem('use_fftw', True, 'Use FFTW for FFTs (assuming it is available)?  Set to False to force numpy.fft always, True to try importing and using FFTW via PyFFTW.')
+precision = astropy.config.ConfigurationItem('precision', 'double', "Floating point precision for propagating wavefronts: 'double' (complex128) or 'single' (complex64 wavefronts, with errors below 1e-5 of the PSF peak; poppy's FFTs and matrix Fourier transforms still produce complex128 temporaries, so peak memory is only modestly lower). Broadband sums are always accumulated in double precision.")
+max_memory = astropy.config.ConfigurationItem('max_memory', 0.0, 'Maximum total memory in GB for a PSF calculation, across all worker processes. The number of wavelengths computed in parallel is reduced as needed to stay within this. Set to 0 to use 80% of the currently available RAM (requires psutil).')
+fftw_wisdom = astropy.config.ConfigurationItem('fftw_wisdom', True, 'Save FFTW planning information ("wisdom") to the webbpsf config directory, and reuse it in later sessions and worker processes?')
+autotune = astropy.config.ConfigurationItem('autotune', True, 'Use the parallelization settings measured by webbpsf.tuning.calibrate() for this machine, if available, instead of use_multiprocessing, n_processes and use_fftw?')
 
 
 
+# Guards process-wide state, such as poppy.settings, that concurrent calculations in threads share
+_lock = threading.RLock()
+
+
 def _apply_settings_to_poppy():
     """Use webbpsf's settings to override any of the
     same settings in poppy. This is admittedly perhaps overbuilt to have identical
@@ -31,10 +43,11 @@ def _apply_settings_to_poppy():
 
     import poppy
 
-    poppy.settings.use_multiprocessing.set(  use_multiprocessing() )
-    poppy.settings.n_processes.set(  n_processes() )
-    poppy.settings.use_fftw.set(  use_fftw() )
-    poppy.settings.default_image_display_fov.set (default_fov_arcsec() )
+    with _lock:
+        poppy.settings.use_multiprocessing.set(  use_multiprocessing() )
+        poppy.settings.n_processes.set(  n_processes() )
+        poppy.settings.use_fftw.set(  use_fftw() )
+        poppy.settings.default_image_display_fov.set (default_fov_arcsec() )
  
 
 def get_webbpsf_data_path():
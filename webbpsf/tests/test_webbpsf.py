@@ -226,6 +226,796 @@ class Test_nircam_coron(unittest.TestCase):
         _log.info("Lots of test files output as test_nircam_*.fits")
 
 
+class Test_Slit_SAM(unittest.TestCase):
+    " Compare semi-analytic slit propagation against brute-force FFTs "
+
+    def do_test_slit(self, iname, image_mask, pupil_mask, wavelength):
+        inst = webbpsf.Instrument(iname)
+        inst.pupilopd = None
+        inst.image_mask = image_mask
+        inst.pupil_mask = pupil_mask
+
+        inst.options['no_sam'] = False
+        psf_sam = inst.calcPSF(monochromatic=wavelength, oversample=2, fov_arcsec=2)
+        self.assertTrue(isinstance(inst.optsys, webbpsf.webbpsf_core.SemiAnalyticSlit))
+
+        inst.options['no_sam'] = True
+        psf_fft = inst.calcPSF(monochromatic=wavelength, oversample=2, fov_arcsec=2)
+        self.assertFalse(isinstance(inst.optsys, webbpsf.webbpsf_core.SemiAnalyticSlit))
+
+        # agreement to within the pixelization of the slit edges
+        self.assertAlmostEqual(psf_sam[0].data.sum()/psf_fft[0].data.sum(), 1.0, 2)
+        self.assertTrue(np.abs(psf_sam[0].data - psf_fft[0].data).max() < 0.01*psf_fft[0].data.max())
+
+    test_nirspec_s200a1 = lambda self : self.do_test_slit('NIRSpec', 'S200A1', 'NIRSpec grating', 2e-6)
+    test_nirspec_msa = lambda self : self.do_test_slit('NIRSpec', 'Single MSA open shutter', 'NIRSpec grating', 2e-6)
+    test_miri_lrs = lambda self : self.do_test_slit('MIRI', 'LRS slit', 'P750L LRS grating', 8e-6)
+
+    def test_no_pupil_stop(self):
+        # without the grating there is no pupil stop after the slit, so FFTs are used, without any warning
+        import logging
+        warnings = []
+        class Collect(logging.Handler):
+            def emit(self, record):
+                if record.levelno >= logging.WARNING: warnings.append(record)
+        handler = Collect()
+        logging.getLogger('webbpsf').addHandler(handler)
+        try:
+            inst = webbpsf.NIRSpec()
+            inst.pupilopd = None
+            inst.image_mask = 'S200A1'
+            inst.pupil_mask = None
+            inst.calcPSF(monochromatic=2e-6, oversample=2, fov_arcsec=2)
+        finally:
+            logging.getLogger('webbpsf').removeHandler(handler)
+        self.assertFalse(isinstance(inst.optsys, webbpsf.webbpsf_core.SemiAnalyticSlit))
+        self.assertEqual([r.getMessage() for r in warnings if 'Semi-Analytic' in r.getMessage()], [])
+
+
+class Test_Memory_Schedule(unittest.TestCase):
+    " Check that wavelengths are scheduled within the memory budget "
+
+    def test_estimate_scales_with_oversampling(self):
+        miri = webbpsf.MIRI()
+        miri.image_mask = 'FQPM1065'
+        miri.pupil_mask = 'MASKFQPM'
+        mem2 = webbpsf.propagation.estimate_memory_per_wavelength(miri._getOpticalSystem(fft_oversample=2))
+        mem4 = webbpsf.propagation.estimate_memory_per_wavelength(miri._getOpticalSystem(fft_oversample=4))
+        # dominated by the padded FFT arrays, which scale as oversample**2
+        self.assertTrue(3.5 < mem4/mem2 < 4.1)
+
+    def test_schedule_within_budget(self):
+        nc = webbpsf.NIRCam()
+        osys = nc._getOpticalSystem(fft_oversample=2, fov_arcsec=2)
+        per_wavelength = webbpsf.propagation.estimate_memory_per_wavelength(osys)
+
+        nworkers, _ = webbpsf.propagation.plan_schedule(osys, 10, 8, budget=None)
+        self.assertEqual(nworkers, 8)
+        nworkers, _ = webbpsf.propagation.plan_schedule(osys, 10, 8, budget=3.5*per_wavelength)
+        self.assertEqual(nworkers, 3)
+        nworkers, _ = webbpsf.propagation.plan_schedule(osys, 2, 8, budget=None)
+        self.assertEqual(nworkers, 2)
+        nworkers, _ = webbpsf.propagation.plan_schedule(osys, 10, 8, budget=0.5*per_wavelength)
+        self.assertEqual(nworkers, 0)
+
+    def test_limited_memory_result(self):
+        nc = webbpsf.NIRCam()
+        nc.pupilopd = None
+        psf1 = nc.calcPSF(nlambda=3, fov_arcsec=2, oversample=2)
+        webbpsf.settings.max_memory.set(1e-6) # forces serial calculation
+        try:
+            psf2 = nc.calcPSF(nlambda=3, fov_arcsec=2, oversample=2)
+        finally:
+            webbpsf.settings.max_memory.set(0)
+        # too small even for single precision, so it stays in double and runs serially
+        self.assertEqual(psf2[0].header['NPROCESS'], 1)
+        self.assertEqual(psf2[0].header['PRECISIO'], 'double')
+        self.assertTrue(np.allclose(psf1[0].data, psf2[0].data))
+
+    def test_single_precision_fallback(self):
+        nc = webbpsf.NIRCam()
+        nc.pupilopd = None
+        osys = nc._getOpticalSystem(fft_oversample=2, detector_oversample=2, fov_arcsec=2)
+        double = webbpsf.propagation.estimate_memory_per_wavelength(osys, precision='double')
+        single = webbpsf.propagation.estimate_memory_per_wavelength(osys, precision='single')
+        self.assertTrue(single < double)
+
+        psf1 = nc.calcPSF(nlambda=3, fov_arcsec=2, oversample=2)
+        webbpsf.settings.max_memory.set(0.5*(single+double)/2**30) # fits one wavelength only in single precision
+        try:
+            psf2 = nc.calcPSF(nlambda=3, fov_arcsec=2, oversample=2)
+        finally:
+            webbpsf.settings.max_memory.set(0)
+        self.assertEqual(psf2[0].header['PRECISIO'], 'single')
+        self.assertEqual(psf2[0].header['NPROCESS'], 1)
+        self.assertTrue(np.abs(psf1[0].data - psf2[0].data).max() < 1e-5*psf1[0].data.max())
+
+    def test_threads_match_serial(self):
+        nc = webbpsf.NIRCam()
+        nc.pupilopd = None
+        psf1 = nc.calcPSF(nlambda=4, fov_arcsec=2, oversample=2)
+
+        results = []
+        webbpsf.settings.use_threads.set(True)
+        try:
+            psf2 = nc.calcPSF(nlambda=4, fov_arcsec=2, oversample=2, wavelength_callback=results.append)
+        finally:
+            webbpsf.settings.use_threads.set(False)
+        self.assertEqual(sorted([r.index for r in results]), range(4))
+        self.assertTrue(np.allclose(psf1[0].data, psf2[0].data))
+
+
+class Test_Progress_Cancel(unittest.TestCase):
+    " Check progress reporting and cooperative cancellation of calcPSF "
+
+    def test_progress_events(self):
+        nc = webbpsf.NIRCam()
+        nc.pupilopd = None
+        events = []
+        psf = nc.calcPSF(nlambda=3, fov_arcsec=2, oversample=2, progress_callback=events.append)
+        wavelength_events = [e for e in events if e.kind == 'wavelength']
+        plane_events = [e for e in events if e.kind == 'plane']
+        self.assertEqual([e.ncompleted for e in wavelength_events], [1, 2, 3])
+        self.assertEqual(len(plane_events), 3*len(nc.optsys.planes))
+        self.assertTrue(all([e.elapsed >= 0 for e in events]))
+
+    def test_cancel(self):
+        nc = webbpsf.NIRCam()
+        nc.pupilopd = None
+        token = webbpsf.propagation.CancelToken()
+        token.cancel()
+        self.assertRaises(webbpsf.propagation.CalculationCancelled, nc.calcPSF, nlambda=3, fov_arcsec=2, oversample=2, cancel_token=token)
+        # the cancelled calculation's profile must not linger for later calls
+        self.assertTrue(nc._profile is None)
+
+    def test_partial_result(self):
+        nc = webbpsf.NIRCam()
+        nc.pupilopd = None
+        token = webbpsf.propagation.CancelToken()
+        def cancel_after_first(event):
+            if event.kind == 'wavelength': token.cancel()
+        psf = nc.calcPSF(nlambda=3, fov_arcsec=2, oversample=2, progress_callback=cancel_after_first,
+                cancel_token=token, return_partial=True)
+        self.assertTrue(psf[0].header['CANCELLD'])
+        self.assertEqual(psf[0].header['NCOMPLET'], 1)
+        self.assertTrue(0 < psf[0].header['WGHTDONE'] < 1)
+
+class Test_Profile(unittest.TestCase):
+    " Check the timing and memory profile recorded for calcPSF "
+
+    def test_profile(self):
+        nc = webbpsf.NIRCam()
+        nc.pupilopd = None
+        psf = nc.calcPSF(nlambda=3, fov_arcsec=2, oversample=2, profile_output='both')
+        profile = nc.last_profile
+        for name in ['weights', 'optsys', 'optsys/pupil', 'propagate', 'header', 'format']:
+            self.assertTrue(profile[name].elapsed >= 0)
+        self.assertEqual(len(profile.wavelengths), 3)
+        self.assertTrue(profile.total_time >= profile['propagate'].elapsed)
+
+        self.assertTrue('T_PROPAG' in psf[0].header)
+        self.assertEqual(psf['PROFILE'].data['STAGE'][0], 'weights')
+
+class Test_Single_Precision(unittest.TestCase):
+    " Compare single precision propagation against double precision for each kind of calculation "
+
+    def do_test_precision(self, iname, image_mask=None, pupil_mask=None, filter=None):
+        inst = webbpsf.Instrument(iname)
+        if filter is not None: inst.filter = filter
+        inst.image_mask = image_mask
+        inst.pupil_mask = pupil_mask
+        psf_double = inst.calcPSF(nlambda=2, fov_arcsec=3, oversample=2, precision='double')
+        psf_single = inst.calcPSF(nlambda=2, fov_arcsec=3, oversample=2, precision='single')
+        self.assertEqual(psf_single[0].header['PRECISIO'], 'single')
+        self.assertEqual(psf_single[0].data.dtype, np.float64) # broadband sum is always double
+
+        peak = psf_double[0].data.max()
+        maxdiff = np.abs(psf_single[0].data - psf_double[0].data).max() / peak
+        fluxdiff = np.abs(psf_single[0].data.sum() - psf_double[0].data.sum()) / psf_double[0].data.sum()
+        _log.info("%s %s %s: single precision max error %.2e of peak, flux error %.2e" % (iname, image_mask, pupil_mask, maxdiff, fluxdiff))
+        self.assertTrue(maxdiff < 1e-5)
+        self.assertTrue(fluxdiff < 1e-5)
+
+    test_nircam = lambda self : self.do_test_precision('NIRCam')
+    test_nircam_wedge = lambda self : self.do_test_precision('NIRCam', 'MASKLWB', 'WEDGELYOT', filter='F444W')
+    test_miri_fqpm = lambda self : self.do_test_precision('MIRI', 'FQPM1065', 'MASKFQPM', filter='F1065C')
+    test_nirspec_slit = lambda self : self.do_test_precision('NIRSpec', 'S200A1', 'NIRSpec grating')
+    test_niriss_nrm = lambda self : self.do_test_precision('NIRISS', None, 'MASK_NRM', filter='F430M')
+    test_fgs = lambda self : self.do_test_precision('FGS')
+
+class Test_Compact_Output(unittest.TestCase):
+    " float32, tile-compressed, and core-only output files "
+
+    def test_compact(self):
+        import tempfile
+        import astropy.io.fits as fits
+        nc = webbpsf.NIRCam()
+        psf = nc.calcPSF(nlambda=1, fov_arcsec=3, oversample=4)
+        core = nc.calcPSF(nlambda=1, fov_arcsec=3, oversample=4, output_dtype='float32', output_oversampled=1.0)
+        self.assertEqual(core[0].data.dtype, np.float32)
+        self.assertEqual(core['DET_SAMP'].data.shape, psf['DET_SAMP'].data.shape)
+        self.assertTrue(core[0].data.shape[0] < psf[0].data.shape[0])
+        rect = nc.calcPSF(nlambda=1, fov_arcsec=3, oversample=4, output_oversampled=(1.0, 2.0))
+        self.assertEqual((rect[0].header['COREFOVY'], rect[0].header['COREFOVX']), (1.0, 2.0))
+        self.assertTrue(rect[0].data.shape[0] < rect[0].data.shape[1])
+        self.assertTrue(np.allclose(core['DET_SAMP'].data, psf['DET_SAMP'].data, rtol=1e-6, atol=1e-7*psf['DET_SAMP'].data.max()))
+
+        detector = nc.calcPSF(nlambda=1, fov_arcsec=3, oversample=4, output_oversampled=False)
+        self.assertEqual(len(detector), 1)
+        self.assertEqual(detector[0].header['OVERSAMP'], 1)
+        self.assertTrue(np.all(detector[0].data == psf['DET_SAMP'].data))
+
+        outfile = os.path.join(tempfile.mkdtemp(), 'psf_compressed.fits')
+        nc.calcPSF(nlambda=1, fov_arcsec=3, oversample=4, outfile=outfile, output_compression='GZIP_2')
+        written = fits.open(outfile)
+        self.assertEqual(written['OVERSAMP'].data.shape, psf[0].data.shape)
+        self.assertTrue(np.all(written['OVERSAMP'].data == psf[0].data)) # GZIP is lossless
+        self.assertTrue(np.all(written['DET_SAMP'].data == psf['DET_SAMP'].data))
+
+class Test_Rebin(unittest.TestCase):
+    " Detector rebinning by strided reshape-and-sum "
+
+    def test_rebin_array(self):
+        from .. import utils
+        a = np.random.random((60, 36))
+        for factor in [1, 2, 3, 4]:
+            self.assertTrue(np.allclose(utils.rebin_array(a, factor), poppy.rebin_array(a, rc=(factor, factor))))
+        # non-contiguous input, and writing into an existing array
+        out = np.zeros((15, 9))
+        utils.rebin_array(np.asfortranarray(a), 4, out=out)
+        self.assertTrue(np.allclose(out, poppy.rebin_array(a, rc=(4, 4))))
+        self.assertTrue(np.allclose(utils.rebin_array(a[:, ::2], 2), poppy.rebin_array(a[:, ::2].copy(), rc=(2, 2))))
+
+    def test_det_samp(self):
+        nc = webbpsf.NIRCam()
+        nc.options['parity'] = 'odd'
+        psf = nc.calcPSF(nlambda=1, fov_pixels=(21, 15), oversample=3)
+        self.assertEqual(psf['DET_SAMP'].data.shape, (21, 15))
+        self.assertEqual(psf['DET_SAMP'].header['OVERSAMP'], 1)
+        self.assertAlmostEqual(psf['DET_SAMP'].header['PIXELSCL'], psf[0].header['PIXELSCL']*3)
+        self.assertTrue(np.allclose(psf['DET_SAMP'].data, poppy.rebin_array(psf[0].data, rc=(3, 3))))
+
+class Test_OPD_Cube(unittest.TestCase):
+    " PSFs for all slices of an OPD cube at once "
+
+    def test_opd_cube(self):
+        nc = webbpsf.NIRCam()
+        opdfile = nc.pupilopd[0]
+        cube = nc.calcPSF_opd_cube(slices=[0, 3], nprocesses=2, nlambda=2, fov_pixels=16, oversample=2)
+        self.assertEqual(cube[0].data.shape, (2, 32, 32))
+        self.assertEqual(cube['DET_SAMP'].data.shape, (2, 16, 16))
+        self.assertEqual(cube[0].header['SLICE1'], 3)
+        for n, i in enumerate([0, 3]):
+            nc.pupilopd = (opdfile, i)
+            psf = nc.calcPSF(nlambda=2, fov_pixels=16, oversample=2)
+            self.assertTrue(np.allclose(cube[0].data[n], psf[0].data))
+            self.assertTrue(np.allclose(cube['DET_SAMP'].data[n], psf['DET_SAMP'].data))
+
+    def test_rotated_pupil(self):
+        # MIRI's pupil is rotated, so each OPD slice must be rotated to match the reused transmission
+        miri = webbpsf.MIRI()
+        opdfile = miri.pupilopd[0]
+        cube = miri.calcPSF_opd_cube(slices=[0, 2], nprocesses=1, nlambda=1, fov_pixels=16, oversample=2)
+        miri.pupilopd = (opdfile, 2)
+        psf = miri.calcPSF(nlambda=1, fov_pixels=16, oversample=2)
+        self.assertTrue(np.allclose(cube[0].data[1], psf[0].data))
+
+class Test_Aggregate(unittest.TestCase):
+    " Streaming statistics over PSF realizations, merged across workers "
+
+    def test_moments_and_sketch(self):
+        from .. import aggregate
+        values = np.random.lognormal(size=(500, 3, 3))
+        parts = [aggregate.RunningMoments(), aggregate.RunningMoments()]
+        sketches = [aggregate.QuantileSketch(0.01), aggregate.QuantileSketch(0.01)]
+        for i, v in enumerate(values):
+            parts[i % 2].add(v)
+            sketches[i % 2].add(v[0, 0])
+        parts[0].merge(parts[1])
+        sketches[0].merge(sketches[1])
+        self.assertTrue(np.allclose(parts[0].mean, values.mean(axis=0)))
+        self.assertTrue(np.allclose(parts[0].variance, values.var(axis=0, ddof=1)))
+        median = np.sort(values[:, 0, 0])[249]
+        self.assertTrue(abs(sketches[0].quantile(0.5)/median - 1) <= 0.01)
+
+    def test_aggregate_psfs(self):
+        import shutil, tempfile
+        from .. import aggregate
+        outdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, outdir, True)
+        filename = os.path.join(outdir, 'test_aggregate.fits')
+        nc = webbpsf.NIRCam()
+        opdfile = nc.pupilopd[0]
+        psfs, shards = [], [aggregate.PSFAggregator(ee_radii=[0.2]), aggregate.PSFAggregator(ee_radii=[0.2])]
+        for i in range(4):
+            nc.pupilopd = (opdfile, i)
+            psfs.append(nc.calcPSF(nlambda=1, fov_pixels=16, oversample=2))
+            shards[i % 2].add(psfs[-1])
+        shards[1].write(filename)
+        total = shards[0].merge(aggregate.read_aggregate(filename))
+        self.assertEqual(total.count, 4)
+        self.assertTrue(np.allclose(total.mean, np.mean([p[0].data for p in psfs], axis=0)))
+        self.assertTrue(np.allclose(total.variance, np.var([p[0].data for p in psfs], axis=0, ddof=1)))
+        self.assertEqual(total.sketches['fwhm'].count, 4)
+        self.assertTrue(set(total.summary().keys()) == set(['ee_0.2', 'fwhm']))
+
+    def test_merge_mismatch(self):
+        import astropy.io.fits as fits
+        from .. import aggregate
+        base = aggregate.PSFAggregator(ee_radii=[0.2])
+        self.assertRaises(ValueError, base.merge, aggregate.PSFAggregator(ee_radii=[0.5]))
+        self.assertRaises(ValueError, base.merge, aggregate.PSFAggregator(ee_radii=[0.2], fwhm=False))
+        self.assertRaises(ValueError, base.merge, aggregate.PSFAggregator(ext='DET_SAMP', ee_radii=[0.2]))
+        reference = fits.HDUList([fits.PrimaryHDU(data=np.ones((4, 4)))])
+        self.assertRaises(ValueError, base.merge, aggregate.PSFAggregator(ee_radii=[0.2], strehl_reference=reference))
+        base.merge(aggregate.PSFAggregator(ee_radii=[0.2]))
+
+_TEST_SUR = """<?xml version="1.0" encoding="UTF-8" standalone="no"?>
+<SEGMENT_UPDATE_REQUEST creator="test" date="2014-01-01" time="00:00:00" version="0.0.1" operational="false">
+    <CONFIGURATION_NAME>test</CONFIGURATION_NAME>
+    <CORRECTION_ID>1</CORRECTION_ID>
+    <GROUP id="1">
+        <UPDATE id="1" type="pose" seg_id="B3-1" absolute="false" coord="local" stage_type="none">
+            <PISTON  units="meters">{piston:E}</PISTON>
+        </UPDATE>
+    </GROUP>
+</SEGMENT_UPDATE_REQUEST>"""
+
+class Test_Segment_WFE(unittest.TestCase):
+    " OPDs from segment update requests via cached influence functions "
+
+    def test_sur_opd(self):
+        import tempfile
+        from .. import wfe
+        filenames = []
+        for piston in [1e-7, 2e-7]:
+            filenames.append(os.path.join(tempfile.mkdtemp(), 'sur.xml'))
+            with open(filenames[-1], 'w') as f: f.write(_TEST_SUR.format(piston=piston))
+        basis = wfe.get_basis()
+        self.assertTrue(wfe.get_basis() is basis)
+        opds = wfe.sur_opd(filenames)
+        b3 = basis.segment_map == wfe.SEGMENTS.index('B3')
+        # relative moves accumulate: 0.1 then 0.1+0.2 microns of piston, doubled on reflection
+        self.assertTrue(np.allclose(opds[0].data[0][b3], 0.2))
+        self.assertTrue(np.allclose(opds[0].data[1][b3], 0.6))
+        self.assertTrue(np.all(opds[0].data[:, ~b3] == 0))
+
+        nc = webbpsf.NIRCam()
+        nc.pupilopd = wfe.sur_opd(filenames[0])
+        psf = nc.calcPSF(nlambda=1, fov_pixels=16, oversample=2)
+        self.assertTrue(np.isfinite(psf[0].data).all())
+
+class Test_Modal_WFE(unittest.TestCase):
+    " Zernike and hexike aberrations from cached bases "
+
+    def test_bases(self):
+        from .. import wfe
+        zernikes = wfe.get_modal_basis('zernike', 6)
+        self.assertTrue(wfe.get_modal_basis('zernike', 6) is zernikes)
+        hexikes = wfe.get_modal_basis('hexike', 4)
+        segments = wfe.get_basis()
+        a1 = segments.segment_map == wfe.SEGMENTS.index('A1')
+        opd = hexikes.opd({'A1': [0, 1e-8]})
+        self.assertTrue(np.all(opd[~a1] == 0))
+        self.assertAlmostEqual(np.sqrt((opd[a1]**2).mean()), 1e-8)
+
+    def test_zernike_option(self):
+        from .. import wfe
+        nc = webbpsf.NIRCam()
+        opd = wfe.add_opd((os.path.join(nc._datapath, 'OPD', nc.pupilopd[0]), nc.pupilopd[1]),
+                          wfe.get_modal_basis('zernike', 4).opd([0, 0, 0, 50e-9]) * 1e6)
+        nc.options['zernike_coeffs'] = [0, 0, 0, 50e-9]
+        psf = nc.calcPSF(nlambda=1, fov_pixels=16, oversample=2)
+        del nc.options['zernike_coeffs']
+        nc.pupilopd = opd
+        reference = nc.calcPSF(nlambda=1, fov_pixels=16, oversample=2)
+        self.assertTrue(np.allclose(psf[0].data, reference[0].data))
+
+class Test_Jacobian(unittest.TestCase):
+    " Analytic PSF derivatives with respect to wavefront modes "
+
+    def test_against_finite_differences(self):
+        from .. import sensitivity
+        nc = webbpsf.NIRCam()
+        nc.filter = 'F212N'
+        jac = nc.calcPSF_jacobian(modes='zernike', nterms=5, nlambda=1, fov_pixels=8, oversample=2)
+        self.assertEqual(jac['JACOBIAN'].data.shape, (5, 16, 16))
+        self.assertEqual(jac['JACOBIAN'].header['MODE3'], 'Z4')
+        eps = 1e-9
+        for term in [2, 4]:
+            coeffs = np.zeros(5)
+            coeffs[term-1] = eps
+            nc.options['zernike_coeffs'] = coeffs
+            plus = nc.calcPSF(nlambda=1, fov_pixels=8, oversample=2)[0].data
+            nc.options['zernike_coeffs'] = -coeffs
+            minus = nc.calcPSF(nlambda=1, fov_pixels=8, oversample=2)[0].data
+            derivative = (plus - minus) / (2*eps)
+            self.assertTrue(np.allclose(jac['JACOBIAN'].data[term-1], derivative, atol=1e-3*np.abs(derivative).max()))
+        approx = sensitivity.linear_psf(jac, coeffs*10)
+        self.assertTrue(np.allclose(approx, jac[0].data + 10*eps*jac['JACOBIAN'].data[3]))
+
+class Test_Through_Focus(unittest.TestCase):
+    " Focus cubes, against individual calculations "
+
+    def test_defocus_and_weak_lenses(self):
+        nc = webbpsf.NIRCam()
+        nc.filter = 'F212N'
+        cube = nc.calcPSF_through_focus(defocus_waves=[-2, 0, 3], weak_lenses=['WEAK LENS +12 (=4+8)'],
+                nlambda=1, fov_pixels=8, oversample=2)
+        self.assertEqual(cube[0].data.shape, (4, 16, 16))
+        self.assertEqual(cube[0].header['NSTEPS'], 4)
+        self.assertEqual(cube[0].header['FOCUS3'], 'WEAK LENS +12 (=4+8)')
+        self.assertTrue('defocus_waves' not in nc.options)
+        for n, waves in enumerate([-2, 0, 3]):
+            nc.options['defocus_waves'] = waves
+            single = nc.calcPSF(nlambda=1, fov_pixels=8, oversample=2)[0].data
+            self.assertTrue(np.allclose(cube[0].data[n], single, rtol=1e-6, atol=1e-6*single.max()))
+        del nc.options['defocus_waves']
+        nc.pupil_mask = 'WEAK LENS +12 (=4+8)'
+        single = nc.calcPSF(nlambda=1, fov_pixels=8, oversample=2)[0].data
+        self.assertTrue(np.allclose(cube[0].data[3], single, rtol=1e-6, atol=1e-6*single.max()))
+
+class Test_Offsets(unittest.TestCase):
+    " Offset cubes, against individual calculations "
+
+    def test_offsets(self):
+        nc = webbpsf.NIRCam()
+        nc.filter = 'F212N'
+        r, theta = [0, 0.1, 0.25], [0, 30, 200]
+        cube = nc.calcPSF_offsets(r, theta, nlambda=2, fov_pixels=8, oversample=2)
+        self.assertEqual(cube[0].data.shape, (3, 16, 16))
+        self.assertEqual(cube[0].header['OFFT2'], 200)
+        for n in range(3):
+            nc.options['source_offset_r'] = r[n]
+            nc.options['source_offset_theta'] = theta[n]
+            single = nc.calcPSF(nlambda=2, fov_pixels=8, oversample=2)[0].data
+            self.assertTrue(np.allclose(cube[0].data[n], single, rtol=1e-6, atol=1e-6*single.max()))
+
+class Test_Pixel_Phases(unittest.TestCase):
+    " Subpixel phase stamps, against shifted rebinning "
+
+    def test_phases(self):
+        from .. import utils
+        image = np.random.rand(48, 40)
+        stamps = utils.pixel_phases(image, 4)
+        self.assertEqual(stamps.shape, (4, 4, 11, 9))
+        for i in range(4):
+            for j in range(4):
+                self.assertTrue(np.allclose(stamps[i, j], utils.rebin_array(image[i:i+44, j:j+36], 4)))
+        kernel = np.random.rand(6, 6)
+        stamps = utils.pixel_phases(image, 4, step=2, kernel=kernel)
+        self.assertEqual(stamps.shape, (2, 2, 11, 9))
+        self.assertAlmostEqual(stamps[1, 0, 3, 5], (image[14:20, 20:26]*kernel).sum())
+
+    def test_instrument(self):
+        from .. import utils
+        nc = webbpsf.NIRCam()
+        nc.filter = 'F212N'
+        result = nc.calcPSF_pixel_phases(nphases=2, nlambda=1, fov_pixels=8, oversample=4)
+        self.assertEqual(result[0].data.shape, (2, 2, 7, 7))
+        self.assertEqual(result[0].header['PHASESTP'], 0.5)
+        self.assertTrue(np.allclose(result[0].data[0, 0], utils.rebin_array(result['OVERSAMP'].data, 4)[:7, :7]))
+
+class Test_Jitter(unittest.TestCase):
+    " Fourier-domain jitter, against direct convolution and sums of shifted PSFs "
+
+    def test_gaussian(self):
+        from .. import jitter
+        image = np.zeros((64, 64))
+        image[32, 30] = 1
+        blurred = jitter.jitter_psf(image, 0.01, sigma=0.02)
+        y, x = np.indices(image.shape)
+        gaussian = np.exp(-((x-30)**2 + (y-32)**2) * 0.01**2 / (2*0.02**2))
+        self.assertTrue(np.allclose(blurred, gaussian/gaussian.sum(), atol=1e-8))
+        cube = jitter.jitter_psf(np.array([image, 2*image]), 0.01, sigma=[0.01, 0.02])
+        self.assertEqual(cube.shape, (2, 2, 64, 64))
+        self.assertTrue(np.allclose(cube[1, 1], 2*blurred))
+        elliptical = jitter.jitter_psf(image, 0.01, sigma=(0.03, 0.01), angle=90)
+        self.assertAlmostEqual((elliptical*(y-32)**2).sum() * 0.01**2, 0.03**2, places=6)
+        self.assertAlmostEqual((elliptical*(x-30)**2).sum() * 0.01**2, 0.01**2, places=6)
+
+    def test_timeseries(self):
+        from .. import jitter
+        image = np.random.random((40, 40))
+        x, y = np.array([0.02, -0.03, 0.0]), np.array([0.0, 0.01, 0.05])
+        blurred = jitter.jitter_psf(image, 0.01, model='timeseries', timeseries=(x, y))
+        shifted = np.zeros((3, 60, 60))
+        for k in range(3):
+            dy, dx = int(round(y[k]/0.01)), int(round(x[k]/0.01))
+            shifted[k, 10+dy:50+dy, 10+dx:50+dx] = image
+        self.assertTrue(np.allclose(blurred, shifted.mean(axis=0)[10:50, 10:50]))
+
+    def test_instrument(self):
+        nc = webbpsf.NIRCam()
+        nc.filter = 'F212N'
+        plain = nc.calcPSF(nlambda=1, fov_pixels=8, oversample=2)
+        cube = nc.calcPSF_jitter([0.0, 0.02], nlambda=1, fov_pixels=8, oversample=2)
+        self.assertTrue(np.allclose(cube[0].data[0], plain[0].data, atol=1e-10))
+        nc.options['jitter'] = 'gaussian'
+        nc.options['jitter_sigma'] = 0.02
+        jittered = nc.calcPSF(nlambda=1, fov_pixels=8, oversample=2)
+        self.assertEqual(jittered[0].header['JITRSIGM'], 0.02)
+        self.assertTrue(np.allclose(cube[0].data[1], jittered[0].data))
+        self.assertTrue(jittered[0].data.max() < plain[0].data.max())
+
+class Test_Mock_DMS(unittest.TestCase):
+    " Sparse detector frames "
+
+    def test_stamp_placement(self):
+        import astropy.io.fits as fits
+        from .. import mockdms
+        stamp = np.random.random((10, 12))
+        header = fits.Header()
+        hdulist = fits.HDUList([fits.PrimaryHDU(header=header), mockdms.sci_hdu(stamp, header, (100, 80), (3.2, 50.2))])
+        self.assertEqual(hdulist['SCI'].data.shape, (10, 10))     # the 2 leftmost columns are off the frame
+        frame = mockdms.full_frame(hdulist)
+        self.assertEqual(frame.shape, (100, 80))
+        self.assertTrue(np.allclose(frame[46:56, 0:10], stamp[:, 2:]))
+        self.assertAlmostEqual(frame.sum(), stamp[:, 2:].sum(), places=3)
+        self.assertRaises(ValueError, mockdms.sci_hdu, stamp, header, (100, 80), (-20, 50))
+
+    def test_instrument(self):
+        from .. import mockdms
+        nc = webbpsf.NIRCam()
+        nc.filter = 'F212N'
+        nc.detector_coordinates = (1000, 700)
+        nc.options['output_mode'] = 'Mock JWST DMS Output'
+        psf = nc.calcPSF(nlambda=1, fov_pixels=9, oversample=2)
+        self.assertTrue(psf[0].data is None)
+        self.assertEqual(psf['SCI'].data.shape, (9, 9))
+        self.assertEqual((psf['SCI'].header['SUBSTRT1'], psf['SCI'].header['SUBSTRT2']), (997, 697))
+        frame = mockdms.full_frame(psf)
+        self.assertEqual(np.unravel_index(frame.argmax(), frame.shape), (700, 1000))
+
+    def test_scene(self):
+        try:
+            from .. import obssim
+        except ImportError:
+            raise unittest.SkipTest("Scene simulations require pysynphot")
+        scene = obssim.TargetScene()
+        scene.addPointSource('G0V', name='star')
+        scene.addPointSource('K0V', name='companion', separation=0.1, PA=45)
+        nc = webbpsf.NIRCam()
+        nc.detector_coordinates = (1000, 700)
+        nc.options['output_mode'] = 'dms'
+        image = scene.calcImage(nc, nlambda=1, fov_pixels=9, oversample=2)
+        # the summed image is placed on the frame once, and the instrument is left as it was
+        self.assertTrue(image[0].data is None)
+        self.assertEqual(image['SCI'].data.shape, (9, 9))
+        self.assertEqual(nc.options['output_mode'], 'dms')
+
+class Test_Tiled(unittest.TestCase):
+    " Detector planes computed in tiles, against the whole plane at once "
+
+    def test_tiled(self):
+        import tempfile
+        nc = webbpsf.NIRCam()
+        nc.filter = 'F212N'
+        nc.options['output_mode'] = 'both'
+        whole = nc.calcPSF(nlambda=2, fov_pixels=13, oversample=2)
+        tiled = nc.calcPSF(nlambda=2, fov_pixels=13, oversample=2, tile_pixels=8)
+        self.assertEqual(tiled[0].header['NTILES'], 16)
+        self.assertTrue(np.allclose(tiled[0].data, whole[0].data, rtol=1e-8, atol=1e-12))
+        self.assertTrue(np.allclose(tiled['DET_SAMP'].data, whole['DET_SAMP'].data, rtol=1e-8, atol=1e-12))
+        filename = os.path.join(tempfile.mkdtemp(), 'tiled.npy')
+        mapped = nc.calcPSF(nlambda=2, fov_pixels=13, oversample=2, tile_pixels=8, tile_file=filename)
+        self.assertTrue(isinstance(mapped[0].data, np.memmap))
+        self.assertTrue(np.allclose(np.load(filename), whole[0].data, rtol=1e-8, atol=1e-12))
+
+class Test_Synthetic_Data(unittest.TestCase):
+    " The benchmarks' synthetic data directory is complete enough to set up every instrument "
+
+    def test_instruments(self):
+        import sys, tempfile
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+        from benchmarks import synthetic_data
+        path = synthetic_data.make_synthetic_data(tempfile.mkdtemp(), npix=64)
+        saved = os.environ.get('WEBBPSF_PATH', None)
+        os.environ['WEBBPSF_PATH'] = path
+        try:
+            for instname in ['NIRCam', 'NIRSpec', 'NIRISS', 'MIRI', 'FGS']:
+                self.assertTrue(os.path.exists(os.path.join(path, synthetic_data.siaf_filename(instname))))
+                inst = webbpsf.Instrument(instname)
+                self.assertEqual(inst.detector, inst.detector_list[0])
+                for name in inst.detector_list:
+                    inst.detector = name
+                    self.assertEqual(len(inst._detector.shape), 2)
+        finally:
+            if saved is None: del os.environ['WEBBPSF_PATH']
+            else: os.environ['WEBBPSF_PATH'] = saved
+            sys.path.pop(0)
+
+class Test_Tuning(unittest.TestCase):
+    " Parallelization settings from the configuration or from a calibration "
+
+    def setUp(self):
+        from .. import tuning
+        self.saved = (tuning._calibration, webbpsf.settings.autotune(), webbpsf.settings.use_multiprocessing(),
+                webbpsf.settings.n_processes())
+
+    def tearDown(self):
+        from .. import tuning
+        tuning._calibration = self.saved[0]
+        webbpsf.settings.autotune.set(self.saved[1])
+        webbpsf.settings.use_multiprocessing.set(self.saved[2])
+        webbpsf.settings.n_processes.set(self.saved[3])
+        webbpsf.settings._apply_settings_to_poppy()
+
+    def test_settings_config(self):
+        import multiprocessing
+        from .. import tuning
+        webbpsf.settings.autotune.set(False)
+        webbpsf.settings.use_multiprocessing.set(True)
+        webbpsf.settings.n_processes.set(2)
+        config = tuning.get_parallel_config('NIRCam', None, 2)
+        self.assertEqual(config['source'], 'settings')
+        self.assertEqual(config['n_processes'], 2)
+        self.assertEqual(config['blas_threads'], max(1, multiprocessing.cpu_count() // 2))
+        tuning.apply_parallel_config(config)
+        self.assertEqual(poppy.settings.use_multiprocessing(), True)
+        self.assertEqual(poppy.settings.n_processes(), 2)
+
+    def test_calibrated_config(self):
+        from .. import tuning
+        webbpsf.settings.autotune.set(True)
+        serial = {'use_multiprocessing': False, 'n_processes': 1, 'use_fftw': False, 'fftw_threads': None, 'blas_threads': 4, 'time': 1.0}
+        parallel = dict(serial, use_multiprocessing=True, n_processes=4, blas_threads=1)
+        tuning._calibration = {'NIRCam:none:2': serial, 'NIRCam:none:8': parallel}
+        # the nearest calibrated oversampling is used
+        config = tuning.get_parallel_config('NIRCam', None, 3)
+        self.assertEqual(config['source'], 'calibration')
+        self.assertEqual(config['n_processes'], 1)
+        self.assertFalse('time' in config)
+        self.assertEqual(tuning.get_parallel_config('NIRCam', None, 6)['n_processes'], 4)
+        # and other modes fall back to the settings
+        self.assertEqual(tuning.get_parallel_config('MIRI', None, 2)['source'], 'settings')
+
+from .. import asyncpsf
+
+@unittest.skipIf(not asyncpsf._HAS_ASYNCIO, "asyncio (or trollius) is not available")
+class Test_Async(unittest.TestCase):
+    " calcPSF_async from an event loop, with coalescing of identical requests "
+
+    def test_async(self):
+        loop = asyncpsf.asyncio.new_event_loop()
+        nc = webbpsf.NIRCam()
+        futures = [nc.calcPSF_async(nlambda=1, fov_arcsec=2, oversample=2, loop=loop) for i in range(2)]
+        futures.append(nc.calcPSF_async(nlambda=1, fov_arcsec=2, oversample=1, loop=loop))
+        results = loop.run_until_complete(asyncpsf.asyncio.gather(*futures))
+        self.assertTrue(results[0] is not results[1])
+        self.assertTrue(np.all(results[0][0].data == results[1][0].data))
+        self.assertEqual(results[2][0].data.shape[0]*2, results[0][0].data.shape[0])
+        loop.close()
+
+class Test_Concurrency(unittest.TestCase):
+    " State shared by calculations running at once in threads "
+
+    def test_config_key(self):
+        nc = webbpsf.NIRCam()
+        key = asyncpsf.config_key(nc, {'nlambda': 1})
+        nc.detector = 'A2'
+        self.assertNotEqual(asyncpsf.config_key(nc, {'nlambda': 1}), key)
+        key = asyncpsf.config_key(nc, {'nlambda': 1})
+        nc.detector_coordinates = (100, 200)
+        self.assertNotEqual(asyncpsf.config_key(nc, {'nlambda': 1}), key)
+        key = asyncpsf.config_key(nc, {'nlambda': 1})
+        webbpsf.settings.precision.set('single')
+        try:
+            self.assertNotEqual(asyncpsf.config_key(nc, {'nlambda': 1}), key)
+        finally:
+            webbpsf.settings.precision.set('double')
+
+    def test_budget_share(self):
+        webbpsf.settings.max_memory.set(8)
+        try:
+            with webbpsf.propagation.budget_share(0.25):
+                self.assertEqual(webbpsf.propagation.memory_budget(), 2*2**30)
+            self.assertEqual(webbpsf.propagation.memory_budget(), 8*2**30)
+        finally:
+            webbpsf.settings.max_memory.set(0)
+
+    def test_overlapping_thread_limits(self):
+        from .. import tuning
+        saved = os.environ.get('OMP_NUM_THREADS')
+        first = tuning.thread_limits(4, None)
+        second = tuning.thread_limits(2, None)
+        first.__enter__()
+        second.__enter__()
+        self.assertEqual(os.environ['OMP_NUM_THREADS'], '2')
+        # the first calculation finishing must not undo the second one's cap, nor leave its own behind
+        first.__exit__(None, None, None)
+        self.assertEqual(os.environ['OMP_NUM_THREADS'], '2')
+        second.__exit__(None, None, None)
+        self.assertEqual(os.environ.get('OMP_NUM_THREADS'), saved)
+
+class Test_Server(unittest.TestCase):
+    " PSFs from a local PSF server match direct calculations, and repeat requests hit the caches "
+
+    def test_server(self):
+        import threading
+        from .. import server
+        psf_server = server.make_server(port=0, nworkers=1)
+        thread = threading.Thread(target=psf_server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            client = server.PSFClient(psf_server.server_address[:2])
+            psf = client.calcPSF('NIRCam', filter='F200W', nlambda=1, fov_arcsec=2, oversample=2)
+            arrays, header = client.calcPSF('NIRCam', filter='F200W', nlambda=1, fov_arcsec=2, oversample=2, format='array')
+            nc = webbpsf.NIRCam()
+            nc.filter = 'F200W'
+            direct = nc.calcPSF(nlambda=1, fov_arcsec=2, oversample=2)
+            self.assertTrue(np.allclose(psf[0].data, direct[0].data))
+            self.assertTrue(np.allclose(arrays['DET_SAMP'], direct['DET_SAMP'].data))
+            self.assertEqual(header['FILTER'], 'F200W')
+            self.assertEqual(client.stats()['optsys_cache']['hits'], 1)
+            # the warm instrument must still switch to the long wavelength pixel scale
+            psf = client.calcPSF('NIRCam', filter='F444W', nlambda=1, fov_arcsec=2, oversample=2)
+            nc.filter = 'F444W'
+            self.assertEqual(psf[0].header['PIXELSCL'], nc.calcPSF(nlambda=1, fov_arcsec=2, oversample=2)[0].header['PIXELSCL'])
+            # and a request without a filter gets the default, not the previous request's
+            psf = client.calcPSF('NIRCam', nlambda=1, fov_arcsec=2, oversample=2)
+            default = webbpsf.NIRCam()
+            self.assertEqual(psf[0].header['FILTER'], default.filter)
+            self.assertEqual(psf[0].header['PIXELSCL'], default.calcPSF(nlambda=1, fov_arcsec=2, oversample=2)[0].header['PIXELSCL'])
+            client.close()
+        finally:
+            psf_server.shutdown()
+            psf_server.stop_workers()
+            psf_server.server_close()
+
+class Test_Batch(unittest.TestCase):
+    " Batch job files: sweeps, de-duplication, and resuming from the manifest "
+
+    def test_batch(self):
+        import json, tempfile
+        from .. import batch
+        outdir = tempfile.mkdtemp()
+        jobfile = os.path.join(outdir, 'jobs.json')
+        with open(jobfile, 'w') as f:
+            json.dump({'defaults': {'nlambda': 1, 'fov_arcsec': 2},
+                       'jobs': [{'instrument': 'NIRCam', 'sweep': {'oversample': [1, 2]}},
+                                {'instrument': 'NIRCam', 'oversample': 2, 'outfile': 'nircam_{oversample}.fits'}]}, f)
+        jobs = batch.expand_jobs(batch.load_jobs(jobfile), outdir=outdir)
+        self.assertEqual(len(jobs), 2)
+        records = batch.run_batch(jobs, outdir=outdir, nprocesses=1)
+        self.assertEqual([r['status'] for r in records], ['done', 'done'])
+        self.assertTrue(os.path.exists(os.path.join(outdir, 'nircam_2.fits')))
+        # a second run finds everything done already
+        self.assertEqual(len(batch.run_batch(jobs, outdir=outdir, nprocesses=1)), 0)
+
+    def test_outfile_collision(self):
+        from .. import batch
+        # a sweep whose outfile doesn't depend on the swept filter would overwrite its own results
+        jobs = [{'instrument': 'NIRCam', 'nlambda': 1, 'outfile': 'psf.fits', 'sweep': {'filter': ['F200W', 'F444W']}}]
+        self.assertRaises(ValueError, batch.expand_jobs, jobs)
+        jobs[0]['outfile'] = 'psf_{filter}.fits'
+        self.assertEqual(len(batch.expand_jobs(jobs)), 2)
+
+    def test_shards(self):
+        import tempfile
+        import astropy.io.fits as fits
+        from .. import batch
+        outdir = tempfile.mkdtemp()
+        jobs = batch.expand_jobs([{'instrument': 'NIRCam', 'nlambda': 1, 'fov_arcsec': 1, 'sweep': {'oversample': [1, 2, 3]}},
+                                  {'instrument': 'MIRI', 'nlambda': 1, 'fov_arcsec': 3, 'oversample': 2,
+                                   'filter': 'F1065C', 'image_mask': 'FQPM1065', 'pupil_mask': 'MASKFQPM'}], outdir=outdir)
+        shards = [batch.shard_jobs(jobs, '%d/2' % i) for i in (1, 2)]
+        self.assertEqual(sorted([j['id'] for j in shards[0] + shards[1]]), sorted([j['id'] for j in jobs]))
+        # the coronagraph is the most expensive job, so gets a shard to itself
+        self.assertEqual(min([len(s) for s in shards]), 1)
+        self.assertEqual(shards, [batch.shard_jobs(list(reversed(jobs)), '%d/2' % i) for i in (1, 2)])
+
+        batch.run_batch(jobs, outdir=outdir, nprocesses=1, shard='1/2')
+        self.assertRaises(ValueError, batch.merge_shards, jobs, outdir, os.path.join(outdir, 'library.fits'))
+        batch.run_batch(jobs, outdir=outdir, nprocesses=1, shard='2/2')
+        library = fits.open(batch.merge_shards(jobs, outdir, os.path.join(outdir, 'library.fits')))
+        self.assertEqual(len(library['INDEX'].data), 4)
+        self.assertEqual(library[0].header['NSHARDS'], 2)
+        for job in jobs:
+            self.assertTrue(np.all(library[job['id']].data == fits.getdata(job['outfile'])))
+
+
 def test_run(index=None, wavelength=2e-6):
     """ This function provides a simple interface for running all available tests, or just one """
     #tests = [TestPupils, TestPoppy, Test1, Test2, Test3, Test4, Test5]
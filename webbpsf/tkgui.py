@@ -568,7 +568,8 @@ class WebbPSF_GUI(object):
         lf.grid(row=4, sticky='E,W', padx=10, pady=5)
 
         lf = ttk.Frame(frame)
-        ttk.Button(lf, text='Compute PSF', command=self.ev_calcPSF ).grid(column=0, row=0)
+        self.widgets['Compute PSF'] = ttk.Button(lf, text='Compute PSF', command=self.ev_calcPSF )
+        self.widgets['Compute PSF'].grid(column=0, row=0)
         self.widgets['SaveAs'] = ttk.Button(lf, text='Save PSF...', command=self.ev_SaveAs )
         self.widgets['SaveAs'].grid(column=1, row=0, sticky='E')
         self.widgets['SaveAs'].state(['disabled'])
@@ -701,10 +702,22 @@ class WebbPSF_GUI(object):
         else:
             source=None # generic flat spectrum
 
-        self.PSF_HDUlist = self.inst.calcPSF(source=source, 
-                detector_oversample= self.detector_oversampling,
-                fft_oversample=self.fft_oversampling,
-                fov_arcsec = self.FOV,  nlambda = self.nlambda, display=True)
+        def wavelength_done(wavelength_result):
+            # redraw the window between wavelengths. Only idle tasks, since handling events here
+            # could start another calculation inside this one.
+            _log.info("Computed wavelength %d: %.3f um" % (wavelength_result.index+1, wavelength_result.wavelength*1e6))
+            self.root.update_idletasks()
+
+        compute_button = self.widgets['Compute PSF']
+        compute_button.state(['disabled'])
+        try:
+            self.PSF_HDUlist = self.inst.calcPSF(source=source, 
+                    detector_oversample= self.detector_oversampling,
+                    fft_oversample=self.fft_oversampling,
+                    fov_arcsec = self.FOV,  nlambda = self.nlambda, display=True,
+                    wavelength_callback=wavelength_done)
+        finally:
+            compute_button.state(['!disabled'])
         #self.PSF_HDUlist.display()
         for w in ['Display PSF', 'Display profiles', 'Save PSF As...']:
            self.widgets[w].state(['!disabled'])
@@ -1120,6 +1133,10 @@ def synplot(thing, waveunit='micron', label=None, **kwargs):
 def tkgui(fignum=1):
     # enable log message printout
     logging.basicConfig(level=logging.INFO,format='%(name)-10s: %(levelname)-8s %(message)s')
+    # GUI does not play well with multiprocessing, so compute wavelengths on threads instead.
+    if webbpsf_core.settings.use_multiprocessing() and not webbpsf_core.settings.use_threads():
+        _log.info('Multiprocessing is not compatible with the GUI; computing wavelengths in parallel threads instead.')
+        webbpsf_core.settings.use_threads.set(True)
     # start the GUI
     gui = WebbPSF_GUI()
     plt.figure(fignum)
@@ -0,0 +1,398 @@
+#!/usr/bin/env python
+"""
+tuning.py
+
+    Machine-specific performance tuning for WebbPSF calculations.
+
+    This provides two things:
+
+    1) Persistent FFTW "wisdom". Planning FFTs with FFTW takes a substantial
+       amount of time the first time any given array size is seen. The resulting
+       plans are saved into the webbpsf configuration directory, and reloaded
+       in later sessions. Since this happens before any worker processes are
+       forked, the workers inherit the loaded wisdom too.
+
+    2) Calibration of parallelization settings. Running `calibrate()` once on
+       a given machine times a small set of PSF calculations using different
+       mixtures of worker processes, FFTW and BLAS threads, and records the
+       fastest for each instrument, image mask, and oversampling. These are
+       then applied automatically in calcPSF if `settings.autotune` is True.
+
+    In all cases the number of BLAS and FFTW threads per process is capped so
+    that (processes x threads) does not exceed the number of available cores.
+
+"""
+import os
+import time
+import json
+import pickle
+import contextlib
+import multiprocessing
+
+from astropy.config import get_config_dir
+
+from . import settings
+
+import logging
+_log = logging.getLogger('webbpsf')
+
+try:
+    import pyfftw
+    _HAS_PYFFTW = True
+except ImportError:
+    _HAS_PYFFTW = False
+
+try:
+    import threadpoolctl
+    _HAS_THREADPOOLCTL = True
+except ImportError:
+    _HAS_THREADPOOLCTL = False
+
+
+_THREAD_ENV_VARS = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS']
+
+_wisdom_loaded = False
+_wisdom_saved = None
+
+_calibration = None     # cached contents of the calibration file
+
+# Environment variables, pyfftw.config, the FFTW wisdom and poppy.settings are shared by
+# every calculation in this process, including ones running concurrently in threads (see
+# asyncpsf and server), so changes to them are made under the settings lock.
+_lock = settings._lock
+_active_limits = []     # (blas_threads, fftw_threads) of each thread_limits context currently open
+_saved_limits = None    # state to restore when the last of those closes
+
+
+#---------------------------------------------------------------------------------
+# FFTW wisdom
+
+def _wisdom_filename():
+    return os.path.join(get_config_dir(), 'webbpsf_fftw_wisdom.pkl')
+
+
+def load_fftw_wisdom(force=False):
+    """ Load saved FFTW wisdom from the webbpsf configuration directory.
+
+    This only does anything once per session, unless `force` is set.
+
+    Returns
+    -------
+    loaded : bool
+        True if wisdom was loaded.
+    """
+    global _wisdom_loaded, _wisdom_saved
+    if not _HAS_PYFFTW or not settings.fftw_wisdom(): return False
+    with _lock:
+        if _wisdom_loaded and not force: return False
+
+        _wisdom_loaded = True
+        filename = _wisdom_filename()
+        if not os.path.exists(filename): return False
+        try:
+            with open(filename, 'rb') as f:
+                wisdom = pickle.load(f)
+            pyfftw.import_wisdom(wisdom)
+            _wisdom_saved = wisdom
+            _log.debug("Loaded FFTW wisdom from "+filename)
+            return True
+        except Exception as err:
+            _log.warn("Could not load FFTW wisdom from %s: %s" % (filename, str(err)))
+            return False
+
+
+def save_fftw_wisdom():
+    """ Save the current FFTW wisdom to the webbpsf configuration directory.
+
+    This is a no-op if the wisdom has not changed since it was last loaded or saved.
+    The file is replaced atomically, so it is safe for several sessions to do this at once.
+    """
+    global _wisdom_saved
+    if not _HAS_PYFFTW or not settings.fftw_wisdom(): return False
+
+    with _lock:
+        wisdom = pyfftw.export_wisdom()
+        if wisdom == _wisdom_saved: return False
+
+        filename = _wisdom_filename()
+        tmpname = "%s.%d.tmp" % (filename, os.getpid())
+        try:
+            with open(tmpname, 'wb') as f:
+                pickle.dump(wisdom, f, protocol=2)
+            os.rename(tmpname, filename)
+            _wisdom_saved = wisdom
+            _log.debug("Saved FFTW wisdom to "+filename)
+            return True
+        except (IOError, OSError) as err:
+            _log.warn("Could not save FFTW wisdom to %s: %s" % (filename, str(err)))
+            return False
+
+
+#---------------------------------------------------------------------------------
+# Thread caps
+
+def _min_limit(values):
+    values = [v for v in values if v]
+    return min(values) if len(values) > 0 else None
+
+
+def _set_limits(blas_threads, fftw_threads):
+    """ Apply thread caps, saving the original state first if nothing is capped yet. Call with _lock held. """
+    global _saved_limits
+    if _saved_limits is None:
+        _saved_limits = {'env': dict([(var, os.environ.get(var)) for var in _THREAD_ENV_VARS]), 'limiter': None, 'fftw': None}
+        if _HAS_THREADPOOLCTL:
+            _saved_limits['limiter'] = threadpoolctl.threadpool_limits(limits=None, user_api='blas')
+        if _HAS_PYFFTW and hasattr(pyfftw, 'config'):
+            _saved_limits['fftw'] = pyfftw.config.NUM_THREADS
+    if blas_threads:
+        for var in _THREAD_ENV_VARS:
+            os.environ[var] = str(int(blas_threads))
+        if _HAS_THREADPOOLCTL:
+            threadpoolctl.threadpool_limits(limits=int(blas_threads), user_api='blas')
+    if fftw_threads and _HAS_PYFFTW and hasattr(pyfftw, 'config'):
+        pyfftw.config.NUM_THREADS = int(fftw_threads)
+
+
+def _restore_limits():
+    """ Undo all thread caps. Call with _lock held. """
+    global _saved_limits
+    if _saved_limits is None: return
+    if _saved_limits['limiter'] is not None:
+        _saved_limits['limiter'].restore_original_limits()
+    for var, value in _saved_limits['env'].items():
+        if value is None: os.environ.pop(var, None)
+        else: os.environ[var] = value
+    if _saved_limits['fftw'] is not None:
+        pyfftw.config.NUM_THREADS = _saved_limits['fftw']
+    _saved_limits = None
+
+
+@contextlib.contextmanager
+def thread_limits(blas_threads=None, fftw_threads=None):
+    """ Context manager to temporarily cap the number of BLAS and FFTW threads.
+
+    BLAS threads are limited using threadpoolctl if it is available. The equivalent
+    environment variables are also set, for the benefit of any worker processes started
+    inside this context which load their BLAS library afresh. FFTW threads are limited
+    via pyfftw.config where that exists.
+
+    These limits are process-wide. If several threads are inside this context at once,
+    the smallest of their caps applies, and the original settings are restored when the
+    last of them leaves.
+
+    Parameters
+    ----------
+    blas_threads, fftw_threads : int or None
+        Maximum number of threads. None means leave unchanged.
+    """
+    limits = (blas_threads, fftw_threads)
+    with _lock:
+        _active_limits.append(limits)
+        if blas_threads or fftw_threads:
+            _set_limits(_min_limit([l[0] for l in _active_limits]), _min_limit([l[1] for l in _active_limits]))
+    try:
+        yield
+    finally:
+        with _lock:
+            _active_limits.remove(limits)
+            if len(_active_limits) == 0:
+                _restore_limits()
+            elif blas_threads or fftw_threads:
+                # go back to the caps of the contexts still open
+                _restore_limits()
+                _set_limits(_min_limit([l[0] for l in _active_limits]), _min_limit([l[1] for l in _active_limits]))
+
+
+#---------------------------------------------------------------------------------
+# Calibration of parallelization settings
+
+def _calibration_filename():
+    return os.path.join(get_config_dir(), 'webbpsf_tuning.json')
+
+
+def _machine_info():
+    import platform
+    return {'ncpu': multiprocessing.cpu_count(), 'node': platform.node(), 'machine': platform.machine()}
+
+
+def _tuning_key(instrument_name, image_mask, oversample):
+    return "%s:%s:%d" % (instrument_name, image_mask if image_mask is not None else 'none', oversample)
+
+
+def _load_calibration():
+    global _calibration
+    if _calibration is None:
+        filename = _calibration_filename()
+        _calibration = {}
+        if os.path.exists(filename):
+            try:
+                with open(filename) as f:
+                    contents = json.load(f)
+                if contents.get('machine', {}).get('ncpu') == multiprocessing.cpu_count():
+                    _calibration = contents.get('results', {})
+                else:
+                    _log.warn("Ignoring parallelization calibration in %s, which was made on a different machine. Rerun webbpsf.tuning.calibrate()." % filename)
+            except (IOError, ValueError) as err:
+                _log.warn("Could not read parallelization calibration %s: %s" % (filename, str(err)))
+    return _calibration
+
+
+def _candidate_configs(ncpu=None, max_processes=8):
+    """ List of parallelization settings to try when calibrating. FFTW is never combined with
+    multiprocessing, since that has been found to be unreliable. """
+    if ncpu is None: ncpu = multiprocessing.cpu_count()
+    configs = [{'use_multiprocessing': False, 'n_processes': 1, 'use_fftw': False, 'fftw_threads': None, 'blas_threads': ncpu}]
+    if _HAS_PYFFTW:
+        configs.append({'use_multiprocessing': False, 'n_processes': 1, 'use_fftw': True, 'fftw_threads': ncpu, 'blas_threads': ncpu})
+    nproc = 2
+    while nproc <= min(ncpu, max_processes):
+        configs.append({'use_multiprocessing': True, 'n_processes': nproc, 'use_fftw': False, 'fftw_threads': None,
+                        'blas_threads': max(1, ncpu // nproc)})
+        nproc *= 2
+    return configs
+
+
+_CALIBRATION_MODES = {'NIRCam': [None, 'MASK335R'],
+                      'MIRI': [None, 'FQPM1065'],
+                      'NIRSpec': [None, 'S200A1'],
+                      'NIRISS': [None],
+                      'FGS': [None]}
+_CALIBRATION_PUPILS = {'MASK335R': 'CIRCLYOT', 'FQPM1065': 'MASKFQPM', 'S200A1': 'NIRSpec grating'}
+
+
+def calibrate(instruments=None, oversamples=(2, 4), fov_arcsec=3, max_processes=8, save=True):
+    """ Measure which parallelization settings are fastest on this machine.
+
+    For each instrument, a representative direct imaging mode and image plane mask mode
+    are timed at each oversampling, for every candidate combination of worker
+    processes, FFTW threads and BLAS threads. The fastest is recorded in
+    `webbpsf_tuning.json` in the webbpsf configuration directory, and will be used
+    by calcPSF from then on whenever `settings.autotune` is True.
+
+    This only needs to be run once per machine, but will take a while.
+
+    Parameters
+    ----------
+    instruments : list of str
+        Instrument names to calibrate. Default is all of them.
+    oversamples : iterable of int
+        Oversampling factors to calibrate.
+    fov_arcsec : float
+        Field of view for the test calculations
+    max_processes : int
+        Largest number of worker processes to try.
+    save : bool
+        Save results to the configuration directory?
+
+    Returns
+    -------
+    results : dict
+        Best settings found, keyed by "instrument:image_mask:oversample"
+    """
+    global _calibration
+    from . import webbpsf_core
+
+    if instruments is None: instruments = ['NIRCam', 'MIRI', 'NIRSpec', 'NIRISS', 'FGS']
+    configs = _candidate_configs(max_processes=max_processes)
+    # use enough wavelengths to keep every worker process busy
+    nlambda = max([c['n_processes'] for c in configs])
+
+    results = {}
+    for iname in instruments:
+        inst = webbpsf_core.Instrument(iname)
+        for image_mask in _CALIBRATION_MODES.get(iname, [None]):
+            inst.image_mask = image_mask
+            inst.pupil_mask = _CALIBRATION_PUPILS.get(image_mask, None) if image_mask is not None else (
+                    'NIRSpec grating' if iname == 'NIRSpec' else None)
+            for oversample in oversamples:
+                key = _tuning_key(iname, image_mask, oversample)
+                best = None
+                for config in configs:
+                    elapsed = _time_config(inst, config, oversample, nlambda, fov_arcsec)
+                    _log.info("Calibrating %s with %s: %.2f s" % (key, _describe(config), elapsed))
+                    if best is None or elapsed < best['time']:
+                        best = dict(config)
+                        best['time'] = elapsed
+                _log.info("Best for %s: %s" % (key, _describe(best)))
+                results[key] = best
+
+    _calibration = results
+    if save:
+        filename = _calibration_filename()
+        with open(filename, 'w') as f:
+            json.dump({'machine': _machine_info(), 'results': results}, f, indent=2, sort_keys=True)
+        _log.info("Saved parallelization calibration to "+filename)
+    return results
+
+
+def _describe(config):
+    return "%s processes, FFTW %s, %s BLAS threads" % (config['n_processes'] if config['use_multiprocessing'] else 1,
+            'on (%s threads)' % config['fftw_threads'] if config['use_fftw'] else 'off', config['blas_threads'])
+
+
+def _time_config(inst, config, oversample, nlambda, fov_arcsec):
+    """ Time a calculation with these parallelization settings, through propagation.calc_psf as calcPSF uses """
+    from . import propagation
+    apply_parallel_config(config)
+    nprocesses = config['n_processes'] if config['use_multiprocessing'] else 1
+
+    # First do a quick untimed calculation so that FFTW planning and file caching
+    # are excluded from the timing.
+    with thread_limits(config['blas_threads'], config['fftw_threads']):
+        inst._getOpticalSystem(fft_oversample=oversample, fov_arcsec=fov_arcsec).propagate_mono(2e-6 if inst.name != 'MIRI' else 10e-6)
+        optsys = inst._getOpticalSystem(fft_oversample=oversample, fov_arcsec=fov_arcsec)
+        wavelens, weights = inst._getWeights(source=None, nlambda=nlambda)
+        t0 = time.time()
+        propagation.calc_psf(optsys, wavelens, weights, nprocesses=nprocesses, budget=propagation.memory_budget())
+        elapsed = time.time() - t0
+    if config['use_fftw']: save_fftw_wisdom()
+    settings._apply_settings_to_poppy()
+    return elapsed
+
+
+def get_parallel_config(instrument_name, image_mask, oversample):
+    """ Return the parallelization settings to use for a calculation.
+
+    If `settings.autotune` is set and a calibration is available for this instrument and
+    image mask, the calibrated settings for the nearest oversampling are used.
+    Otherwise they come from the `use_multiprocessing`, `n_processes` and
+    `use_fftw` settings, with BLAS threads capped to share the available cores
+    between the worker processes.
+
+    Returns
+    -------
+    config : dict
+        Keys are 'use_multiprocessing', 'n_processes', 'use_fftw', 'fftw_threads',
+        'blas_threads', and 'source' which is either 'calibration' or 'settings'.
+    """
+    if settings.autotune():
+        calibration = _load_calibration()
+        prefix = _tuning_key(instrument_name, image_mask, 0)[:-1]
+        candidates = [(abs(int(k[len(prefix):]) - oversample), k) for k in calibration.keys() if k.startswith(prefix)]
+        if len(candidates) > 0:
+            config = dict(calibration[min(candidates)[1]])
+            config.pop('time', None)
+            config['source'] = 'calibration'
+            return config
+
+    ncpu = multiprocessing.cpu_count()
+    use_multiprocessing = settings.use_multiprocessing()
+    n_processes = settings.n_processes()
+    config = {'use_multiprocessing': use_multiprocessing, 'n_processes': n_processes,
+              'use_fftw': settings.use_fftw(), 'fftw_threads': None, 'blas_threads': None, 'source': 'settings'}
+    if use_multiprocessing and n_processes > 0:
+        config['blas_threads'] = max(1, ncpu // n_processes)
+        config['fftw_threads'] = max(1, ncpu // n_processes)
+    return config
+
+
+def apply_parallel_config(config):
+    """ Apply parallelization settings as returned by get_parallel_config to poppy """
+    import poppy
+    with _lock:
+        poppy.settings.use_multiprocessing.set(config['use_multiprocessing'])
+        poppy.settings.n_processes.set(config['n_processes'])
+        poppy.settings.use_fftw.set(config['use_fftw'])
+        if config['use_fftw']:
+            load_fftw_wisdom()
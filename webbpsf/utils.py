@@ -1,5 +1,7 @@
 #!/usr/bin/env python
 import os, sys
+import numpy as np
+import astropy.io.fits as fits
 
 import logging
 _log = logging.getLogger('webbpsf')
@@ -261,3 +263,291 @@ def system_diagnostic():
             pyfits=pyfits_version)
     return result
 
+
+
+
+def matrix_dft(plane, nlamD, npix, offset=(0.0, 0.0), inverse=False):
+    """ Matrix Fourier transform between a pupil and a (possibly rectangular) image region
+
+    This is the same symmetric-centered MFT used by poppy's MatrixFourierTransform,
+    generalized so that the output region may be rectangular and need not be centered
+    on the optical axis. This lets us compute the field only within a small box of the
+    image plane, such as the area enclosing a spectrograph slit or one tile of a large
+    detector, rather than the full padded FFT array.
+
+    Parameters
+    ----------
+    plane : 2D ndarray
+        Input complex field, either a pupil (forward) or an image region (inverse).
+    nlamD : float or 2-tuple
+        Size of the image region in units of lambda/D, where D is the full width of
+        the pupil array. Given as (Y, X) if a tuple.
+    npix : int or 2-tuple
+        Number of pixels across the output; (Y, X) if a tuple. For the inverse
+        transform this is the size of the pupil array to reconstruct.
+    offset : 2-tuple
+        Offset (Y, X) of the center of the image region from the optical axis, in
+        units of image region pixels.
+    inverse : bool
+        Transform from the image region back to the pupil instead.
+
+    Returns
+    -------
+    result : 2D ndarray
+        Transformed complex field. This is single precision (complex64) if the input
+        plane is, otherwise double precision.
+    """
+    if inverse:
+        expYV, expXU, norm_coeff = mft_matrices(npix, nlamD, plane.shape, offset, inverse=True)
+    else:
+        expYV, expXU, norm_coeff = mft_matrices(plane.shape, nlamD, npix, offset)
+    if plane.dtype == np.complex64:
+        # the phases are computed in double precision for accuracy, then the
+        # matrix products done in single precision for speed
+        expXU = expXU.astype(np.complex64)
+        expYV = expYV.astype(np.complex64)
+        norm_coeff = np.float32(norm_coeff)
+
+    if inverse:
+        return norm_coeff * np.dot(np.dot(expYV.T, plane), expXU.T)
+    else:
+        return norm_coeff * np.dot(np.dot(expYV, plane), expXU)
+
+
+def mft_matrices(pupil_shape, nlamD, npix, offset=(0.0, 0.0), inverse=False):
+    """ The matrices and normalization used by matrix_dft
+
+    The forward transform of a pupil plane P is norm * expYV . P . expXU, so
+    these can be reused to transform many planes with the same geometry.
+    Arguments are as for matrix_dft, with pupil_shape the (Y, X) shape of the pupil array.
+    """
+    if np.isscalar(nlamD): nlamD = (nlamD, nlamD)
+    if np.isscalar(npix): npix = (npix, npix)
+    if np.isscalar(pupil_shape): pupil_shape = (pupil_shape, pupil_shape)
+    nlamDY, nlamDX = float(nlamD[0]), float(nlamD[1])
+    npupY, npupX = int(pupil_shape[0]), int(pupil_shape[1])
+    npixY, npixX = int(npix[0]), int(npix[1])
+    sign = 1.0 if inverse else -1.0
+
+    dX, dY = 1.0/npupX, 1.0/npupY
+    dU, dV = nlamDX/npixX, nlamDY/npixY
+
+    Xs = (np.arange(npupX) - npupX/2.0 + 0.5) * dX
+    Ys = (np.arange(npupY) - npupY/2.0 + 0.5) * dY
+    Us = (np.arange(npixX) - npixX/2.0 + 0.5 + offset[1]) * dU
+    Vs = (np.arange(npixY) - npixY/2.0 + 0.5 + offset[0]) * dV
+
+    expXU = np.exp(sign * 2.0j * np.pi * np.outer(Xs, Us))
+    expYV = np.exp(sign * 2.0j * np.pi * np.outer(Vs, Ys))
+
+    norm_coeff = np.sqrt((nlamDY * nlamDX) / (npupY * npupX * npixY * npixX))
+    return expYV, expXU, norm_coeff
+
+
+
+def rebin_array(a, factor, out=None):
+    """ Sum an image over blocks of factor x factor pixels, e.g. to rebin an oversampled PSF onto detector pixels
+
+    This views the image as a 4D array of blocks using strides, and sums over the
+    block axes, so no copy of the input is made and the result can be written
+    directly into an existing array. This is equivalent to poppy.rebin_array, but
+    much faster for large arrays: faster even than copying the input.
+
+    Parameters
+    ----------
+    a : 2D ndarray
+        Image to rebin. It need not be square. If a dimension is not a multiple
+        of the factor, the leftover rows or columns are trimmed equally from
+        either side (with the extra one from the end, if the leftover is odd).
+    factor : int or 2-tuple
+        Number of pixels to sum along each axis, or (Y, X) factors.
+    out : 2D ndarray, optional
+        Array in which to place the result, of shape (a.shape[0]//factor, a.shape[1]//factor).
+
+    Returns
+    -------
+    out : 2D ndarray
+        Rebinned image
+    """
+    if np.isscalar(factor): factor = (factor, factor)
+    fy, fx = int(factor[0]), int(factor[1])
+    ny, nx = a.shape[0]//fy, a.shape[1]//fx
+    y0, x0 = (a.shape[0] - ny*fy)//2, (a.shape[1] - nx*fx)//2
+    trimmed = a[y0:y0+ny*fy, x0:x0+nx*fx]
+    blocks = np.lib.stride_tricks.as_strided(trimmed, shape=(ny, fy, nx, fx),
+            strides=(trimmed.strides[0]*fy, trimmed.strides[0], trimmed.strides[1]*fx, trimmed.strides[1]))
+    # summing down the rows of each block first adds whole contiguous rows at a time, which is
+    # several times faster than summing over both block axes at once
+    return np.add.reduce(np.add.reduce(blocks, axis=1), axis=2, out=out)
+
+
+def pixel_phases(a, factor, step=1, kernel=None):
+    """ Rebin an oversampled image onto detector pixels at every subpixel phase, e.g. for effective PSFs
+
+    Stamp (i, j) is the image binned with the pixel grid starting at oversampled pixel
+    (i*step, j*step), equivalent to the source displaced by -(i, j)*step/factor detector pixels.
+    All stamps are views of the one input image through strides, so nothing is shifted,
+    interpolated or copied, and they are computed together in one operation.
+
+    Parameters
+    ----------
+    a : 2D ndarray
+        Oversampled image
+    factor : int
+        Oversampling factor, i.e. the number of image pixels per detector pixel along each axis
+    step : int
+        Spacing of the phases in oversampled pixels; factor must be a multiple of it.
+    kernel : 2D ndarray, optional
+        Pixel response sampled on the oversampled grid, as weights for the image pixels that make
+        up each detector pixel, starting at its corner. It may be larger than factor x factor, to
+        include response spilling into neighbouring pixels. Default is uniform response, a plain sum.
+
+    Returns
+    -------
+    stamps : 4D ndarray
+        Detector-sampled images, shape (factor//step, factor//step, ny, nx). All have the same
+        size, which is one pixel less than rebin_array gives along an axis if needed to fit every phase.
+    """
+    factor, step = int(factor), int(step)
+    if factor % step != 0:
+        raise ValueError("The oversampling factor %d is not a multiple of the phase step %d" % (factor, step))
+    nphases = factor // step
+    ky, kx = (factor, factor) if kernel is None else kernel.shape
+    ny = (a.shape[0] - (nphases-1)*step - ky)//factor + 1
+    nx = (a.shape[1] - (nphases-1)*step - kx)//factor + 1
+    if ny < 1 or nx < 1:
+        raise ValueError("Image of shape %s is too small for %dx%d pixel phases" % (a.shape, nphases, nphases))
+    a = np.ascontiguousarray(a)
+    sy, sx = a.strides
+    view = np.lib.stride_tricks.as_strided(a, shape=(nphases, nphases, ny, nx, ky, kx),
+            strides=(sy*step, sx*step, sy*factor, sx*factor, sy, sx))
+    if kernel is None:
+        return np.add.reduce(np.add.reduce(view, axis=4), axis=4)
+    return np.einsum('ijyxab,ab->ijyx', view, np.asarray(kernel, dtype=a.dtype))
+
+
+
+#---- compact output formats
+
+_COMPRESSION_TYPES = ['RICE_1', 'GZIP_1', 'GZIP_2', 'HCOMPRESS_1', 'PLIO_1']
+
+# header keywords describing the data array itself, which belong to each HDU rather than being copied between them
+_STRUCTURAL_KEYWORDS = ['SIMPLE', 'XTENSION', 'BITPIX', 'NAXIS', 'NAXIS1', 'NAXIS2', 'NAXIS3', 'EXTEND',
+        'PCOUNT', 'GCOUNT', 'BSCALE', 'BZERO', 'CHECKSUM', 'DATASUM']
+
+
+def _image_hdus(hdulist):
+    return [hdu for hdu in hdulist if isinstance(hdu, (fits.PrimaryHDU, fits.ImageHDU)) and hdu.data is not None]
+
+
+def _crop_core(hdu, core_arcsec):
+    """ Crop an image HDU to its central core_arcsec, keeping its center on the same pixel boundary or pixel center """
+    pixelscale = hdu.header['PIXELSCL']
+    if np.isscalar(core_arcsec): core_arcsec = (core_arcsec, core_arcsec)
+    slices = []
+    for axis, size in enumerate(hdu.data.shape):
+        npix = min(int(np.ceil(core_arcsec[axis]/pixelscale)), size)
+        if (size - npix) % 2 == 1: npix += 1    # keep the same parity, so the crop is symmetric
+        start = (size - npix)//2
+        slices.append(slice(start, start+npix))
+    hdu.data = hdu.data[tuple(slices)].copy()
+    hdu.header.update('COREFOVX', core_arcsec[1], '[arcsec] Oversampled PSF cropped to this core FOV in X')
+    hdu.header.update('COREFOVY', core_arcsec[0], '[arcsec] Oversampled PSF cropped to this core FOV in Y')
+
+
+def compact_output(hdulist, dtype=None, oversampled=True):
+    """ Reduce the size of a PSF HDUList, in place, for writing to disk
+
+    Parameters
+    ----------
+    hdulist : fits.HDUList
+        PSF as returned by calcPSF, with the oversampled PSF in the primary HDU and
+        optionally a detector-sampled extension named DET_SAMP.
+    dtype : string or numpy dtype, optional
+        Convert all image data to this type, e.g. 'float32', which halves the size
+        of the file. Default is to leave the data as computed (float64).
+    oversampled : bool or float
+        True to keep the oversampled PSF; False to drop it, leaving just the
+        detector-sampled PSF as the primary HDU; or a field of view size in arcsec
+        (or a 2-tuple of (Y, X) sizes) to keep only that central core of the oversampled
+        PSF, while the detector-sampled extension keeps the full field of view.
+
+    Returns
+    -------
+    hdulist : fits.HDUList
+        The same HDUList, modified.
+    """
+    if oversampled is not True and oversampled is not None:
+        extnames = [hdu.header.get('EXTNAME', '') for hdu in hdulist]
+        if oversampled is False:
+            if 'DET_SAMP' in extnames:
+                detector = hdulist[extnames.index('DET_SAMP')]
+                hdulist[0].data = detector.data
+                for key in ['OVERSAMP', 'CALCSAMP', 'PIXELSCL']:
+                    if key in detector.header:
+                        hdulist[0].header.update(key, detector.header[key], detector.header.comments[key])
+                hdulist.remove(detector)
+            elif hdulist[0].header.get('OVERSAMP', 1) > 1:
+                _log.warn("No detector-sampled extension in this PSF to replace the oversampled one; keeping it.")
+        else:
+            _crop_core(hdulist[0], oversampled)
+
+    if dtype is not None:
+        dtype = np.dtype(dtype)
+        for hdu in _image_hdus(hdulist):
+            if hdu.data.dtype != dtype:
+                hdu.data = hdu.data.astype(dtype)
+    return hdulist
+
+
+def _compressed_hdu(data, header, compression):
+    # lossless for GZIP; the other algorithms quantize floating point data (see the astropy docs)
+    quantize = 0.0 if compression.startswith('GZIP') else 16.0
+    try:
+        return fits.CompImageHDU(data=data, header=header, compression_type=compression, quantize_level=quantize)
+    except TypeError:
+        # astropy < 0.3 keyword names
+        return fits.CompImageHDU(data=data, header=header, compressionType=compression, quantizeLevel=quantize)
+
+
+def write_fits(hdulist, filename, compression=None, clobber=False):
+    """ Write a PSF HDUList to a file, optionally using FITS tile compression
+
+    Parameters
+    ----------
+    hdulist : fits.HDUList
+        PSF to write
+    filename : string
+        Output filename
+    compression : string, optional
+        None for an ordinary FITS file, or a tile compression algorithm: 'GZIP_2'
+        (lossless, and usually the best choice for PSFs), 'GZIP_1' (lossless),
+        or 'RICE_1' or 'HCOMPRESS_1' (lossy for floating point data).
+        Since the primary HDU of a FITS file cannot be compressed, compressed
+        files keep the header in an empty primary HDU, with each image in a
+        compressed extension. The oversampled PSF goes in an extension named
+        OVERSAMP, or DET_SAMP if it is detector sampled.
+    clobber : bool
+        Overwrite an existing file?
+    """
+    if compression is None or str(compression).lower() == 'none':
+        hdulist.writeto(filename, clobber=clobber)
+        return
+    compression = compression.upper()
+    if compression not in _COMPRESSION_TYPES:
+        raise ValueError("Unknown FITS compression type %s; must be one of %s" % (compression, ", ".join(_COMPRESSION_TYPES)))
+
+    images = _image_hdus(hdulist)
+    output = fits.HDUList([fits.PrimaryHDU(header=hdulist[0].header.copy())])
+    for i, hdu in enumerate(hdulist):
+        if not any([hdu is image for image in images]):
+            if i > 0: output.append(hdu)
+            continue
+        header = fits.Header()
+        for card in hdu.header.cards:
+            if card.keyword not in _STRUCTURAL_KEYWORDS and card.keyword not in ('HISTORY', 'COMMENT', ''):
+                header.update(card.keyword, card.value, card.comment)
+        if i == 0:
+            header.update('EXTNAME', 'OVERSAMP' if hdu.header.get('OVERSAMP', 1) > 1 else 'DET_SAMP')
+        output.append(_compressed_hdu(hdu.data, header, compression))
+    output.writeto(filename, clobber=clobber)
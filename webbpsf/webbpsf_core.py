@@ -24,6 +24,7 @@ the logger name "webbpsf".
 Code by Marshall Perrin <mperrin@stsci.edu>
 """
 import os
+import copy
 import types
 import glob
 import time
@@ -40,6 +41,12 @@ from astropy.config import ConfigurationItem, get_config_dir, save_config
 import poppy
 
 from . import settings
+from . import tuning
+from . import propagation
+from . import profiling
+from . import utils
+from . import wfe
+from . import jitter
 
 
 try: 
@@ -95,7 +102,13 @@ class JWInstrument(poppy.instrument.Instrument):
         For output files, write an additional FITS extension including a version of the output array 
         rebinned down to the actual detector pixel scale?
     jitter : string
-        Type of jitter model to apply. Currently not implemented
+        Type of pointing jitter to apply to the PSF: None, 'gaussian', or 'timeseries'. See `webbpsf.jitter`.
+    jitter_sigma : float or 2-tuple
+        For Gaussian jitter, the rms per axis in arcsec (default 0.007), or (major, minor) for elliptical jitter
+    jitter_angle : float
+        For elliptical jitter, the angle of the major axis in degrees counterclockwise from +X
+    jitter_timeseries : 2-tuple of arrays
+        For timeseries jitter, the (x, y) line of sight offsets in arcsec, sampled uniformly in time
     parity : string "even" or "odd"
         You may wish to ensure that the output PSF grid has either an odd or even number of pixels.
         Setting this option will force that to be the case by increasing npix by one if necessary.
@@ -109,6 +122,13 @@ class JWInstrument(poppy.instrument.Instrument):
         Set this to prevent the SemiAnalyticMethod coronagraph mode from being used when possible, and instead do
         the brute-force FFT calculations. This is usually not what you want to do, but is available for comparison tests.
         The SAM code will in general be much faster than the FFT method, particularly for high oversampling.
+    zernike_coeffs : list of floats
+        Zernike aberrations to add to the OPD, as RMS wavefront error in meters for each Noll term
+        starting with piston, over the circle circumscribing the pupil. See `webbpsf.wfe`.
+    hexike_coeffs : dict or ndarray
+        Hexike aberrations of individual segments to add to the OPD, as {segment name: list of RMS wavefront
+        errors in meters for each term starting with piston}, or an array of shape (18, nterms) in the order
+        of `webbpsf.wfe.SEGMENTS`.
 
     """
 
@@ -163,6 +183,10 @@ class JWInstrument(poppy.instrument.Instrument):
         self.filter = self.filter_list[0]
         self._rotation = None
 
+        self.last_profile = None
+        "webbpsf.profiling.CalcProfile giving timings and memory use for the most recent calcPSF call"
+        self._profile = None # profile for the calculation in progress, if any
+
 
         #self.opd_list = [os.path.basename(os.path.abspath(f)) for f in glob.glob(self._datapath+os.sep+'OPD/*.fits')]
         self.opd_list = [os.path.basename(os.path.abspath(f)) for f in glob.glob(self._datapath+os.sep+'OPD/OPD*.fits')]
@@ -318,6 +342,47 @@ class JWInstrument(poppy.instrument.Instrument):
             Options for saving to disk or returning to the calling function the intermediate optical planes during the propagation. 
             This is useful if you want to e.g. examine the intensity in the Lyot plane for a coronagraphic propagation. These have no
             effect for simple direct imaging calculations.
+        wavelength_callback : callable, optional
+            Function to be called with a `webbpsf.propagation.WavelengthResult` as each wavelength
+            completes, from the thread that called calcPSF. GUIs can use this to update their display
+            while a calculation runs on multiple threads (see `settings.use_threads`).
+        progress_callback : callable, optional
+            Function to be called with a `webbpsf.propagation.ProgressEvent` after each wavelength,
+            and after each optical plane when planes are computed in this process, with timings.
+        cancel_token : webbpsf.propagation.CancelToken, optional
+            Call `cancel()` on this token, from any thread, to stop the calculation. It is checked
+            between wavelengths and between planes. A cancelled calculation raises
+            `webbpsf.propagation.CalculationCancelled`, unless `return_partial` is set.
+        return_partial : bool
+            If the calculation is cancelled, return the weighted sum of the wavelengths completed
+            so far instead of raising an exception. The CANCELLD header keyword marks such results.
+        precision : string, optional
+            'single' to propagate complex64 wavefronts, using half the memory and running faster,
+            or 'double'. The weighted sum over wavelengths is accumulated in double precision
+            either way. Default is `settings.precision`.
+        profile_output : string, optional
+            The time and peak memory for each stage of the calculation are always recorded in
+            `self.last_profile`. Set this to 'header' to also write the main stage times to FITS
+            header keywords, 'table' to append a PROFILE table extension with all stages and
+            wavelengths, or 'both'.
+        output_dtype : string, optional
+            Data type for the output images, e.g. 'float32' to halve the file size. Default is
+            `settings.output_dtype`.
+        output_compression : string, optional
+            FITS tile compression to use when writing `outfile`, e.g. 'GZIP_2'. Compressed files
+            hold each image in a compressed extension after an empty primary HDU; see
+            `webbpsf.utils.write_fits`. Default is `settings.output_compression`.
+        output_oversampled : bool or float, optional
+            Set False to drop the oversampled PSF from the output, keeping only the detector
+            sampled one, or to a size in arcsec (or a (Y, X) tuple of sizes) to keep only that
+            central core of the oversampled PSF. Default is True, to keep all of it.
+        tile_pixels : int, optional
+            For direct imaging over very large fields of view, compute the detector plane in tiles
+            of this many oversampled pixels on a side, so that memory use scales with the tile size
+            rather than the field of view. See `webbpsf.propagation.calc_psf_tiled`.
+        tile_file : string, optional
+            With tile_pixels, a .npy file to hold the oversampled PSF as a memory-mapped array, which
+            the returned HDUList then uses for its data.
 
 
         For additional arguments, see the documentation for poppy.OpticalSystem.calcPSF()
@@ -335,118 +400,688 @@ class JWInstrument(poppy.instrument.Instrument):
         if calc_oversample is not None: fft_oversample = calc_oversample # back compatibility hook for deprecated arg name.
 
         _log.info("Setting up PSF calculation for "+self.name)
+        profile = profiling.CalcProfile(self.name)
+        self._profile = profile
+        try:
+            profile_output = kwargs.pop('profile_output', None)
+            if profile_output not in (None, False, 'header', 'table', 'both'):
+                raise ValueError("profile_output must be one of None, 'header', 'table', or 'both'.")
+
+            # first make sure that webbpsf's settings are used to override any of the
+            # same settings in poppy. This is admittedly perhaps overbuilt to have identical
+            # settings in both packages, but the intent is to shield typical users of webbpsf
+            # from having to think about the existence of the underlying library. They can 
+            # just deal with one set of settings.
+            settings._apply_settings_to_poppy()
+
+            if filter is not None:
+                self.filter = filter
+
+            local_options = self.options.copy()  # all local state should be stored in a dict, for
+                                          # ease of handing off to the various subroutines of
+                                          # calcPSF. Don't just modify the global self.options
+                                          # structure since that would pollute it with temporary
+                                          # state as well as persistent state.
+            local_options['monochromatic'] = monochromatic
+            local_options['output_dtype'] = kwargs.pop('output_dtype', None) or settings.output_dtype()
+            local_options['output_oversampled'] = kwargs.pop('output_oversampled', True)
+            output_compression = kwargs.pop('output_compression', None) or settings.output_compression()
 
-        # first make sure that webbpsf's settings are used to override any of the
-        # same settings in poppy. This is admittedly perhaps overbuilt to have identical
-        # settings in both packages, but the intent is to shield typical users of webbpsf
-        # from having to think about the existence of the underlying library. They can 
-        # just deal with one set of settings.
-        settings._apply_settings_to_poppy()
 
-        if filter is not None:
-            self.filter = filter
+    
+            #----- choose # of wavelengths intelligently. Do this first before generating the source spectrum weighting.
+            if nlambda is None or nlambda==0:
+                # Automatically determine number of appropriate wavelengths.
+                # Make selection based on filter configuration file
+                try:
+                    nlambda = self._filter_nlambda_default[self.filter]
+                    _log.debug("Automatically selecting # of wavelengths: %d" % nlambda)
+                except:
+                    nlambda=10
+                    _log.warn("unrecognized filter %s. setting default nlambda=%d" % (self.filter, nlambda))
+            local_options['nlambda'] = nlambda
+
+
+
+            #----- calculate field of view depending on supplied parameters
+            if fov_arcsec is None and fov_pixels is None:  #pick decent defaults.
+                if self.name =='MIRI': fov_arcsec=12.
+                else: fov_arcsec=5.
+                fov_spec = 'arcsec = %f' % fov_arcsec
+            elif fov_pixels is not None:
+
+                if np.isscalar(fov_pixels): 
+                    fov_spec = 'pixels = %d' % fov_pixels
+                else:
+                    fov_spec = 'pixels = (%d, %d)' % (fov_pixels[0], fov_pixels[1])
+            elif fov_arcsec is not None:
+                if np.isscalar(fov_arcsec): 
+                    fov_spec = 'arcsec = %f' % fov_arcsec
+                else:
+                    fov_spec = 'arcsec = (%.3f, %.3f)' % (fov_arcsec[0], fov_arcsec[1])
+
+            _log.debug('FOV set to '+fov_spec)
+
+            #---- Implement the semi-convoluted logic for the oversampling options. See docstring above
+            if oversample is not None and detector_oversample is not None and fft_oversample is not None:
+                # all options set, contradictorily -> complain!
+                raise ValueError("You cannot specify simultaneously the oversample= option with the detector_oversample and fft_oversample options. Pick one or the other!")
+            elif oversample is None and detector_oversample is None and fft_oversample is None:
+                # nothing set -> set oversample = 4
+                oversample = settings.default_oversampling()
+            if detector_oversample is None: detector_oversample = oversample
+            if fft_oversample is None: fft_oversample = oversample
+            local_options['detector_oversample']=detector_oversample
+            local_options['fft_oversample']=fft_oversample
+
+
+            _log.info("PSF calc using fov_%s, oversample = %d, nlambda = %d" % (fov_spec, detector_oversample, nlambda) )
+
+            #----- compute weights for each wavelength based on source spectrum
+            with profile.stage('weights'):
+                wavelens, weights = self._getWeights(source=source, nlambda=nlambda, monochromatic=monochromatic)
+
+
+            #---- now at last, actually do the PSF calc:
+            #  instantiate an optical system using the current parameters
+            with profile.stage('optsys'):
+                self.optsys = self._getOpticalSystem(fov_arcsec=fov_arcsec, fov_pixels=fov_pixels,
+                    fft_oversample=fft_oversample, detector_oversample=detector_oversample, options=local_options)
+            #---- choose parallelization settings, either calibrated for this machine or from the configuration
+            parallel_config = tuning.get_parallel_config(self.name, self.image_mask, fft_oversample)
+            use_threads = settings.use_threads()
+            if use_threads:
+                # one wavelength per thread, so avoid oversubscribing the cores with nested threads
+                parallel_config.update(use_multiprocessing=False, blas_threads=1, fftw_threads=1)
+            elif display and parallel_config['use_multiprocessing']:
+                # intermediate planes can only be displayed from this process.
+                parallel_config.update(use_multiprocessing=False, blas_threads=None, fftw_threads=None)
+            tuning.apply_parallel_config(parallel_config)
+            _log.debug("Parallelization settings from %s: %s" % (parallel_config['source'], tuning._describe(parallel_config)))
+
+            wavelength_callback = kwargs.pop('wavelength_callback', None)
+            progress_callback = kwargs.pop('progress_callback', None)
+            cancel_token = kwargs.pop('cancel_token', None)
+            return_partial = kwargs.pop('return_partial', False)
+            precision = kwargs.pop('precision', None) or settings.precision()
+            tile_pixels = kwargs.pop('tile_pixels', None)
+            tile_file = kwargs.pop('tile_file', None)
+            if display:
+                # show each wavelength's planes as it completes, from this thread
+                user_callback = wavelength_callback
+                def wavelength_callback(wavelength_result):
+                    propagation.display_intermediates(wavelength_result.intermediates)
+                    if user_callback is not None: user_callback(wavelength_result)
+
+            # and use it to compute the PSF (the real work happens here, in propagation.py and poppy)
+            with profile.stage('propagate'), tuning.thread_limits(parallel_config['blas_threads'], parallel_config['fftw_threads']):
+                monitored = progress_callback is not None or cancel_token is not None
+                if tile_pixels is not None:
+                    # direct imaging over large fields: the detector plane a tile at a time, into a memory map if requested
+                    result = propagation.calc_psf_tiled(self.optsys, wavelens, weights, tile=tile_pixels,
+                            nworkers=parallel_config['n_processes'] if use_threads else 1, filename=tile_file,
+                            dtype=local_options['output_dtype'], normalize=kwargs.get('normalize', 'first'),
+                            cancel_token=cancel_token)
+                elif return_intermediates or kwargs.get('save_intermediates', False) or (display and not use_threads and not monitored):
+                    # these calculations go through poppy's own loop, which knows how to display and save each plane
+                    if monitored:
+                        _log.warn("Progress callbacks and cancellation are not available when saving or returning intermediate planes.")
+                    if precision != 'double':
+                        _log.warn("Single precision is not available when saving, returning or displaying intermediate planes this way; using double.")
+                    result = self.optsys.calcPSF(wavelens, weights, display_intermediates=display, display=display, return_intermediates=return_intermediates, **kwargs)
+                else:
+                    if use_threads:
+                        nprocesses = parallel_config['n_processes']
+                    else:
+                        nprocesses = parallel_config['n_processes'] if parallel_config['use_multiprocessing'] else 1
+                    result = propagation.calc_psf(self.optsys, wavelens, weights, normalize=kwargs.get('normalize', 'first'),
+                            nprocesses=nprocesses, budget=propagation.memory_budget(), use_threads=use_threads,
+                            callback=wavelength_callback, return_intermediates=display,
+                            progress=progress_callback, cancel_token=cancel_token, return_partial=return_partial,
+                            profile=profile, precision=precision)
+                    if display:
+                        plt.clf()
+                        poppy.display_PSF(result)
+            if parallel_config['use_fftw']:
+                tuning.save_fftw_wisdom()
+
+            if return_intermediates: # this implies we got handed back a tuple, so split it apart
+                result, intermediates = result
+
+            with profile.stage('jitter'):
+                if tile_pixels is not None and jitter.options_model(local_options) is not None:
+                    # that would need the whole image in memory at once
+                    _log.warn("Jitter is not applied to PSFs computed in tiles.")
+                else:
+                    result[0].data = self._apply_jitter(result[0].data, result[0].header, local_options)
+
+            with profile.stage('header'):
+                self._getFITSHeader(result, local_options)
+
+            with profile.stage('format'):
+                self._calcPSF_format_output(result, local_options)
+        finally:
+            # also when cancelled or failed, so later calls don't record into this profile
+            self._profile = None
+        self.last_profile = profile
+        if profile_output in ('header', 'both'):
+            profile.to_header(result[0].header)
+        if profile_output in ('table', 'both'):
+            result.append(profile.to_table_hdu())
 
-        local_options = self.options.copy()  # all local state should be stored in a dict, for
-                                      # ease of handing off to the various subroutines of
-                                      # calcPSF. Don't just modify the global self.options
-                                      # structure since that would pollute it with temporary
-                                      # state as well as persistent state.
-        local_options['monochromatic'] = monochromatic
 
+        if display:
+            f = plt.gcf()
+            #p.text( 0.1, 0.95, "%s, filter= %s" % (self.name, self.filter), transform=f.transFigure, size='xx-large')
 
-    
-        #----- choose # of wavelengths intelligently. Do this first before generating the source spectrum weighting.
-        if nlambda is None or nlambda==0:
-            # Automatically determine number of appropriate wavelengths.
-            # Make selection based on filter configuration file
+            if monochromatic is None:
+                plt.suptitle( "%s, filter= %s" % (self.name, self.filter), size='xx-large')
+                plt.text( 0.99, 0.04, "Calculation with %d wavelengths (%g - %g um)" % (nlambda, wavelens[0]*1e6, wavelens[-1]*1e6), transform=f.transFigure, horizontalalignment='right')
+            else:
+                plt.suptitle( "{self.name},  $\lambda$ = {wavelen} um".format(self=self, wavelen = monochromatic*1e6), size='xx-large')
+ 
+        if outfile is not None:
+            result[0].header.update ("FILENAME", os.path.basename (outfile),
+                           comment="Name of this file")
+            with profile.stage('write'):
+                utils.write_fits(result, outfile, compression=output_compression, clobber=clobber)
+            _log.info("Saved result to "+outfile)
+        _log.debug(profile.summary())
+
+        if return_intermediates:
+            return result, intermediates
+        else:
+            return result
+
+    def calcPSF_async(self, **kwargs):
+        """ Start calcPSF on a worker thread, returning an asyncio Future for the result
+
+        For use from within an asyncio event loop, which this does not block. The
+        instrument is copied as currently configured. Concurrent requests for identical
+        calculations share one computation, and cancelling the Future cancels the
+        calculation. Arguments are as for calcPSF. See `webbpsf.asyncpsf`.
+        """
+        from . import asyncpsf
+        return asyncpsf.calcPSF_async(self, **kwargs)
+
+    def calcPSF_opd_cube(self, opd=None, slices=None, nprocesses=None, outfile=None, clobber=True, **kwargs):
+        """ Compute PSFs for every realization in a cube of OPDs
+
+        This is equivalent to calling calcPSF with pupilopd=(opd, i) for each slice i, but
+        much faster: the OPD cube and pupil are read once, the wavelength weights and the
+        rest of the optical system (coronagraph masks, Lyot stops, etc.) are computed once
+        for the first slice and reused, and for each further slice only the pupil plane
+        with that slice's OPD is rebuilt. The slices are computed in parallel on threads.
+
+        Parameters
+        ----------
+        opd : string or fits.HDUList, optional
+            OPD file name, either a full path or a file in the instrument's OPD directory,
+            or an OPD cube in microns already in memory (e.g. from `webbpsf.wfe`).
+            Default is the file of the currently selected pupilopd.
+        slices : list of ints, optional
+            Which slices of the cube to compute. Default is all of them.
+        nprocesses : int, optional
+            Number of slices to compute at once. Default is `settings.n_processes`; this
+            is reduced if needed to fit within the memory budget.
+        outfile : string, optional
+            Filename to write the result to.
+
+        Other keyword arguments are passed to calcPSF for the first slice, and the same
+        sampling, source spectrum, options, etc. are used for all slices.
+
+        Returns
+        -------
+        psfs : fits.HDUList
+            The PSFs as a cube with one plane per slice, in the primary HDU, plus a cube of
+            detector-sampled PSFs in a DET_SAMP extension depending on the output mode.
+            Header keywords SLICE0, SLICE1, ... give the OPD slice for each plane.
+        """
+        #---- read the OPD cube and the pupil once
+        if opd is None:
+            opd = self.pupilopd[0] if isinstance(self.pupilopd, (tuple, list)) else self.pupilopd
+        if isinstance(opd, fits.HDUList):
+            opd_hdulist, opd_name = opd, opd[0].header.get('OPDFILE', 'in-memory OPD cube')
+        elif isinstance(opd, basestring):
+            opd_path = opd if os.path.exists(opd) else os.path.join(self._datapath, "OPD", opd)
+            opd_hdulist, opd_name = fits.open(opd_path), os.path.basename(opd_path)
+        else:
+            raise ValueError("Specify the OPD cube to use as a filename or HDUList.")
+        cube = opd_hdulist[0].data
+        if cube.ndim == 2: cube = cube[np.newaxis]
+        if slices is None: slices = range(cube.shape[0])
+        slices = list(slices)
+        def slice_hdulist(i):
+            return fits.HDUList([fits.PrimaryHDU(data=cube[i], header=opd_hdulist[0].header.copy())])
+
+        if isinstance(self.pupil, fits.HDUList):
+            pupil = self.pupil
+        else:
+            pupil = fits.open(self.pupil if os.path.exists(self.pupil) else os.path.join(self._WebbPSF_basepath, self.pupil))
+
+        #---- the first slice goes through calcPSF, which sets up the optical system and weights
+        saved = self.pupil, self.pupilopd
+        self.pupil, self.pupilopd = pupil, slice_hdulist(slices[0])
+        try:
+            first, wavelens, weights = self._calcPSF_oversampled(**kwargs)
+        finally:
+            self.pupil, self.pupilopd = saved
+        header = first[0].header
+        base_optsys = self.optsys
+        pupil_indices = [i for i, p in enumerate(base_optsys.planes) if p.name == 'JWST Pupil']
+        if len(pupil_indices) == 0:
+            raise ValueError("OPD cubes need an optical system with a 'JWST Pupil' plane, which %s does not have "
+                    "in this configuration." % self.name)
+        pupil_index = pupil_indices[0]
+
+        #---- then only the OPD in the pupil plane changes for the rest. The transmission was read
+        # and rotated once already for the first slice, so reuse that and rotate each OPD to match.
+        optsys_copies = propagation._ThreadLocalOpticalSystems(base_optsys)
+        precision = kwargs.get('precision', None) or settings.precision()
+        rotation = self._rotation
+        extra_opd = wfe.modal_opd(self.options, pupil=pupil)
+        def compute_slice(i):
+            optsys = optsys_copies.get()
+            opd = cube[i] if extra_opd is None else cube[i] + extra_opd
+            opd = opd * 1e-6 # microns to meters
+            if rotation: opd = scipy.ndimage.rotate(opd, rotation, reshape=False)
+            element = copy.copy(optsys.planes[pupil_index])
+            element.opd = opd
+            optsys.planes[pupil_index] = element
+            result = propagation.calc_psf(optsys, wavelens, weights, normalize=kwargs.get('normalize', 'first'),
+                    nprocesses=1, precision=precision)
+            return result[0].data
+
+        if nprocesses is None: nprocesses = settings.n_processes()
+        nworkers, per_wavelength = propagation.plan_schedule(base_optsys, len(slices)-1, nprocesses, budget=propagation.memory_budget())
+        nworkers = max(nworkers, 1)
+        _log.info("Computing PSFs for %d OPD slices from %s, %d at a time" % (len(slices), opd, nworkers))
+        if nworkers > 1:
+            import multiprocessing.pool
+            pool = multiprocessing.pool.ThreadPool(nworkers)
             try:
-                nlambda = self._filter_nlambda_default[self.filter]
-                _log.debug("Automatically selecting # of wavelengths: %d" % nlambda)
-            except:
-                nlambda=10
-                _log.warn("unrecognized filter %s. setting default nlambda=%d" % (self.filter, nlambda))
-        local_options['nlambda'] = nlambda
+                with tuning.thread_limits(1, 1):
+                    rest = pool.map(compute_slice, slices[1:])
+            finally:
+                pool.terminate()
+        else:
+            rest = [compute_slice(i) for i in slices[1:]]
 
+        #---- assemble the cube
+        psf_cube = np.asarray([first[0].data] + rest, dtype=first[0].data.dtype)
+        header.update('OPDFILE', opd_name, 'OPD realizations file')
+        header.update('NSLICES', len(slices), 'Number of OPD realizations in this cube')
+        for n, i in enumerate(slices):
+            header.update('SLICE%d' % n, i, 'OPD slice for plane %d of this cube' % n)
+        return self._cube_output(psf_cube, header, outfile=outfile, clobber=clobber,
+                compression=kwargs.get('output_compression', None))
 
+    def calcPSF_jacobian(self, modes='zernike', nterms=11, chunk=8, outfile=None, clobber=True, **kwargs):
+        """ Compute a PSF and its first-order sensitivity to each of a set of wavefront modes
 
-        #----- calculate field of view depending on supplied parameters
-        if fov_arcsec is None and fov_pixels is None:  #pick decent defaults.
-            if self.name =='MIRI': fov_arcsec=12.
-            else: fov_arcsec=5.
-            fov_spec = 'arcsec = %f' % fov_arcsec
-        elif fov_pixels is not None:
+        The derivative of the PSF with respect to each mode coefficient is computed analytically,
+        for all modes and wavelengths in one pass, rather than by finite differences. Approximate
+        PSFs for small coefficients then follow as the PSF plus a matrix product with the Jacobian;
+        see `webbpsf.sensitivity.linear_psf`.
 
-            if np.isscalar(fov_pixels): 
-                fov_spec = 'pixels = %d' % fov_pixels
-            else:
-                fov_spec = 'pixels = (%d, %d)' % (fov_pixels[0], fov_pixels[1])
-        elif fov_arcsec is not None:
-            if np.isscalar(fov_arcsec): 
-                fov_spec = 'arcsec = %f' % fov_arcsec
-            else:
-                fov_spec = 'arcsec = (%.3f, %.3f)' % (fov_arcsec[0], fov_arcsec[1])
+        This is only available for direct imaging, not for coronagraphs.
 
-        _log.debug('FOV set to '+fov_spec)
+        Parameters
+        ----------
+        modes : string or ndarray
+            'zernike' or 'hexike' for those modes (with coefficients in meters RMS, as for
+            options['zernike_coeffs']), 'segments' for segment pose parameters (in meters and radians),
+            any basis from `webbpsf.wfe`, or a cube of OPD maps in meters on the pupil grid.
+        nterms : int
+            Number of Zernike or hexike terms (per segment, for hexikes)
+        chunk : int
+            Number of modes to compute at once; higher is faster but uses more memory.
+        outfile : string, optional
+            Filename to write the result to.
+
+        Other keyword arguments are as for calcPSF.
 
-        #---- Implement the semi-convoluted logic for the oversampling options. See docstring above
-        if oversample is not None and detector_oversample is not None and fft_oversample is not None:
-            # all options set, contradictorily -> complain!
-            raise ValueError("You cannot specify simultaneously the oversample= option with the detector_oversample and fft_oversample options. Pick one or the other!")
-        elif oversample is None and detector_oversample is None and fft_oversample is None:
-            # nothing set -> set oversample = 4
-            oversample = settings.default_oversampling()
-        if detector_oversample is None: detector_oversample = oversample
-        if fft_oversample is None: fft_oversample = oversample
-        local_options['detector_oversample']=detector_oversample
-        local_options['fft_oversample']=fft_oversample
+        Returns
+        -------
+        result : fits.HDUList
+            The PSF in the primary HDU, and the derivatives in a cube in the JACOBIAN extension,
+            with keywords MODE0, MODE1, ... naming the modes. Depending on the output mode, also
+            detector-sampled versions in DET_SAMP and JAC_DET extensions.
+        """
+        from . import sensitivity
+        if isinstance(self.pupil, fits.HDUList):
+            pupil = self.pupil
+        else:
+            pupil = self.pupil if os.path.exists(self.pupil) else os.path.join(self._WebbPSF_basepath, self.pupil)
+        if modes in ('zernike', 'hexike'):
+            modes = wfe.get_modal_basis(modes, nterms, pupil)
+        elif modes == 'segments':
+            modes = wfe.get_basis(pupil)
+
+        first, wavelens, weights = self._calcPSF_oversampled(**kwargs)
+        propagation.check_direct_imaging(self.optsys)
+        psf, jacobian = sensitivity.psf_jacobian(self.optsys, wavelens, weights, modes,
+                normalize=kwargs.get('normalize', 'first'), rotation=self._rotation, chunk=chunk)
+        # jitter is a linear operation on the intensity, so applies to the derivatives just the same
+        psf = self._apply_jitter(psf, first[0].header, self.options)
+        jacobian = self._apply_jitter(jacobian, first[0].header, self.options)
+        names = modes.names if isinstance(modes, wfe._PupilBasis) else ['M%d' % k for k in range(jacobian.shape[0])]
+
+        result = fits.HDUList([fits.PrimaryHDU(data=psf, header=first[0].header)])
+        jac_hdu = fits.ImageHDU(data=jacobian)
+        jac_hdu.header.update('EXTNAME', 'JACOBIAN', 'Derivative of the PSF with respect to each mode')
+        jac_hdu.header.update('NMODES', len(names), 'Number of wavefront modes')
+        for k, name in enumerate(names):
+            jac_hdu.header.update('MODE%d' % k, name, 'Wavefront mode for plane %d' % k)
+        result.append(jac_hdu)
+
+        output_mode = self.options.get('output_mode', settings.default_output_mode())
+        detector_oversample = first[0].header.get('DET_SAMP', 1)
+        if output_mode in ('Both as FITS extensions', 'both', 'Detector sampled image', 'detector') and detector_oversample > 1:
+            det_hdu = fits.ImageHDU(data=utils.rebin_array(psf, detector_oversample), header=first[0].header.copy())
+            self._set_detector_sampled_keywords(det_hdu.header, detector_oversample)
+            det_hdu.header.update('EXTNAME', 'DET_SAMP')
+            jac_det = fits.ImageHDU(data=np.asarray([utils.rebin_array(plane, detector_oversample) for plane in jacobian]),
+                                    header=jac_hdu.header.copy())
+            jac_det.header.update('EXTNAME', 'JAC_DET')
+            result.extend([det_hdu, jac_det])
+        if outfile is not None:
+            result[0].header.update("FILENAME", os.path.basename(outfile), comment="Name of this file")
+            utils.write_fits(result, outfile, clobber=clobber)
+            _log.info("Saved result to "+outfile)
+        return result
 
+    def calcPSF_through_focus(self, defocus_waves=None, defocus_wavelength=2.0e-6, weak_lenses=None, chunk=8,
+            outfile=None, clobber=True, **kwargs):
+        """ Compute PSFs through focus, as a cube
 
-        _log.info("PSF calc using fov_%s, oversample = %d, nlambda = %d" % (fov_spec, detector_oversample, nlambda) )
+        This is equivalent to calling calcPSF with options['defocus_waves'] set to each value in
+        turn (or with each NIRCam weak lens selected as the pupil_mask), but much faster: the pupil,
+        OPD, masks and wavelength weights are set up once, and for each focus step only the thin
+        lens phasor changes. Steps are transformed together, several at a time, per wavelength.
 
-        #----- compute weights for each wavelength based on source spectrum
-        wavelens, weights = self._getWeights(source=source, nlambda=nlambda, monochromatic=monochromatic)
+        This is only available for direct imaging, not for coronagraphs.
 
+        Parameters
+        ----------
+        defocus_waves : iterable of floats, optional
+            Defocus for each step, in waves peak-to-valley at defocus_wavelength. These replace
+            any options['defocus_waves'].
+        defocus_wavelength : float
+            Reference wavelength for defocus_waves, in meters
+        weak_lenses : list of strings, optional
+            For NIRCam, names of weak lenses from pupil_mask_list, to add a step for each after those
+            from defocus_waves. If a weak lens is currently selected as the pupil_mask, it is left out
+            of the base optical system for these steps.
+        chunk : int
+            Number of steps to compute at once; higher is faster but uses more memory.
+        outfile : string, optional
+            Filename to write the result to.
+
+        Other keyword arguments are as for calcPSF.
 
-        #---- now at last, actually do the PSF calc:
-        #  instantiate an optical system using the current parameters
-        self.optsys = self._getOpticalSystem(fov_arcsec=fov_arcsec, fov_pixels=fov_pixels,
-            fft_oversample=fft_oversample, detector_oversample=detector_oversample, options=local_options)
-        # and use it to compute the PSF (the real work happens here, in code in poppy.py)
-        #result = self.optsys.calcPSF(source, display_intermediates=display, save_intermediates=save_intermediates, display=display)
-        #if _USE_MULTIPROC and monochromatic is None :
-            #result = self.optsys.calcPSFmultiproc(source, nprocesses=_MULTIPROC_NPROCESS) # no fancy display args for multiproc.
-        #else:
-        result = self.optsys.calcPSF(wavelens, weights, display_intermediates=display, display=display, return_intermediates=return_intermediates, **kwargs)
+        Returns
+        -------
+        psfs : fits.HDUList
+            The PSFs as a cube with one plane per focus step, in the primary HDU, plus a cube of
+            detector-sampled PSFs in a DET_SAMP extension depending on the output mode.
+            Header keywords FOCUS0, FOCUS1, ... describe each step.
+        """
+        #---- each step is a thin lens, or a stack of them, applied in the pupil
+        steps, labels = [], []
+        for nwaves in (defocus_waves if defocus_waves is not None else []):
+            steps.append([poppy.ThinLens(nwaves=nwaves, reference_wavelength=defocus_wavelength)])
+            labels.append('%g waves at %g um' % (nwaves, defocus_wavelength*1e6))
+        weak_lens_waves = getattr(self, '_weak_lens_waves', {})
+        for name in (weak_lenses if weak_lenses is not None else []):
+            if name not in weak_lens_waves:
+                raise ValueError("Unknown weak lens '%s' for %s. Choose from %s." % (name, self.name, sorted(weak_lens_waves.keys())))
+            steps.append([poppy.ThinLens(nwaves=nwaves, reference_wavelength=2e-6) for nwaves in weak_lens_waves[name]])
+            labels.append(name)
+        if len(steps) == 0:
+            raise ValueError("Specify defocus_waves and/or weak_lenses for the focus steps.")
+        def lens_step(lenses):
+            def step(wavefront):
+                for lens in lenses:
+                    wavefront *= lens
+            return step
+
+        #---- set up the base optical system without defocus, through calcPSF
+        saved_options = dict(self.options)
+        saved_pupil_mask = self.pupil_mask
+        self.options.pop('defocus_waves', None)
+        if weak_lenses is not None and self.pupil_mask in weak_lens_waves:
+            self.pupil_mask = None
+        try:
+            first, wavelens, weights = self._calcPSF_oversampled(**kwargs)
+        finally:
+            self.options.clear()
+            self.options.update(saved_options)
+            self.pupil_mask = saved_pupil_mask
+        header = first[0].header
 
-        if return_intermediates: # this implies we got handed back a tuple, so split it apart
-            result, intermediates = result
+        _log.info("Computing PSFs for %d focus steps" % len(steps))
+        psf_cube = propagation.calc_psf_steps(self.optsys, wavelens, weights, [lens_step(l) for l in steps],
+                normalize=kwargs.get('normalize', 'first'), chunk=chunk)
 
+        header.update('NSTEPS', len(steps), 'Number of focus steps in this cube')
+        for n, label in enumerate(labels):
+            header.update('FOCUS%d' % n, label, 'Defocus for plane %d of this cube' % n)
+        return self._cube_output(psf_cube.astype(first[0].data.dtype), header, outfile=outfile, clobber=clobber,
+                compression=kwargs.get('output_compression', None))
 
-        self._getFITSHeader(result, local_options)
+    def calcPSF_offsets(self, offset_r, offset_theta=0, chunk=8, outfile=None, clobber=True, **kwargs):
+        """ Compute PSFs for many source positions, as a cube
 
-        self._calcPSF_format_output(result, local_options)
+        This is equivalent to calling calcPSF with options['source_offset_r'] and
+        options['source_offset_theta'] set to each position in turn, but much faster: the
+        optical system is set up and the pupil wavefront computed once per wavelength, and
+        each offset only changes the grid of detector pixels that wavefront is transformed to.
 
+        This is only available for direct imaging, not for coronagraphs.
 
-        if display:
-            f = plt.gcf()
-            #p.text( 0.1, 0.95, "%s, filter= %s" % (self.name, self.filter), transform=f.transFigure, size='xx-large')
+        Parameters
+        ----------
+        offset_r : float or iterable of floats
+            Radial offsets of the source from the center, in arcseconds
+        offset_theta : float or iterable of floats
+            Position angles for those offsets, in degrees, as for options['source_offset_theta']
+        chunk : int
+            Number of offsets to compute at once; higher is faster but uses more memory.
+        outfile : string, optional
+            Filename to write the result to.
+
+        Other keyword arguments are as for calcPSF. Any source offset in the options is
+        ignored; offsets are relative to the center of the field.
 
-            if monochromatic is None:
-                plt.suptitle( "%s, filter= %s" % (self.name, self.filter), size='xx-large')
-                plt.text( 0.99, 0.04, "Calculation with %d wavelengths (%g - %g um)" % (nlambda, wavelens[0]*1e6, wavelens[-1]*1e6), transform=f.transFigure, horizontalalignment='right')
-            else:
-                plt.suptitle( "{self.name},  $\lambda$ = {wavelen} um".format(self=self, wavelen = monochromatic*1e6), size='xx-large')
- 
+        Returns
+        -------
+        psfs : fits.HDUList
+            The PSFs as a cube with one plane per offset, in the primary HDU, plus a cube of
+            detector-sampled PSFs in a DET_SAMP extension depending on the output mode.
+            Header keywords OFFR0, OFFT0, OFFR1, ... give the offset for each plane.
+        """
+        offset_r, offset_theta = np.broadcast_arrays(np.atleast_1d(np.asarray(offset_r, dtype=np.float64)),
+                                                     np.atleast_1d(np.asarray(offset_theta, dtype=np.float64)))
+
+        #---- set up the optical system with no offset, through calcPSF
+        saved_options = dict(self.options)
+        self.options.pop('source_offset_r', None)
+        self.options.pop('source_offset_theta', None)
+        try:
+            first, wavelens, weights = self._calcPSF_oversampled(**kwargs)
+        finally:
+            self.options.clear()
+            self.options.update(saved_options)
+        header = first[0].header
+
+        _log.info("Computing PSFs for %d source offsets" % len(offset_r))
+        psf_cube = propagation.calc_psf_offsets(self.optsys, wavelens, weights, offset_r, offset_theta,
+                normalize=kwargs.get('normalize', 'first'), chunk=chunk)
+
+        header.update('NOFFSETS', len(offset_r), 'Number of source offsets in this cube')
+        for n in range(len(offset_r)):
+            header.update('OFFR%d' % n, offset_r[n], '[arcsec] Source offset for plane %d of this cube' % n)
+            header.update('OFFT%d' % n, offset_theta[n], '[deg] Position angle of that offset')
+        return self._cube_output(psf_cube.astype(first[0].data.dtype), header, outfile=outfile, clobber=clobber,
+                compression=kwargs.get('output_compression', None))
+
+    def calcPSF_pixel_phases(self, nphases=None, kernel=None, outfile=None, clobber=True, **kwargs):
+        """ Compute detector-sampled PSFs at a grid of subpixel phases, e.g. for effective PSFs
+
+        One oversampled PSF is computed, and every phase is rebinned from it onto detector pixels
+        with the pixel grid shifted by whole oversampled pixels; see `utils.pixel_phases`. So the
+        number of phases costs nothing in propagation.
+
+        Parameters
+        ----------
+        nphases : int, optional
+            Number of phases along each axis. The detector oversampling must be a multiple of it.
+            Default is one phase per oversampled pixel, i.e. the detector oversampling.
+        kernel : 2D ndarray, optional
+            Pixel response sampled on the oversampled grid, as for `utils.pixel_phases`.
+            Default is uniform response.
+        outfile : string, optional
+            Filename to write the result to.
+
+        Other keyword arguments are as for calcPSF.
+
+        Returns
+        -------
+        result : fits.HDUList
+            The detector-sampled PSFs in the primary HDU, with shape (nphases, nphases, ny, nx),
+            and the oversampled PSF they come from in an OVERSAMP extension. Stamp (i, j) is for
+            the source displaced by -(i, j)*PHASESTP detector pixels.
+        """
+        first, wavelens, weights = self._calcPSF_oversampled(**kwargs)
+        detector_oversample = first[0].header.get('DET_SAMP', 1)
+        if nphases is None: nphases = detector_oversample
+        if detector_oversample % nphases != 0:
+            raise ValueError("The detector oversampling %d is not a multiple of nphases=%d" % (detector_oversample, nphases))
+        step = detector_oversample // nphases
+        first[0].data = self._apply_jitter(first[0].data, first[0].header, self.options)
+        stamps = utils.pixel_phases(first[0].data, detector_oversample, step=step, kernel=kernel)
+
+        header = first[0].header.copy()
+        self._set_detector_sampled_keywords(header, detector_oversample)
+        header.update('NPHASES', nphases, 'Number of subpixel phases along each axis')
+        header.update('PHASESTP', float(step)/detector_oversample, '[pixels] Spacing of the subpixel phases')
+        header.update('PIXRESP', 'uniform' if kernel is None else 'kernel', 'Pixel response used in rebinning')
+        result = fits.HDUList([fits.PrimaryHDU(data=stamps, header=header)])
+        oversampled = fits.ImageHDU(data=first[0].data, header=first[0].header)
+        oversampled.header.update('EXTNAME', 'OVERSAMP')
+        result.append(oversampled)
         if outfile is not None:
-            result[0].header.update ("FILENAME", os.path.basename (outfile),
-                           comment="Name of this file")
-            result.writeto(outfile, clobber=clobber)
+            result[0].header.update("FILENAME", os.path.basename(outfile), comment="Name of this file")
+            utils.write_fits(result, outfile, compression=kwargs.get('output_compression', None) or settings.output_compression(),
+                    clobber=clobber)
             _log.info("Saved result to "+outfile)
+        return result
 
-        if return_intermediates:
-            return result, intermediates
+    def calcPSF_jitter(self, jitter_sigma, jitter_angle=0.0, outfile=None, clobber=True, **kwargs):
+        """ Compute PSFs for a range of Gaussian pointing jitter amplitudes, as a cube
+
+        The PSF is computed once without jitter, and each amplitude applied to it as a transfer
+        function in the Fourier domain, from one forward FFT; see `webbpsf.jitter`. Any jitter
+        in the options is ignored.
+
+        Parameters
+        ----------
+        jitter_sigma : list
+            RMS jitter per axis in arcsec for each plane, or (major, minor) pairs for elliptical jitter
+        jitter_angle : float
+            Angle of the major axis in degrees counterclockwise from +X, for elliptical jitter
+        outfile : string, optional
+            Filename to write the result to.
+
+        Other keyword arguments are as for calcPSF.
+
+        Returns
+        -------
+        psfs : fits.HDUList
+            The PSFs as a cube with one plane per jitter amplitude, in the primary HDU, plus a cube of
+            detector-sampled PSFs in a DET_SAMP extension depending on the output mode.
+            Header keywords JITSIG0, JITSIG1, ... give the (major axis) rms jitter for each plane.
+        """
+        jitter_sigma = list(jitter_sigma)
+        first, wavelens, weights = self._calcPSF_oversampled(**kwargs)
+        header = first[0].header
+        psf_cube = jitter.jitter_psf(first[0].data, header['PIXELSCL'], model='gaussian',
+                sigma=jitter_sigma, angle=jitter_angle).astype(first[0].data.dtype)
+
+        header.update('JITRTYPE', 'gaussian', 'Type of pointing jitter applied')
+        header.update('NJITTER', len(jitter_sigma), 'Number of jitter amplitudes in this cube')
+        for n, sigma in enumerate(jitter_sigma):
+            if np.isscalar(sigma):
+                header.update('JITSIG%d' % n, sigma, '[arcsec] RMS jitter per axis for plane %d' % n)
+            else:
+                header.update('JITSIG%d' % n, sigma[0], '[arcsec] RMS jitter along the major axis for plane %d' % n)
+                header.update('JITMIN%d' % n, sigma[1], '[arcsec] RMS jitter along the minor axis')
+        if not all([np.isscalar(sigma) for sigma in jitter_sigma]):
+            header.update('JITRANGL', jitter_angle, '[deg] Angle of the major axis from +X')
+        return self._cube_output(psf_cube, header, outfile=outfile, clobber=clobber,
+                compression=kwargs.get('output_compression', None), apply_jitter=False)
+
+    def _cube_output(self, cube, header, outfile=None, clobber=True, compression=None, apply_jitter=True):
+        """ HDUList for a cube of oversampled PSFs, with detector-sampled PSFs as the output mode requires
+
+        Any jitter in the options is applied to each PSF, and the cube is written to outfile if that is given.
+        """
+        if apply_jitter: cube = self._apply_jitter(cube, header, self.options)
+        result = fits.HDUList([fits.PrimaryHDU(data=cube, header=header)])
+        output_mode = self.options.get('output_mode', settings.default_output_mode())
+        detector_oversample = header.get('DET_SAMP', 1)
+        if output_mode in ('Both as FITS extensions', 'both', 'Detector sampled image', 'detector') and detector_oversample > 1:
+            rebinned = np.asarray([utils.rebin_array(plane, detector_oversample) for plane in cube])
+            if output_mode in ('Detector sampled image', 'detector'):
+                result[0].data = rebinned
+                self._set_detector_sampled_keywords(result[0].header, detector_oversample)
+            else:
+                det_hdu = fits.ImageHDU(data=rebinned, header=result[0].header.copy())
+                self._set_detector_sampled_keywords(det_hdu.header, detector_oversample)
+                det_hdu.header.update('EXTNAME', 'DET_SAMP')
+                result.append(det_hdu)
+        if outfile is not None:
+            result[0].header.update("FILENAME", os.path.basename(outfile), comment="Name of this file")
+            utils.write_fits(result, outfile, compression=compression or settings.output_compression(), clobber=clobber)
+            _log.info("Saved result to "+outfile)
+        return result
+
+    def _apply_jitter(self, data, header, options):
+        """ Jitter an oversampled PSF, or a cube of them, as the options specify, noting that in the header """
+        model = jitter.options_model(options)
+        if model is None:
+            return data
+        header.update('JITRTYPE', model['model'], 'Type of pointing jitter applied')
+        if model['model'] == 'gaussian':
+            sigma = model['sigma']
+            if np.isscalar(sigma):
+                header.update('JITRSIGM', sigma, '[arcsec] RMS jitter per axis')
+            else:
+                header.update('JITRSIGM', sigma[0], '[arcsec] RMS jitter along the major axis')
+                header.update('JITRSIG2', sigma[1], '[arcsec] RMS jitter along the minor axis')
+                header.update('JITRANGL', model['angle'], '[deg] Angle of the major axis from +X')
         else:
-            return result
+            header.update('JITRNSMP', len(model['timeseries'][0]), 'Number of jitter timeseries samples')
+        return jitter.jitter_psf(data, header['PIXELSCL'], **model).astype(data.dtype)
+
+    def _calcPSF_oversampled(self, **kwargs):
+        """ Run calcPSF for just the oversampled PSF, returning it with the wavelengths and weights used
+
+        Afterwards, self.optsys is the optical system it used. No jitter is applied.
+        """
+        saved_options = dict(self.options)
+        self.options['output_mode'] = 'Oversampled image'
+        self.options.pop('jitter', None)    # callers apply any jitter to whatever they compute from this
+        try:
+            result = self.calcPSF(**kwargs)
+        finally:
+            self.options.clear()
+            self.options.update(saved_options)
+        header = result[0].header
+        wavelens = [header['WAVE%d' % i] for i in range(header['NWAVES'])]
+        weights = [header['WGHT%d' % i] for i in range(header['NWAVES'])]
+        return result, wavelens, weights
 
     def _getFITSHeader(self, result, options):
         """ populate FITS Header keywords """
@@ -458,22 +1093,62 @@ class JWInstrument(poppy.instrument.Instrument):
             result[0].header.update('PUPIL', self.pupil_mask)
 
 
+    @staticmethod
+    def _set_detector_sampled_keywords(header, detector_oversample):
+        header.update('OVERSAMP', 1, 'These data are rebinned to detector pixels')
+        header.update('CALCSAMP', detector_oversample, 'This much oversampling used in calculation')
+        header['PIXELSCL'] *= detector_oversample
+
     def _calcPSF_format_output(self, result, options):
         """ Apply desired formatting to output file:
                  - rebin to detector pixel scale if desired
                  - set up FITS extensions if desired
                  - output either the oversampled, rebinned, or both
+                 - optionally crop or drop the oversampled PSF, and convert to float32
 
             Modifies the 'result' HDUList object.
         """
         output_mode = options.get('output_mode',settings.default_output_mode())
-
-        if output_mode == 'Mock JWST DMS Output':
-            # first rebin down to detector sampling
-            # then call mockdms routines to embed in larger detector etc
-            raise NotImplementedError('Not implemented yet')
+        detector_oversample = options.get('detector_oversample', 1)
+        rebin = options.get('rebin', True) and detector_oversample > 1
+
+        if output_mode in ('Mock JWST DMS Output', 'dms'):
+            # first rebin down to detector sampling, then place the stamp on the detector frame
+            from . import mockdms
+            header = result[0].header
+            stamp = result[0].data
+            if rebin:
+                _log.info(" Downsampling to detector pixel scale, by %d" % detector_oversample)
+                stamp = utils.rebin_array(stamp, detector_oversample)
+                self._set_detector_sampled_keywords(header, detector_oversample)
+            if self._detector is not None:
+                frame_shape = self._detector.sci_shape
+                detector = self._detector.name
+            else:
+                frame_shape, detector = mockdms.DEFAULT_FRAME_SHAPE, None
+            sci = mockdms.sci_hdu(stamp, header, frame_shape, self.detector_coordinates, detector=detector)
+            result[0].data = None
+            for hdu in result[1:]:
+                result.remove(hdu)
+            result.append(sci)
+        elif output_mode in ('Both as FITS extensions', 'both'):
+            if rebin:
+                _log.info(" Downsampling to detector pixel scale, by %d" % detector_oversample)
+                # the rebinned data are summed straight into the new extension, and only the header is copied
+                rebinned = fits.ImageHDU(data=utils.rebin_array(result[0].data, detector_oversample), header=result[0].header.copy())
+                self._set_detector_sampled_keywords(rebinned.header, detector_oversample)
+                rebinned.header.update('EXTNAME', 'DET_SAMP')
+                result.append(rebinned)
+        elif output_mode in ('Detector sampled image', 'detector'):
+            if rebin:
+                _log.info(" Downsampling to detector pixel scale, by %d" % detector_oversample)
+                result[0].data = utils.rebin_array(result[0].data, detector_oversample)
+                self._set_detector_sampled_keywords(result[0].header, detector_oversample)
+        elif output_mode in ('Oversampled image', 'oversampled'):
+            pass
         else:
             poppy.Instrument._calcPSF_format_output(self, result, options)
+        utils.compact_output(result, dtype=options.get('output_dtype'), oversampled=options.get('output_oversampled', True))
 
 
     def _getOpticalSystem(self,fft_oversample=2, detector_oversample = None, fov_arcsec=2, fov_pixels=None, options=None):
@@ -540,9 +1215,17 @@ class JWInstrument(poppy.instrument.Instrument):
         else: 
             raise TypeError("Not sure what to do with a pupil of that type:"+str(type(self.pupil)))
 
+        #---- add any Zernike or hexike aberrations to the OPD
+        extra_opd = wfe.modal_opd(options, pupil=full_pupil_path)
+        if extra_opd is not None:
+            if isinstance(full_opd_path, poppy.OpticalElement):
+                raise TypeError("Zernike or hexike coefficients can't be added to a pupilopd given as an OpticalElement")
+            full_opd_path = wfe.add_opd(full_opd_path, extra_opd)
+
 
         #---- apply pupil intensity and OPD to the optical model
-        optsys.addPupil(name='JWST Pupil', transmission=full_pupil_path, opd=full_opd_path, opdunits='micron', rotation=self._rotation)
+        with profiling.stage(self._profile, 'pupil'):  # mostly reading the pupil and OPD FITS files
+            optsys.addPupil(name='JWST Pupil', transmission=full_pupil_path, opd=full_opd_path, opdunits='micron', rotation=self._rotation)
 
         #---- Add defocus if requested
         if 'defocus_waves' in options.keys(): 
@@ -562,7 +1245,8 @@ class JWInstrument(poppy.instrument.Instrument):
 
         if self.image_mask is not None or self.pupil_mask is not None or ('force_coron' in options.keys() and options['force_coron']):
             _log.debug("Adding coronagraph/spectrograph optics...")
-            optsys, trySAM, SAM_box_size = self._addAdditionalOptics(optsys, oversample=fft_oversample)
+            with profiling.stage(self._profile, 'instrument_optics'):
+                optsys, trySAM, SAM_box_size = self._addAdditionalOptics(optsys, oversample=fft_oversample)
         else: trySAM = False
 
         #--- add the detector element. 
@@ -588,7 +1272,25 @@ class JWInstrument(poppy.instrument.Instrument):
                 _log.warn(str(err))
                 #_log.warn("ERROR ({0}): {1}".format(errno, strerror))
                 pass
- 
+
+        #---  invoke semi-analytic slit propagation
+        # Rectangular field stops (spectrograph slits and MSA shutters) only transmit light within a small
+        # box in the image plane, so there is no need to FFT the entire padded array to get there and back.
+        if not trySAM and not ('no_sam' in self.options.keys() and self.options['no_sam']):
+            slit_box = _get_slit_box_size(optsys)
+            if slit_box is not None and not _has_pupil_after_image(optsys):
+                # e.g. a NIRSpec slit with no grating selected: nothing to do semi-analytically, and nothing wrong
+                _log.debug("No pupil stop follows the slit, so using FFT propagation rather than the semi-analytic slit.")
+                slit_box = None
+            if slit_box is not None:
+                _log.info("Trying to invoke switch to Semi-Analytic Slit algorithm")
+                try:
+                    slit_optsys = SemiAnalyticSlit(optsys, oversample=fft_oversample, slit_box=slit_box)
+                    _log.info("Semi-analytic slit OK")
+                    return slit_optsys
+                except ValueError as err:
+                    _log.warn("Could not switch to Semi-Analytic Slit mode; invalid set of optical planes? Using default propagation instead.")
+                    _log.warn(str(err))
 
 
         return optsys
@@ -848,6 +1550,9 @@ class NIRCam(JWInstrument):
         self.image_mask_list = ['MASKLWB','MASKSWB','MASK210R','MASK335R','MASK430R']
 
         self.pupil_mask_list = ['CIRCLYOT','WEDGELYOT', 'WEAK LENS +4', 'WEAK LENS +8', 'WEAK LENS -8', 'WEAK LENS +12 (=4+8)','WEAK LENS -4 (=4-8)']
+        # defocus in waves at 2 microns of each lens in each weak lens position
+        self._weak_lens_waves = {'WEAK LENS +4': [4], 'WEAK LENS +8': [8], 'WEAK LENS -8': [-8],
+                'WEAK LENS +12 (=4+8)': [4, 8], 'WEAK LENS -4 (=4-8)': [4, -8]}
 
         self.filter = 'F200W' # default
         self._default_aperture='NIRCam A1 center' # reference into SIAF for ITM simulation V/O coords
@@ -1215,6 +1920,10 @@ class FGS(JWInstrument):
 class NIRSpec_three_MSA_shutters(poppy.AnalyticOpticalElement):
     """ Three NIRSpec MSA shutters, adjacent vertically."""
 
+    # overall extent of the open area, in arcsec. Used to bound the semi-analytic slit calculation.
+    width = 0.2
+    height = 0.45*3 + 0.06*2
+
     def getPhasor(self,wave):
         """ Compute the transmission inside/outside of the field stop.
 
@@ -1595,6 +2304,147 @@ class NIRISS_GR700XD_Grism(poppy.FITSOpticalElement):
 
 
 
+#######  Custom optical systems used in JWInstrument classes  #####
+
+_RADIANStoARCSEC = 180.*60*60 / np.pi
+
+def _get_slit_box_size(optsys):
+    """ Return the (Y, X) size in arcsec of a box enclosing the rectangular field stop in an
+    optical system, or None if the system does not have exactly one such image plane.
+
+    Rectangular field stops are recognized by having `width` and `height` attributes,
+    as for poppy.IdealRectangularFieldStop. Any rotation `angle` of the stop is accounted for.
+    """
+    image_planes = [p for p in optsys.planes if p.planetype == poppy.poppy_core._IMAGE]
+    if len(image_planes) != 1: return None
+    slit = image_planes[0]
+    if not (hasattr(slit, 'width') and hasattr(slit, 'height')): return None
+
+    ang = np.deg2rad(getattr(slit, 'angle', 0.0))
+    box_x = abs(slit.width*np.cos(ang)) + abs(slit.height*np.sin(ang))
+    box_y = abs(slit.width*np.sin(ang)) + abs(slit.height*np.cos(ang))
+    return (box_y, box_x)
+
+
+def _has_pupil_after_image(optsys):
+    """ Is there a pupil plane (such as a pupil stop) after the first image plane of an optical system? """
+    image_indices = [i for i, p in enumerate(optsys.planes) if p.planetype == poppy.poppy_core._IMAGE]
+    if len(image_indices) == 0: return False
+    return any([p.planetype == poppy.poppy_core._PUPIL for p in optsys.planes[image_indices[0]+1:]])
+
+
+class SemiAnalyticSlit(poppy.OpticalSystem):
+    """ Semi-analytic propagation through a rectangular image plane field stop
+
+    This is the spectrograph slit analog of poppy.SemiAnalyticCoronagraph. Since a slit or
+    MSA shutter blocks everything outside of a small rectangle in the image plane, the field
+    only needs to be computed within a box enclosing that rectangle. This is done with a
+    matrix Fourier transform from the entrance pupil to the box, multiplication by the field
+    stop, and an inverse MFT back to the subsequent pupil stop (e.g. the NIRSpec grating wheel
+    or the MIRI LRS pupil stop). Unlike the coronagraph case no Babinet subtraction is needed,
+    and the result is exact to within the sampling of the box.
+
+    Compared to FFT propagation, this avoids allocating the full padded FFT arrays, which
+    reach gigabyte sizes at high oversampling.
+
+    Parameters
+    -----------
+    ExistingOpticalSystem : poppy.OpticalSystem
+        An optical system consisting of one or more pupil planes, one image plane
+        rectangular field stop, one or more pupil plane optics (possibly including rotations),
+        and a detector.
+    oversample : int
+        Oversampling factor for the image plane box, relative to lambda/D.
+    slit_box : float or 2-tuple
+        Size in arcsec, as (Y, X) if a tuple, of a box that entirely encloses the field stop.
+
+    """
+    _supports_precision = True # propagate_mono accepts precision='single'
+
+    def __init__(self, ExistingOpticalSystem, oversample=2, slit_box=1.0):
+        poppy.OpticalSystem.__init__(self, name=ExistingOpticalSystem.name, oversample=oversample)
+        self.source_offset_r = getattr(ExistingOpticalSystem, 'source_offset_r', 0)
+        self.source_offset_theta = getattr(ExistingOpticalSystem, 'source_offset_theta', 0)
+        self.planes = ExistingOpticalSystem.planes
+
+        image_indices = [i for i, p in enumerate(self.planes) if p.planetype == poppy.poppy_core._IMAGE]
+        if len(image_indices) != 1:
+            raise ValueError("A semi-analytic slit calculation requires exactly one image plane.")
+        self._slit_index = image_indices[0]
+        if self._slit_index == 0:
+            raise ValueError("The slit must be preceded by at least one pupil plane.")
+        for p in self.planes[:self._slit_index]:
+            if p.planetype != poppy.poppy_core._PUPIL:
+                raise ValueError("All planes prior to the slit must be pupil planes.")
+        if self.planes[-1].planetype != poppy.poppy_core._DETECTOR:
+            raise ValueError("The last optical plane must be a detector.")
+        if not any([p.planetype == poppy.poppy_core._PUPIL for p in self.planes[self._slit_index+1:-1]]):
+            raise ValueError("The slit must be followed by a pupil plane stop.")
+
+        if np.isscalar(slit_box): slit_box = (slit_box, slit_box)
+        self.slit_box = (float(slit_box[0]), float(slit_box[1]))
+        self.slit = self.planes[self._slit_index]
+        self.detector = self.planes[-1]
+
+    def propagate_mono(self, wavelength=2e-6, normalize='first', display_intermediates=False, return_intermediates=False,
+            precision='double', **kwargs):
+        """ Propagate a monochromatic wavefront through the slit system.
+
+        Returns the detector plane intensity as a FITS HDUList, plus a list of intermediate
+        wavefronts if return_intermediates is set. Set precision='single' to propagate
+        complex64 wavefronts.
+        """
+        _log.debug(" Semi-analytic slit propagation for wavelength = %g meters" % wavelength)
+        intermediate_wfs = []
+
+        wavefront = propagation.set_precision(self.inputWavefront(wavelength), precision)
+        for i, optic in enumerate(self.planes[:self._slit_index]):
+            wavefront.propagateTo(optic)
+            wavefront *= optic
+            propagation.set_precision(wavefront, precision)
+            if i == 0 and normalize.lower() == 'first':
+                wavefront.normalize()
+            if return_intermediates: intermediate_wfs.append(wavefront.copy())
+
+        #------- differences from regular propagation begin here --------------
+        # lambda/D for the full pupil array, in arcsec, and the image plane sampling to use.
+        npup = wavefront.shape[0]
+        lamD = wavelength / (npup * wavefront.pixelscale) * _RADIANStoARCSEC
+        pixelscale = lamD / self.oversample
+        npix_box = (int(np.ceil(self.slit_box[0] / pixelscale)), int(np.ceil(self.slit_box[1] / pixelscale)))
+        nlamD_box = (npix_box[0] / float(self.oversample), npix_box[1] / float(self.oversample))
+        _log.debug("   Slit box is %d x %d pixels at %.4f arcsec/pixel" % (npix_box[1], npix_box[0], pixelscale))
+
+        slitwave = wavefront.copy()
+        slitwave.wavefront = utils.matrix_dft(wavefront.wavefront, nlamD_box, npix_box)
+        slitwave.planetype = poppy.poppy_core._IMAGE
+        slitwave.pixelscale = pixelscale
+        slitwave.location = 'at '+self.slit.name
+        slitwave *= self.slit
+        if return_intermediates: intermediate_wfs.append(slitwave.copy())
+
+        # back to the pupil, at the same sampling as the entrance pupil
+        wavefront.wavefront = utils.matrix_dft(slitwave.wavefront, nlamD_box, wavefront.shape, inverse=True)
+        del slitwave
+        #------- differences from regular propagation end here --------------
+
+        for optic in self.planes[self._slit_index+1:]:
+            wavefront.propagateTo(optic)
+            propagation.set_precision(wavefront, precision)
+            wavefront *= optic
+            propagation.set_precision(wavefront, precision)
+            if return_intermediates: intermediate_wfs.append(wavefront.copy())
+
+        if display_intermediates:
+            wavefront.display(what='intensity')
+
+        if return_intermediates:
+            return wavefront.asFITS(), intermediate_wfs
+        else:
+            return wavefront.asFITS()
+
+
+
 ###########################################################################
 # Generic utility functions
 
@@ -1705,6 +2555,13 @@ class DetectorGeometry(object):
         ydetsize = self.aperture.YDetSize
         return (xdetsize,ydetsize)
 
+    @property
+    def sci_shape(self):
+        """ Return the (Y, X) array shape of a full frame in Science coordinates """
+        xsize = getattr(self.aperture, 'XSciSize', self.aperture.XDetSize)
+        ysize = getattr(self.aperture, 'YSciSize', self.aperture.YDetSize)
+        return (int(ysize), int(xsize))
+
     def validate_coords(self, x, y):
         """ Check if specified pixel coords are actually on the detector
 
@@ -0,0 +1,420 @@
+#!/usr/bin/env python
+"""
+wfe.py
+
+    Wavefront error maps from primary mirror segment poses.
+
+    A Segment Update Request (SUR, parsed by `webbpsf.jwxml.SUR`) moves some of
+    the 18 primary mirror segments in piston, tip/tilt, lateral translation and
+    clocking. To first order the resulting OPD is linear in those 18x6 pose
+    parameters, so it can be written as OPD = B . pose for a fixed basis B of
+    influence functions. `SegmentBasis` computes B once on the grid of the pupil
+    file (it is very sparse: each pupil pixel depends only on the six parameters
+    of its own segment) and caches it, after which any SUR, or a whole sequence
+    of them, is turned into OPD maps with a single sparse matrix product:
+
+        >>> from webbpsf import wfe
+        >>> nc = webbpsf.NIRCam()
+        >>> nc.pupilopd = wfe.sur_opd('my_sur.xml')
+        >>> psf = nc.calcPSF()
+
+    and for a sweep over many mirror states:
+
+        >>> opds = wfe.sur_opd(list_of_surs)           # cube, one plane per SUR
+        >>> psfs = nc.calcPSF_opd_cube(opd=opds)
+
+    The influence functions are those of rigid-body motions of each segment on a
+    spherical primary of radius of curvature `PM_ROC`: piston and tilts move the
+    segment surface directly, while lateral translations and clocking slide it
+    along the curved primary and so add tilt and piston. Moves are taken in each
+    segment's local frame with axes parallel to the pupil array (X along columns,
+    Y along rows), as given by `Segment_Update.toLocal`.
+
+    `ModalBasis` similarly caches Zernike polynomials over the whole pupil, or
+    hexikes (Zernikes orthonormalized over each hexagonal segment), so that
+    sweeps over many low-order aberration vectors cost one matrix product each.
+    Instruments apply these through options['zernike_coeffs'] and
+    options['hexike_coeffs'], on top of the OPD file:
+
+        >>> nc.options['zernike_coeffs'] = [0, 0, 0, 20e-9]   # 20 nm RMS defocus
+
+"""
+import os
+import threading
+from math import factorial
+import numpy as np
+import scipy.sparse
+import astropy.io.fits as fits
+
+from . import settings
+from . import jwxml
+
+import logging
+_log = logging.getLogger('webbpsf')
+
+
+SEGMENTS = ['A1', 'A2', 'A3', 'A4', 'A5', 'A6',
+            'B1', 'B2', 'B3', 'B4', 'B5', 'B6',
+            'C1', 'C2', 'C3', 'C4', 'C5', 'C6']
+DOFS = ['PISTON', 'X_TILT', 'Y_TILT', 'X_TRANS', 'Y_TRANS', 'CLOCK']
+
+PM_ROC = 15.8799            # primary mirror radius of curvature, meters
+SEGMENT_PITCH = 1.32 + 0.007  # flat-to-flat segment size plus gap, meters
+
+
+def segment_centers(pitch=SEGMENT_PITCH):
+    """ Nominal (x, y) centers in meters of each segment, in the order of SEGMENTS
+
+    A1 is at the top of the pupil (+Y), and the numbering runs clockwise as displayed
+    with the origin at lower left. B segments are outward of the A segments of the same
+    number, and C segments lie between them.
+    """
+    centers = []
+    for radius, offset in [(pitch, 0), (2*pitch, 0), (np.sqrt(3)*pitch, 30)]:    # A, B, C rings
+        for i in range(6):
+            angle = np.deg2rad(90 - offset - 60*i)
+            centers.append((radius*np.cos(angle), radius*np.sin(angle)))
+    return np.asarray(centers)
+
+
+def _pupil_filename(pupil):
+    if pupil is None:
+        pupil = os.path.join(settings.get_webbpsf_data_path(), 'pupil_RevV.fits')
+    return pupil
+
+
+class _PupilBasis(object):
+    """ A linear basis of OPD maps over the illuminated pixels of a pupil
+
+    Subclasses set `shape`, `pixels` (flat indices of the illuminated pixels), `header`,
+    and `matrix`, of shape (number of pixels, number of basis vectors).
+    """
+    _origin = 'basis'
+
+    def opd(self, vectors):
+        """ OPD in meters for a coefficient vector, or a cube of OPDs for an array of them """
+        vectors = np.asarray(vectors, dtype=np.float64)
+        values = self.matrix.dot(vectors.T)   # (npixels,) or (npixels, nvectors)
+        if vectors.ndim == 1:
+            result = np.zeros(self.shape)
+            result.flat[self.pixels] = values
+            return result
+        result = np.zeros((vectors.shape[0],) + self.shape)
+        result.reshape(vectors.shape[0], -1)[:, self.pixels] = values.T
+        return result
+
+    def opd_hdulist(self, vectors, baseline=None):
+        """ OPD(s) for coefficient vector(s), in microns, as an HDUList that can be used as a pupilopd
+
+        Parameters
+        ----------
+        vectors : ndarray
+            Coefficient vector, or array of them
+        baseline : ndarray or fits.HDUList, optional
+            OPD in microns on the same grid to add to each, e.g. one realization from an OPD file
+        """
+        data = self.opd(vectors) * 1e6
+        if baseline is not None:
+            if isinstance(baseline, fits.HDUList): baseline = baseline[0].data
+            data += baseline
+        hdu = fits.PrimaryHDU(data=data)
+        for key in ['PUPLSCAL', 'PUPLDIAM']:
+            if key in self.header: hdu.header.update(key, self.header[key])
+        hdu.header.update('BUNIT', 'micron', 'Units of OPD')
+        hdu.header.update('OPDFILE', self._origin, 'OPD computed from '+self._origin)
+        return fits.HDUList([hdu])
+
+
+class SegmentBasis(_PupilBasis):
+    """ Segment rigid-body influence functions on a pupil grid
+
+    Parameters
+    ----------
+    pupil : string or fits.HDUList, optional
+        Pupil transmission file defining the grid. Default is the JWST pupil_RevV.fits.
+    roc : float
+        Primary mirror radius of curvature in meters.
+    pitch : float
+        Distance in meters between the centers of adjacent segments.
+
+    Attributes
+    ----------
+    segment_map : ndarray of ints
+        Index into SEGMENTS of the segment covering each pixel, or -1 outside the pupil
+    x, y, segment : ndarrays
+        Position in meters and segment index of each illuminated pixel
+    matrix : scipy.sparse.csr_matrix
+        Influence functions, shape (number of pupil pixels, 18*6), giving OPD in meters
+        for poses in meters and radians ordered by segment then DOFS
+    """
+    _origin = 'segment poses'
+
+    def __init__(self, pupil=None, roc=PM_ROC, pitch=SEGMENT_PITCH):
+        pupil = _pupil_filename(pupil)
+        hdulist = pupil if isinstance(pupil, fits.HDUList) else fits.open(pupil)
+        transmission = hdulist[0].data
+        self.header = hdulist[0].header.copy()
+        ny, nx = transmission.shape
+        if 'PUPLSCAL' in self.header:
+            pixelscale = self.header['PUPLSCAL']
+        else:
+            pixelscale = self.header.get('PUPLDIAM', 6.559) / nx
+        self.shape = (ny, nx)
+
+        #---- assign each illuminated pixel to the segment with the nearest center
+        self.pixels = np.flatnonzero(transmission > 0)
+        y, x = np.unravel_index(self.pixels, self.shape)
+        x = (x - (nx - 1) / 2.) * pixelscale
+        y = (y - (ny - 1) / 2.) * pixelscale
+        centers = segment_centers(pitch)
+        distance = (x[:, np.newaxis] - centers[:, 0])**2 + (y[:, np.newaxis] - centers[:, 1])**2
+        segment = np.argmin(distance, axis=1)
+        self.x, self.y, self.segment, self.centers = x, y, segment, centers
+        self.pupil_radius = self.header['PUPLDIAM'] / 2. if 'PUPLDIAM' in self.header else np.sqrt(x**2 + y**2).max()
+        self.segment_map = np.zeros(self.shape, dtype=np.int16) - 1
+        self.segment_map.flat[self.pixels] = segment
+
+        #---- OPD (twice the surface height change) for a unit move in each DOF
+        xc, yc = centers[segment, 0], centers[segment, 1]
+        xl, yl = x - xc, y - yc
+        surface = [np.ones_like(x),         # PISTON
+                   yl,                      # X_TILT: rotation about the local X axis
+                   -xl,                     # Y_TILT: rotation about the local Y axis
+                   -x / roc,                # X_TRANS: sliding along the curved primary
+                   -y / roc,                # Y_TRANS
+                   -(xl*yc - yl*xc) / roc]  # CLOCK: rotation about the local Z axis
+        rows = np.tile(np.arange(len(self.pixels)), len(DOFS))
+        cols = np.concatenate([segment*len(DOFS) + j for j in range(len(DOFS))])
+        values = 2 * np.concatenate(surface)
+        self.matrix = scipy.sparse.csr_matrix((values, (rows, cols)),
+                                              shape=(len(self.pixels), len(SEGMENTS)*len(DOFS)))
+
+    @property
+    def nparams(self):
+        return len(SEGMENTS) * len(DOFS)
+
+    @property
+    def names(self):
+        """ Name of each basis vector, e.g. 'A1_PISTON' """
+        return [segment + '_' + dof for segment in SEGMENTS for dof in DOFS]
+
+    def index(self, segment, dof):
+        """ Index in the pose vector of one segment's degree of freedom """
+        return SEGMENTS.index(segment) * len(DOFS) + DOFS.index(dof)
+
+    def poses(self, surs, cumulative=True, initial=None):
+        """ Pose vectors for a sequence of SURs
+
+        Parameters
+        ----------
+        surs : jwxml.SUR, or filename, or list of either
+            Segment update requests
+        cumulative : bool
+            If True, each SUR is applied on top of the poses from the ones before it, as
+            when commanding the mirrors in sequence. If False, each is applied to the initial pose.
+        initial : ndarray, optional
+            Starting pose vector. Default is all segments at their nominal positions.
+
+        Returns
+        -------
+        poses : ndarray
+            Shape (number of SURs, 18*6), or (18*6,) if a single SUR was given.
+        """
+        single = not isinstance(surs, (list, tuple))
+        if single: surs = [surs]
+        start = np.zeros(self.nparams) if initial is None else np.asarray(initial, dtype=np.float64)
+        state = start.copy()
+        result = np.zeros((len(surs), self.nparams))
+        for i, sur in enumerate(surs):
+            if isinstance(sur, basestring): sur = jwxml.SUR(sur)
+            if not cumulative: state = start.copy()
+            for group in sur.groups:
+                for update in group:
+                    moves = update.toLocal()
+                    for dof, value in moves.items():
+                        if update.units[dof] not in ('meters', 'radians'):
+                            raise ValueError("Segment %s %s move is in units of %s; only meters and radians are supported."
+                                    % (update.segment, dof, update.units[dof]))
+                        j = self.index(update.segment, dof)
+                        state[j] = value if update.absolute else state[j] + value
+            result[i] = state
+        return result[0] if single else result
+
+
+def noll_indices(j):
+    """ Radial order n and azimuthal order m of Noll's Zernike term j (j=1 is piston) """
+    if j < 1: raise ValueError("Noll indices start at 1")
+    n = 0
+    while j > (n + 1) * (n + 2) // 2: n += 1
+    k = j - n * (n + 1) // 2 - 1    # position within radial order n
+    m = 2 * ((k + (n + 1) % 2) // 2) + n % 2
+    return n, (m if j % 2 == 0 or m == 0 else -m)
+
+
+def zernike(j, rho, theta):
+    """ Noll's Zernike term j, normalized to unit RMS over the unit disk """
+    n, m = noll_indices(j)
+    radial = np.zeros_like(rho)
+    for k in range((n - abs(m)) // 2 + 1):
+        coefficient = (-1)**k * float(factorial(n - k)) / (factorial(k) * factorial((n + abs(m)) // 2 - k) * factorial((n - abs(m)) // 2 - k))
+        radial += coefficient * rho**(n - 2*k)
+    if m == 0: return np.sqrt(n + 1) * radial
+    angular = np.cos(m * theta) if m > 0 else np.sin(-m * theta)
+    return np.sqrt(2 * (n + 1)) * radial * angular
+
+
+class ModalBasis(_PupilBasis):
+    """ Zernike or hexike aberration modes on a pupil grid
+
+    Parameters
+    ----------
+    kind : string
+        'zernike' for Noll-ordered Zernikes over the circle circumscribing the pupil, or
+        'hexike' for the same terms orthonormalized over each segment in turn
+    nterms : int
+        Number of terms (per segment, for hexikes)
+    segments : SegmentBasis
+        Segment basis for the pupil grid, giving pixel positions and segment assignments
+
+    Each mode has unit RMS (over the circumscribing circle for Zernikes, and over the
+    segment for hexikes), so coefficients are RMS wavefront error in meters.
+    """
+    def __init__(self, kind, nterms, segments):
+        if kind not in ('zernike', 'hexike'): raise ValueError("Unknown kind of basis: " + kind)
+        self.kind, self.nterms = kind, nterms
+        self.shape, self.pixels, self.header = segments.shape, segments.pixels, segments.header
+        self._origin = kind + ' coefficients'
+        if kind == 'zernike':
+            x, y = segments.x / segments.pupil_radius, segments.y / segments.pupil_radius
+            rho, theta = np.sqrt(x**2 + y**2), np.arctan2(y, x)
+            self.matrix = np.asarray([zernike(j, rho, theta) for j in range(1, nterms + 1)]).T
+        else:
+            # Gram-Schmidt (via QR) makes the Zernikes over each hexagonal segment into hexikes
+            segment_radius = SEGMENT_PITCH / np.sqrt(3)
+            rows, cols, values = [], [], []
+            for s in range(len(SEGMENTS)):
+                members = np.flatnonzero(segments.segment == s)
+                if len(members) < nterms: continue
+                x = (segments.x[members] - segments.centers[s, 0]) / segment_radius
+                y = (segments.y[members] - segments.centers[s, 1]) / segment_radius
+                rho, theta = np.sqrt(x**2 + y**2), np.arctan2(y, x)
+                q, r = np.linalg.qr(np.asarray([zernike(j, rho, theta) for j in range(1, nterms + 1)]).T)
+                modes = q * np.sign(np.diag(r)) * np.sqrt(len(members))
+                rows.append(np.repeat(members, nterms))
+                cols.append(np.tile(s * nterms + np.arange(nterms), len(members)))
+                values.append(modes.ravel())
+            self.matrix = scipy.sparse.csr_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))),
+                                                  shape=(len(self.pixels), len(SEGMENTS) * nterms))
+
+    @property
+    def names(self):
+        """ Name of each basis vector: 'Z<j>' for Zernikes, or e.g. 'A1_H<j>' for hexikes """
+        if self.kind == 'zernike':
+            return ['Z%d' % j for j in range(1, self.nterms + 1)]
+        return ['%s_H%d' % (segment, j) for segment in SEGMENTS for j in range(1, self.nterms + 1)]
+
+    def vectors(self, coeffs):
+        """ Coefficient vector(s) in the order of the basis
+
+        For hexikes, coefficients may be given as a dict of {segment name: list of coefficients},
+        or as an array of shape (18, nterms), or an array of such arrays.
+        """
+        if isinstance(coeffs, dict):
+            vector = np.zeros((len(SEGMENTS), self.nterms))
+            for segment, values in coeffs.items():
+                vector[SEGMENTS.index(segment), :len(values)] = values
+            coeffs = vector
+        coeffs = np.asarray(coeffs, dtype=np.float64)
+        if self.kind == 'hexike':
+            return coeffs.reshape(coeffs.shape[:-2] + (len(SEGMENTS) * self.nterms,))
+        return coeffs
+
+    def opd(self, coeffs):
+        """ OPD in meters for a set of coefficients, or a cube of OPDs for an array of them """
+        return _PupilBasis.opd(self, self.vectors(coeffs))
+
+
+def get_modal_basis(kind, nterms, pupil=None):
+    """ The ModalBasis for a pupil file or HDUList, computed on first use and cached thereafter """
+    return _cached(pupil, (kind, nterms), lambda pupil: ModalBasis(kind, nterms, get_basis(pupil)))
+
+
+def _nterms(kind, coeffs):
+    if kind == 'hexike' and isinstance(coeffs, dict):
+        return max([len(values) for values in coeffs.values()])
+    return np.shape(coeffs)[-1]
+
+
+def modal_opd(options, pupil=None):
+    """ OPD in microns from the 'zernike_coeffs' and 'hexike_coeffs' in an options dict, or None if neither is set """
+    total = None
+    for kind in ['zernike', 'hexike']:
+        coeffs = options.get(kind + '_coeffs', None)
+        if coeffs is None or len(coeffs) == 0: continue
+        basis = get_modal_basis(kind, _nterms(kind, coeffs), pupil)
+        opd = basis.opd(coeffs) * 1e6
+        total = opd if total is None else total + opd
+    return total
+
+
+def add_opd(opd, extra):
+    """ Add an OPD array in microns to an OPD as given to poppy: None, a filename, a (filename, slice) tuple, or an HDUList """
+    if opd is None:
+        return fits.HDUList([fits.PrimaryHDU(data=extra)])
+    if isinstance(opd, fits.HDUList):
+        data, header = opd[0].data, opd[0].header
+    elif isinstance(opd, basestring):
+        data, header = fits.getdata(opd, header=True)
+    else:
+        data, header = fits.getdata(opd[0], header=True)
+        data = data[opd[1]]
+    if data.shape != extra.shape:
+        raise ValueError("OPD has shape %s but the pupil has shape %s" % (data.shape, extra.shape))
+    hdu = fits.PrimaryHDU(data=data + extra, header=header.copy())
+    return fits.HDUList([hdu])
+
+
+_basis_cache = {}
+_basis_lock = threading.RLock()
+
+
+def _cached(pupil, kind, function):
+    """ Look up or compute a basis for a pupil, given as a filename or an HDUList """
+    pupil = _pupil_filename(pupil)
+    with _basis_lock:
+        if isinstance(pupil, fits.HDUList):
+            # keyed by identity; keep only the latest in-memory pupil for each kind of basis
+            key = ('in-memory', kind)
+            if key not in _basis_cache or _basis_cache[key][0] is not pupil:
+                _basis_cache[key] = (pupil, function(pupil))
+        else:
+            key = (os.path.abspath(pupil), os.path.getmtime(pupil), kind)
+            if key not in _basis_cache:
+                _basis_cache[key] = (None, function(pupil))
+        return _basis_cache[key][1]
+
+
+def get_basis(pupil=None):
+    """ The SegmentBasis for a pupil file or HDUList, computed on first use and cached thereafter """
+    return _cached(pupil, 'segments', SegmentBasis)
+
+
+def sur_opd(surs, pupil=None, cumulative=True, baseline=None):
+    """ OPD in microns for a SUR, or a cube of OPDs for a sequence of SURs, as an HDUList
+
+    Parameters
+    ----------
+    surs : jwxml.SUR, or filename, or list of either
+        Segment update requests
+    pupil : string, optional
+        Pupil file defining the OPD grid. Default is the JWST pupil_RevV.fits.
+    cumulative : bool
+        Apply each SUR on top of the ones before it (True), or each on its own (False)?
+    baseline : ndarray or fits.HDUList, optional
+        OPD in microns to add to each, e.g. one realization from an OPD file
+
+    The result can be assigned to an instrument's pupilopd, or for a sequence passed to
+    `JWInstrument.calcPSF_opd_cube`.
+    """
+    basis = get_basis(pupil)
+    return basis.opd_hdulist(basis.poses(surs, cumulative=cumulative), baseline=baseline)
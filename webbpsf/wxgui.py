@@ -557,6 +557,8 @@ class WebbPSF_GUI(wx.Frame):
 
     def ev_calcPSF(self, event):
         "Event handler for PSF Calculations"
+        if not self.ButtonCompute.IsEnabled():
+            return # a calculation is already running (e.g. started again from the menu)
         self._updateFromGUI()
         self.log("Starting PSF calculation...")
 
@@ -565,8 +567,13 @@ class WebbPSF_GUI(wx.Frame):
         for w in ['Display PSF', 'Display profiles', 'Save PSF As...']:
            self.widgets[w].Enable(False)
 
-        self.calcthread = PSFCalcThread()
-        self.calcthread.runPSFCalc(self.inst, self) 
+        # no second calculation may start inside this one while the window is updated between wavelengths
+        self.ButtonCompute.Enable(False)
+        try:
+            self.calcthread = PSFCalcThread()
+            self.calcthread.runPSFCalc(self.inst, self) 
+        finally:
+            self.ButtonCompute.Enable(True)
 #        self.PSF_HDUlist = self.inst.calcPSF(source=source, 
 #                detector_oversample= self.detector_oversampling,
 #                fft_oversample=self.fft_oversampling,
@@ -855,13 +862,24 @@ class PSFCalcThread(Thread):
             fov_arcsec = None
             fov_pixels = masterapp.FOV
  
+        def wavelength_done(wavelength_result):
+            # keep the window updated between wavelengths. Not via masterapp.log, whose wx.Yield would
+            # handle user input; SafeYield blocks that, and only yields if not yielding already.
+            message = "Computed wavelength %d: %.3f um" % (wavelength_result.index+1, wavelength_result.wavelength*1e6)
+            _log.info(message)
+            masterapp.sb.SetStatusText(message)
+            masterapp.Refresh()
+            masterapp.Update()
+            masterapp._refresh_window()
+            wx.SafeYield(masterapp, True)
+
         PSF_HDUlist = instrument.calcPSF(source=source, 
                 detector_oversample = masterapp.detector_oversampling,
                 fft_oversample = masterapp.fft_oversampling,
                 fov_arcsec = fov_arcsec, fov_pixels=fov_pixels,  
                 nlambda = masterapp.nlambda, 
                 monochromatic=masterapp.monochromatic_wavelength, 
-                display = True)
+                display = True, wavelength_callback=wavelength_done)
 
         wx.PostEvent(masterapp, ResultEvent(PSF_HDUlist)) # send results back to master thread
 
@@ -1473,10 +1491,10 @@ def wxgui(fignum=1, showlog=True):
     logging.basicConfig(level=logging.INFO,format='%(name)-10s: %(levelname)-8s %(message)s')
 
 
-    # GUI does not play well with multiprocessing, so avoid that.
-    if settings.use_multiprocessing():
-        _log.error('Multiprocessing is not compatible with the GUI right now. Falling back to single-threaded.')
-        settings.use_multiprocessing.set(False)
+    # GUI does not play well with multiprocessing, so compute wavelengths on threads instead.
+    if settings.use_multiprocessing() and not settings.use_threads():
+        _log.info('Multiprocessing is not compatible with the GUI; computing wavelengths in parallel threads instead.')
+        settings.use_threads.set(True)
 
     # start the GUI
     app = wx.App()